@@ -72,6 +72,35 @@ def sub_mesh(mesh, region):
     submesh_region = SubMesh(mesh, region)
     return submesh_region
     
+def comp_transf_mat_batch(e0,e1):
+    # Rodrigues rotation matrices taking e0 into
+    # every row of e1 (shape (N,3)), returned as an array of shape (N,3,3)
+    e0 = np.asarray(e0,dtype=float)
+    e0 = e0/np.linalg.norm(e0)
+    e1 = np.asarray(e1,dtype=float).reshape((-1,3))
+    norm = np.linalg.norm(e1,axis=1)
+    e1 = np.where(norm[:,np.newaxis]>0, e1/np.where(norm>0,norm,1)[:,np.newaxis], e0)
+    
+    v = np.cross(e0,e1) # rotation axis scaled by the sine
+    c = e1.dot(e0) # cosine
+    vx = np.zeros((len(e1),3,3))
+    vx[:,0,1], vx[:,0,2], vx[:,1,2] = -v[:,2], v[:,1], -v[:,0]
+    vx[:,1,0], vx[:,2,0], vx[:,2,1] = v[:,2], -v[:,1], v[:,0]
+    
+    # Rodrigues' formula with (1-c)/s^2 = 1/(1+c), i.e. without dividing by the
+    # sine, which vanishes for e1 = e0 (T = I)
+    antiparallel = c < -1 + 1e-9
+    scale = 1/np.where(antiparallel,1,1+c)
+    T = c[:,np.newaxis,np.newaxis]*np.identity(3) + vx \
+        + scale[:,np.newaxis,np.newaxis]*np.einsum('ni,nj->nij',v,v)
+    
+    # e1 = -e0: rotation by pi around an axis normal to e0
+    if antiparallel.any():
+        u = np.cross(e0,np.identity(3)[np.argmin(abs(e0))])
+        u = u/np.linalg.norm(u)
+        T[antiparallel] = 2*np.tensordot(u,u,axes=0) - np.identity(3)
+    return T
+
 def tensor_generate(mesh, md, mf):
    Vpe = FunctionSpace(mesh, "Lagrange", 1)   
    dx = Measure("dx", domain=mesh, subdomain_data = md)
@@ -98,38 +127,21 @@ def tensor_generate(mesh, md, mf):
    Vdir = FunctionSpace(mesh, "DG", 0) 
    e = project(-grad(pe),Ve, solver_type='bicgstab')
    e = interpolate(e,Ve_DG)
-   e_array = e.vector().get_local()
+   e_array = e.vector().get_local().reshape((-1,3))
 
-   for i in range(int(len(e_array)/3)):
-       e_array[i*3:(i+1)*3] = e_array[i*3:(i+1)*3]/np.linalg.norm(e_array[i*3:(i+1)*3])
-   e.vector().set_local(e_array)
-
-   def comp_transf_mat(e0,e1):
-       v = np.cross(e0,e1)
-       s = np.linalg.norm(v) 
-       c = np.dot(e0,e1) 
-       I = np.identity(3) 
-       u = v/s
-       ux = np.array([[0,-u[2],u[1]],[u[2],0,-u[0]],[-u[1],u[0],0]])
-       T = c*I + s*ux + (1-c)*np.tensordot(u,u,axes=0)
-       return T
+   e_array = e_array/np.linalg.norm(e_array,axis=1)[:,np.newaxis]
+   e.vector().set_local(e_array.reshape(-1))
 
    K_space = TensorFunctionSpace(mesh, "DG", 0)
    e_ref = np.array([0,0,1])
    K1_form = [[0,0,0],[0,0,0],[0,0,1]]
    K1 = Function(K_space)    
    K1_array = K1.vector().get_local()
-   e_loc_array = e.vector().get_local()
+   e_loc_array = e.vector().get_local().reshape((-1,3))
 
-   for i in range(mesh.num_cells()):
-       e1 = e_loc_array[i*3:i*3+3]
-       T = comp_transf_mat(e_ref,e1)                                 
-        
-       # rotate local permeability tensor
-       K1_loc = np.reshape(np.matmul(np.matmul(T,K1_form),T.transpose()),9 ) 
-        
-       # set local permeability tensor
-       K1_array[i*9:i*9+9] = K1_loc
+   # rotate local permeability tensors of every cell at once
+   T = comp_transf_mat_batch(e_ref,e_loc_array)
+   K1_array[:] = np.einsum('nij,jk,nlk->nil',T,np.asarray(K1_form,dtype=float),T).reshape(-1)
    
    tolerance = 1e-9
    mask = abs(K1_array) < tolerance
@@ -1,5 +1,6 @@
 from dolfin import *
 import numpy as np
+import time
 import IO_funcs
 
 #%%
@@ -49,6 +50,18 @@ def func_space(mesh, eleD, configs):
     
     return Vc, DGSpace, CGSpace, uSpace, beta_ac, beta_cv, pa, pc, pv, ua, uc, depth
 
+#%% Langevin function coth(x)-1/x
+def coth_minus_inv(x, x_small=1e-2):
+    # series expansion for small arguments avoids the cancellation of coth(x) and 1/x
+    x = np.asarray(x, dtype=float)
+    L = np.zeros_like(x)
+    small = np.abs(x) < x_small
+    xs = x[small]
+    L[small] = xs/3 - xs**3/45 + 2*xs**5/945
+    xl = x[~small]
+    L[~small] = 1/np.tanh(xl) - 1/xl
+    return L
+
 #%% Calculation of artifitial diffusion
 def art_diff(mesh, ua, D_a, DGSpace, depth, configs):
     uaMag=sqrt(dot(ua,ua))
@@ -56,18 +69,19 @@ def art_diff(mesh, ua, D_a, DGSpace, depth, configs):
     
     Peh=uaMag*h/(2*D_a)
     PehVal=project(Peh,DGSpace)
+    PehVal=PehVal.vector().get_local()
     
+    # limit of the cell Peclet number (DG0 values)
     if configs.simulation.Pehdepth == True:
-        Pehlim=Expression(PehExp,degree=2,depth=depth)
+        # C++ expression of depth given in the config file, e.g. 0.9*depth+0.01 (depth is DG0, so exact per cell)
+        Pehlim=interpolate(Expression(configs.parameter.PehExp, depth=depth, degree=0), DGSpace).vector().get_local()
     else:
-        Pehlim=interpolate(Constant(configs.parameter.PehCon),DGSpace)
+        Pehlim=configs.parameter.PehCon*np.ones_like(PehVal)
     
-    alpha=np.zeros(mesh.num_cells())
-    for i in range(mesh.num_cells()):
-        if PehVal.vector()[i]!=0:
-            alpha[i]=(1/np.tanh(PehVal.vector()[i])-1/PehVal.vector()[i])/Pehlim.vector()[i]
+    alpha=coth_minus_inv(PehVal)/Pehlim
     alphaMesh=Function(DGSpace)
-    alphaMesh.vector()[:]=alpha
+    alphaMesh.vector().set_local(alpha)
+    alphaMesh.vector().apply('insert')
     dalta=alphaMesh*uaMag*h/2+D_a
     
     return dalta
@@ -93,9 +107,75 @@ def BC(boundaries, Vc, configs):
             
     return BCa
 
+#%% Linear solver settings
+# type: mumps (direct) or gmres; preconditioner of gmres: fieldsplit (block Gauss-Seidel over
+# the arteriole, capillary and tissue fields with AMG on each block), bjacobi (ILU blocks) or hypre_amg
+def solver_settings(configs):
+    settings = {'type': 'mumps', 'preconditioner': 'fieldsplit', 'rtol': 1e-8, 'atol': 1e-12,
+                'max_it': 1000, 'restart': 200, 'monitor': False}
+    if hasattr(configs, 'solver'):
+        for key in settings:
+            if hasattr(configs.solver, key):
+                settings[key] = getattr(configs.solver, key)
+    return settings
+
+def linear_solver(Vc, settings, prefix='oxygen_'):
+    if settings['type'] == 'mumps':
+        return PETScLUSolver('mumps')
+    elif settings['type'] != 'gmres':
+        raise Exception("unknown oxygen solver type: " + settings['type'])
+    
+    PETScOptions.set(prefix+'ksp_type', 'gmres')
+    PETScOptions.set(prefix+'ksp_gmres_restart', settings['restart'])
+    PETScOptions.set(prefix+'ksp_rtol', settings['rtol'])
+    PETScOptions.set(prefix+'ksp_atol', settings['atol'])
+    PETScOptions.set(prefix+'ksp_max_it', settings['max_it'])
+    if settings['monitor'] == True:
+        PETScOptions.set(prefix+'ksp_monitor')
+    if settings['preconditioner'] == 'fieldsplit':
+        PETScOptions.set(prefix+'pc_type', 'fieldsplit')
+        PETScOptions.set(prefix+'pc_fieldsplit_type', 'multiplicative')
+        for i in range(3):
+            PETScOptions.set(prefix+'fieldsplit_'+str(i)+'_ksp_type', 'preonly')
+            PETScOptions.set(prefix+'fieldsplit_'+str(i)+'_pc_type', 'hypre')
+            PETScOptions.set(prefix+'fieldsplit_'+str(i)+'_pc_hypre_type', 'boomeramg')
+    elif settings['preconditioner'] == 'bjacobi':
+        PETScOptions.set(prefix+'pc_type', 'bjacobi')
+        PETScOptions.set(prefix+'sub_pc_type', 'ilu')
+    elif settings['preconditioner'] == 'hypre_amg':
+        PETScOptions.set(prefix+'pc_type', 'hypre')
+        PETScOptions.set(prefix+'pc_hypre_type', 'boomeramg')
+    else:
+        raise Exception("unknown oxygen preconditioner: " + settings['preconditioner'])
+    
+    solver = PETScKrylovSolver()
+    solver.set_options_prefix(prefix)
+    solver.set_from_options()
+    if settings['preconditioner'] == 'fieldsplit':
+        # dofs of the three concentration fields
+        from petsc4py import PETSc
+        fields = [(str(i), PETSc.IS().createGeneral(np.array(Vc.sub(i).dofmap().dofs(), dtype=PETSc.IntType),
+                                                   comm=Vc.mesh().mpi_comm())) for i in range(3)]
+        solver.ksp().getPC().setFieldSplitIS(*fields)
+    return solver
+
+#%% Newton solver settings
+# init_linear: start from the solution with linear metabolism (M)
+# continuation_steps: metabolism blended from linear to Michaelis-Menten in this many steps
+# jacobian_reuse: max. number of Newton iterations with the same Jacobian (modified Newton),
+#                 the Jacobian is updated earlier if the residual decreases slowly
+def newton_settings(configs):
+    settings = {'init_linear': True, 'continuation_steps': 1, 'jacobian_reuse': 1,
+                'rtol': 1e-8, 'atol': 1e-14, 'max_it': 50, 'min_reduction': 0.5}
+    if hasattr(configs, 'newton'):
+        for key in settings:
+            if hasattr(configs.newton, key):
+                settings[key] = getattr(configs.newton, key)
+    return settings
+
 #%%
-def O2_Linear(beta12,beta23,mesh,Vc,pa,pc,pv,ua,uc,phiA,phiC,phiT,D_a,D_c,D_t,SaVa,ScVc,gammaA,gammaC,tau,M,BCa):
-    # solve concentration
+def O2_Linear_forms(beta12,beta23,Vc,pa,pc,pv,ua,uc,phiA,phiC,phiT,D_a,D_c,D_t,SaVa,ScVc,gammaA,gammaC,tau,M):
+    # bilinear and linear forms of the linear metabolism problem
     v_a, v_c, v_t=TestFunctions(Vc)
     C=TrialFunction(Vc)
     C_a, C_c, C_t=split(C)
@@ -109,39 +189,106 @@ def O2_Linear(beta12,beta23,mesh,Vc,pa,pc,pv,ua,uc,phiA,phiC,phiT,D_a,D_c,D_t,Sa
         
     RHS = Constant(0.0)*v_a*dx + Constant(0.0)*v_c*dx + Constant(0.0)*v_t*dx
     
-    C=Function(Vc)
-    problem=LinearVariationalProblem(LHS, RHS, C, BCa)
-    solver=LinearVariationalSolver(problem)
-    slprm=solver.parameters
-    slprm['linear_solver']='mumps'
+    return LHS, RHS
+
+#%%
+def O2_Linear(beta12,beta23,mesh,Vc,pa,pc,pv,ua,uc,phiA,phiC,phiT,D_a,D_c,D_t,SaVa,ScVc,gammaA,gammaC,tau,M,BCa,**kwarg):
+    settings = kwarg.get('settings', solver_settings(None))
     
-    solver.solve()
+    # solve concentration
+    LHS, RHS = O2_Linear_forms(beta12,beta23,Vc,pa,pc,pv,ua,uc,phiA,phiC,phiT,D_a,D_c,D_t,SaVa,ScVc,gammaA,gammaC,tau,M)
+    C=Function(Vc)
+    A, b = assemble_system(LHS, RHS, BCa)
+    solver = linear_solver(Vc, settings)
+    solver.set_operator(A)
+    solver.solve(C.vector(), b)
     Ca, Cc, Ct=C.split(deepcopy=True)
     
     return Ca, Cc, Ct
 
 #%%
-def O2_nonLinear(beta12,beta23,mesh,ele,pa,pc,pv,ua,uc,phiA,phiC,phiT,D_a,D_c,D_t,SaVa,ScVc,gammaA,gammaC,tau,G,C50,BCa):
+def O2_nonLinear(beta12,beta23,mesh,Vc,pa,pc,pv,ua,uc,phiA,phiC,phiT,D_a,D_c,D_t,SaVa,ScVc,gammaA,gammaC,tau,G,C50,BCa,**kwarg):
+    """
+    Newton iterations for the Michaelis-Menten metabolism. Optional inputs:
+    settings (linear solver), newton (see newton_settings), initial (Ca, Cc, Ct),
+    M (linear metabolism used for continuation) and report (dictionary filled
+    with iteration counts, residuals and timings).
+    """
+    settings = kwarg.get('settings', solver_settings(None))
+    newton = kwarg.get('newton', newton_settings(None))
+    report = kwarg.get('report', {})
+    M = kwarg.get('M', 0.0)
+    
     v_a, v_c, v_t=TestFunctions(Vc)
     C=Function(Vc)
     C_a, C_c, C_t=split(C)
+    if 'initial' in kwarg:
+        assign(C, list(kwarg.get('initial')))
+    
+    # continuation parameter blending linear (0) and Michaelis-Menten (1) metabolism
+    s_cont=Constant(1.0)
     
     LHS = dot(ua, grad(C_a))*v_a*dx + phiA*D_a*dot(grad(C_a),grad(v_a))*dx \
         + beta12*(pa-pc)*C_a*v_a*dx + SaVa*phiA*gammaA*(tau*C_a-C_t)*v_a*dx \
         + dot(uc, grad(C_c))*v_c*dx + phiC*D_c*dot(grad(C_c),grad(v_c))*dx \
         - beta12*(pa-pc)*C_a*v_c*dx + beta23*(pc-pv)*C_c*v_c*dx + ScVc*phiC*gammaC*(tau*C_c-C_t)*v_c*dx \
         + phiT*D_t*dot(grad(C_t),grad(v_t))*dx - SaVa*phiA*gammaA*(tau*C_a-C_t)*v_t*dx - ScVc*phiC*gammaC*(tau*C_c-C_t)*v_t*dx \
-        + phiT*G*C_t/(C50-C_t)*v_t*dx
+        + phiT*(s_cont*G*C_t/(C50-C_t) + (1-s_cont)*M*C_t)*v_t*dx
         
     J=derivative(LHS, C)
-    problem=NonlinearVariationalProblem(LHS, C, BCa, J)
-    solver=NonlinearVariationalSolver(problem)
-    slprm=solver.parameters
-    slprm['newton_solver']['linear_solver']='mumps'
     
-    solver.solve()
+    # Dirichlet values are set once, increments are zero on the boundary
+    for bc in BCa:
+        bc.apply(C.vector())
+    bcs0=[DirichletBC(bc) for bc in BCa]
+    for bc in bcs0:
+        bc.homogenize()
+    
+    # Jacobian and residual are assembled into the same tensors in every iteration
+    A, b, dC = PETScMatrix(), PETScVector(), Function(Vc)
+    solver = linear_solver(Vc, settings)
+    
+    report.update({'iterations': 0, 'jacobian_updates': 0, 'residuals': [], 'converged': True,
+                   'assembly_time': 0.0, 'solve_time': 0.0})
+    n_steps = max(int(newton['continuation_steps']), 1)
+    for step in range(1, n_steps+1):
+        s_cont.assign(step/n_steps)
+        age = newton['jacobian_reuse']  # forces a Jacobian update in the first iteration
+        res0, res_prev = None, None
+        for it in range(newton['max_it']+1):
+            start = time.time()
+            assemble(LHS, tensor=b)
+            for bc in bcs0:
+                bc.apply(b)
+            res = b.norm('l2')
+            report['assembly_time'] += time.time()-start
+            report['residuals'].append(res)
+            res0 = res if res0 is None else res0
+            if res <= newton['atol'] or res <= newton['rtol']*res0:
+                break
+            if it == newton['max_it']:
+                report['converged'] = False
+                break
+            
+            # modified Newton: the Jacobian is kept while the residual decreases fast enough
+            start = time.time()
+            if age >= newton['jacobian_reuse'] or (res_prev is not None and res > newton['min_reduction']*res_prev):
+                assemble(J, tensor=A)
+                for bc in bcs0:
+                    bc.apply(A)
+                solver.set_operator(A)
+                report['jacobian_updates'] += 1
+                age = 0
+            report['assembly_time'] += time.time()-start
+            
+            start = time.time()
+            solver.solve(dC.vector(), b)
+            C.vector().axpy(-1.0, dC.vector())
+            report['solve_time'] += time.time()-start
+            report['iterations'] += 1
+            age += 1
+            res_prev = res
+    
     Ca, Cc, Ct=C.split(deepcopy=True)
     
     return Ca, Cc, Ct
-    
-
@@ -97,14 +97,33 @@ end2=time.time()
 if rank==0: print('----Solving variational equations----')
 start3=time.time()
 
+# linear solver (mumps or preconditioned gmres) selected in the solver section of the config file
+settings=FE_solver.solver_settings(configs)
+
 if configs.simulation.nonLinear==False:
     Ca, Cc, Ct=FE_solver.O2_Linear(beta_ac,beta_cv,mesh,Vc,pa,pc,pv,ua,uc,\
                                    phiA,phiC,phiT,dalta,D_c,D_t,\
-                                   SaVa,ScVc,gammaA,gammaC,tau,M,BCa)
+                                   SaVa,ScVc,gammaA,gammaC,tau,M,BCa,settings=settings)
 else:
+    newton=FE_solver.newton_settings(configs)
+    newton_report={}
+    initial={}
+    if newton['init_linear']==True:
+        # the solution with linear metabolism is the initial guess of the Newton iterations
+        start_lin=time.time()
+        initial['initial']=FE_solver.O2_Linear(beta_ac,beta_cv,mesh,Vc,pa,pc,pv,ua,uc,\
+                                               phiA,phiC,phiT,dalta,D_c,D_t,\
+                                               SaVa,ScVc,gammaA,gammaC,tau,M,BCa,settings=settings)
+        newton_report['linear_time']=time.time()-start_lin
     Ca, Cc, Ct=FE_solver.O2_nonLinear(beta_ac,beta_cv,mesh,Vc,pa,pc,pv,ua,uc,\
                                       phiA,phiC,phiT,dalta,D_c,D_t,\
-                                      SaVa,ScVc,gammaA,gammaC,tau,G,C50,BCa)
+                                      SaVa,ScVc,gammaA,gammaC,tau,G,C50,BCa,settings=settings,\
+                                      newton=newton,M=M,report=newton_report,**initial)
+    if rank==0:
+        print('Newton iterations: ', newton_report['iterations'], '; Jacobian updates: ', newton_report['jacobian_updates'],
+              '; converged: ', newton_report['converged'])
+        print('Final residual: ', newton_report['residuals'][-1], '; assembly [s]: ', newton_report['assembly_time'],
+              '; linear solves [s]: ', newton_report['solve_time'])
         
 end3=time.time()
         
@@ -129,6 +148,14 @@ if rank == 0:
     print ('Step 2: Computing artificial diffusion and boundary conditions [s]; \t\t', end2 - start2)
     print ('Step 3: Solving variational equations [s]; \t\t', end3 - start3)
     print ('Step 4: Saving solutions [s]; \t\t', end4 - start4)
+    if configs.simulation.nonLinear==True:
+        if 'linear_time' in newton_report:
+            print ('\t Linear metabolism initial guess [s]; \t\t', newton_report['linear_time'])
+        print ('\t Newton iterations; \t\t', newton_report['iterations'])
+        print ('\t Jacobian updates; \t\t', newton_report['jacobian_updates'])
+        print ('\t Newton assembly [s]; \t\t', newton_report['assembly_time'])
+        print ('\t Newton linear solves [s]; \t\t', newton_report['solve_time'])
+        print ('\t Residual norms; \t\t', newton_report['residuals'])
     logfile.close()
     sys.stdout = oldstdout
     print ('Execution time: \t', end0 - start0, '[s]')
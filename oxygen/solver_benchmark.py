@@ -0,0 +1,112 @@
+"""
+Benchmark of the linear solvers of the oxygen model (linear metabolism)
+
+The system of oxygen_main.py is assembled on the mesh of the configuration
+file and solved with the selected solver (--solver mumps or
+gmres:fieldsplit, gmres:bjacobi, gmres:hypre_amg). Wall time, peak memory
+increase of the solver setup and solve (VmHWM, reset before the solver is
+created, summed over processes) and the relative residual are appended to a
+CSV file and all rows are compared to the mumps row. Each solver is run in a
+separate process so that PETSc options and pools do not carry over:
+
+for s in mumps gmres:fieldsplit gmres:bjacobi gmres:hypre_amg; do
+    mpirun -n 6 python3 solver_benchmark.py --solver $s
+done
+"""
+
+#%% Import modules
+# python3 modules
+from dolfin import *
+import numpy as np
+import time
+import argparse
+import os
+# user modules
+import FE_solver, IO_funcs
+
+# solver runs is "silent" mode
+set_log_level(50)
+
+# define MPI variables
+comm=MPI.comm_world
+rank=comm.Get_rank()
+size=comm.Get_size()
+
+parser=argparse.ArgumentParser()
+parser.add_argument("--config_file", help="path of configuration file", type=str, default='./config_oxygen_solver.yaml')
+parser.add_argument("--rslt", help="path fo results folder (string ended with /)", type=str, default=None)
+parser.add_argument("--solver", help="mumps or gmres:preconditioner (fieldsplit, bjacobi, hypre_amg)",
+                    type=str, default='mumps')
+parser.add_argument("--benchmark_file", help="CSV file collecting the benchmark results",
+                    type=str, default='./solver_benchmark.csv')
+args=parser.parse_args()
+
+configs=IO_funcs.oxygen_config_reader(args.config_file, parser)
+settings=FE_solver.solver_settings(configs)
+settings['type']=args.solver.split(':')[0]
+if settings['type']=='gmres':
+    settings['preconditioner']=args.solver.split(':')[1]
+
+def memory_status(key):
+    # current (VmRSS) or peak (VmHWM) resident memory of the process [MB]
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key):
+                return float(line.split()[1])/1024
+
+def reset_peak_memory():
+    # reset VmHWM to the current resident memory (Linux >= 4.0), so that earlier
+    # peaks (mesh reading, assembly) are not charged to the solver
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        raise Exception('resetting the peak memory (/proc/self/clear_refs) is not supported')
+
+#%% Assemble the linear system of oxygen_main.py
+mesh, subdomains, boundaries=IO_funcs.mesh_reader_xdmf(configs.input.mesh_file)
+Vc, DGSpace, CGSpace, uSpace, beta_ac, beta_cv,\
+pa, pc, pv, ua, uc, depth=FE_solver.func_space(mesh, configs.simulation.eleD, configs)
+prm=configs.parameter
+dalta=FE_solver.art_diff(mesh, ua, prm.D_a, DGSpace, depth, configs)
+BCa=FE_solver.BC(boundaries, Vc, configs)
+
+LHS, RHS=FE_solver.O2_Linear_forms(beta_ac,beta_cv,Vc,pa,pc,pv,ua,uc,prm.phiA,prm.phiC,prm.phiT,dalta,prm.D_c,prm.D_t,
+                                  prm.SaVa,prm.ScVc,prm.gammaA,prm.gammaC,prm.tau,prm.M)
+A, b = assemble_system(LHS, RHS, BCa)
+
+#%% Solve
+C=Function(Vc)
+reset_peak_memory()
+mem0=memory_status('VmRSS')
+comm.Barrier()
+start=time.time()
+solver=FE_solver.linear_solver(Vc, settings)
+solver.set_operator(A)
+n_iter=solver.solve(C.vector(), b)
+comm.Barrier()
+solve_time=time.time()-start
+memory=MPI.sum(comm, memory_status('VmHWM')-mem0)
+
+residual=b.copy()
+A.mult(C.vector(), residual)
+residual.axpy(-1, b)
+rel_res=residual.norm('l2')/max(b.norm('l2'), 1e-300)
+
+#%% Report
+if rank==0:
+    new_file=not os.path.isfile(args.benchmark_file)
+    with open(args.benchmark_file, 'a') as f:
+        if new_file:
+            f.write('solver,processes,dofs,time [s],memory [MB],iterations,relative residual\n')
+        f.write('%s,%d,%d,%e,%e,%d,%e\n' % (args.solver, size, Vc.dim(), solve_time, memory, n_iter, rel_res))
+
+    data=np.genfromtxt(args.benchmark_file, delimiter=',', skip_header=1, dtype=None, encoding=None)
+    data=np.atleast_1d(data)
+    reference=[row for row in data if row[0]=='mumps' and row[1]==size and row[2]==Vc.dim()]
+    print('solver \t\t time [s] \t memory [MB] \t iterations \t time/mumps \t memory/mumps')
+    for row in data:
+        if row[1]!=size or row[2]!=Vc.dim():
+            continue
+        ratios=(row[3]/reference[-1][3], row[4]/max(reference[-1][4], 1e-300)) if reference else (np.nan, np.nan)
+        print('%-16s %e \t %e \t %d \t\t %.3f \t\t %.3f' % (row[0], row[3], row[4], row[5], ratios[0], ratios[1]))
@@ -1,10 +1,13 @@
 import os
 import subprocess
 import shutil
+from multiprocessing.connection import Client
 
 from desist.eventhandler.api import API
 from desist.isct.utilities import read_yaml, write_yaml
 
+from perfusion.worker_key import read_worker_key
+
 # Default path (inside the container) pointing to the YAML configuration for
 # the `basic_flow_solver` routine.
 permeability_config_name = 'config_permeability_initialiser.yaml'
@@ -113,14 +116,27 @@ class API(API):
         #     f'{perfusion_dir}/perfusion_config.yaml')
         write_yaml(perfusion_config_file, solver_config)
 
-        # form command to evaluate perfusion
-        solve_cmd = [
-            "python3", "basic_flow_solver.py", "--res_fldr", f"{res_folder}/",
-            "--config_file", f"{str(perfusion_config_file)}"
-        ]
+        # a persistent perfusion worker (see `perfusion_worker.py`) keeps the
+        # mesh and function spaces of the patient in memory between events
+        worker_port = self.current_model.get('perfusion_worker_port', None)
+        if worker_port is not None:
+            solver_config['output']['res_fldr'] = f"{res_folder}/"
+            print(f"Submitting scenario to perfusion worker on port {worker_port}", flush=True)
+            authkey = read_worker_key(int(worker_port))
+            with Client(('localhost', int(worker_port)), authkey=authkey) as conn:
+                conn.send(solver_config)
+                reply = conn.recv()
+            if reply['status'] != 'done':
+                raise Exception(f"Perfusion worker failed: {reply.get('error')}")
+        else:
+            # form command to evaluate perfusion
+            solve_cmd = [
+                "python3", "basic_flow_solver.py", "--res_fldr", f"{res_folder}/",
+                "--config_file", f"{str(perfusion_config_file)}"
+            ]
 
-        print(f"Evaluating: '{' '.join(solve_cmd)}'", flush=True)
-        subprocess.run(solve_cmd, check=True, cwd=PERFUSION_ROOT)
+            print(f"Evaluating: '{' '.join(solve_cmd)}'", flush=True)
+            subprocess.run(solve_cmd, check=True, cwd=PERFUSION_ROOT)
 
         # terminate baseline scenario
         if self.event_id == 0:
@@ -165,7 +181,8 @@ class API(API):
         print(f"Evaluating: '{' '.join(infarct_cmd)}'", flush=True)
         subprocess.run(infarct_cmd, check=True, cwd=PERFUSION_ROOT)
 
-        # convert perfusion FEM result to NIFTI
+        # convert FEM results to NIFTI (all variables in a single run)
+        image_variables = self.current_model.get('image_variables', ['perfusion'])
         res2img_cmd = [
             "python3",
             "convert_res2img.py",
@@ -174,7 +191,7 @@ class API(API):
             "--res_fldr",
             f"{res_folder}/",
             "--variable",
-            "perfusion",
+            *image_variables,
             "--save_figure",
         ]
         print(f"Evaluating: '{' '.join(res2img_cmd)}'", flush=True)
@@ -203,6 +203,44 @@ def inlet_file_reader(inlet_boundary_file):
     return boundary_data
 
 
+#%%
+def boundary_data(label,Q,p,artery,bc_type):
+    # boundary conditions of the surface regions (arrays of equal length):
+    # region label, Q [ml/s], p [Pa], feeding artery ID, BC: p->0 or Q->1
+    return {'label': np.asarray(label, dtype=int), 'Q': np.asarray(Q, dtype=float),
+            'p': np.asarray(p, dtype=float), 'artery': np.asarray(artery, dtype=int),
+            'type': np.asarray(bc_type, dtype=int)}
+
+
+#%%
+def read_boundary_data(inlet_boundary_file):
+    # boundary data from a boundary condition file (missing artery and BC columns are set to 0)
+    BC_data = np.loadtxt(inlet_boundary_file,skiprows=1,delimiter=',',ndmin=2)
+    columns = [BC_data[:,i] if i<BC_data.shape[1] else np.zeros(len(BC_data)) for i in range(5)]
+    return boundary_data(*columns)
+
+
+#%%
+def write_boundary_data(bc_data,inlet_boundary_file):
+    with open(inlet_boundary_file, 'w') as f:
+        f.write("# region I,Q [ml/s],p [Pa],feeding artery ID,BC: p->0 or Q->1\n")
+        for row in zip(bc_data['label'], bc_data['Q'], bc_data['p'], bc_data['artery'], bc_data['type']):
+            f.write("%d,%.16g,%.16g,%d,%d\n" % row)
+
+
+#%%
+def bcast_boundary_data(bc_data,root=0):
+    # boundary data of the root process on every process
+    return MPI.comm_world.bcast(bc_data, root=root)
+
+
+#%%
+def boundary_data_array(bc_data):
+    # rows as in the boundary condition file: label, Q, p, artery, BC type
+    return np.column_stack([bc_data['label'], bc_data['Q'], bc_data['p'],
+                            bc_data['artery'], bc_data['type']]).astype(float)
+
+
 #%%
 def initialise_permeabilities(K1_space,K2_space,mesh, permeability_folder,**kwarg):
     if 'model_type' in kwarg:
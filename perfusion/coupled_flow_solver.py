@@ -34,6 +34,7 @@ import sys
 
 from Blood_Flow_1D import Patient, Results, GeneralFunctions, Constants
 import contextlib
+import multiprocessing
 import scipy.optimize
 
 # solver runs is "silent" mode
@@ -46,6 +47,23 @@ size = comm.Get_size()
 
 start0 = time.time()
 
+# time spent by every process waiting for rank 0 (mostly for the 1-D model)
+idle_time = {'calibration': 0.0, 'coupling': 0.0, 'output': 0.0}
+
+
+def timed_barrier(phase):
+    start = time.time()
+    comm.Barrier()
+    idle_time[phase] += time.time() - start
+
+
+def timed_bcast(value, phase):
+    start = time.time()
+    value = comm.bcast(value, root=0)
+    idle_time[phase] += time.time() - start
+    return value
+
+
 # %% READ INPUT
 if rank == 0:
     print('Step 1: Reading input files, initialising functions and parameters')
@@ -65,6 +83,25 @@ config_file = parser.parse_args().config_file
 
 configs = IO_fcts.basic_flow_config_reader_yml(config_file, parser)
 
+# coupling of the 1-D and 3-D models
+coupled_model = configs['simulation']['coupled_model'] if 'coupled_model' in configs['simulation'] else True
+# 'direct': 3-D solve in every residual evaluation, 'response': affine response of the 3-D model
+try:
+    coupling_mode = configs['simulation']['coupling_mode'].lower().strip()
+except KeyError:
+    coupling_mode = 'direct'
+if coupling_mode not in ['direct', 'response']:
+    raise Exception("coupling_mode must be 'direct' or 'response'")
+# the 3-D flow rates only respond to the coupling point pressures with pressure boundary conditions
+if coupled_model and coupling_mode == 'response' and configs['input']['inlet_BC_type'] != 'DBC':
+    raise Exception("coupling_mode 'response' requires inlet_BC_type 'DBC'")
+# solve the 1-D model in a forked process during the 3-D solves (direct coupling, uses an additional core);
+# rank 0 is forked after MPI initialisation, which is not supported by every MPI implementation and transport
+try:
+    overlap_1d_model = configs['simulation']['overlap_1d_model']
+except KeyError:
+    overlap_1d_model = False
+
 # physical parameters
 p_arterial, p_venous = configs['physical']['p_arterial'], configs['physical']['p_venous']
 K1gm_ref, K2gm_ref, K3gm_ref, gmowm_perm_rat = \
@@ -121,7 +158,7 @@ if rank == 0:
     for outlet in Patient.Topology.OutletNodes:
         outlet.Pressure = outlet.OutPressure
     Patient.Perfusion.UpdateMappedRegionsFlowdata(configs['input']['inlet_boundary_file'])
-comm.Barrier()
+timed_barrier('calibration')
 
 try:
     compartmental_model = configs['simulation']['model_type'].lower().strip()
@@ -181,8 +218,8 @@ if not GeneralFunctions.is_non_zero_file(coupled_resistance_file):
     # krylov_solver_preconditioners()
     if rank == 0:
         print('\t pressure computation')
-    p = fe_mod.solve_lin_sys(Vp, LHS, RHS, BCs, lin_solver, precond, rtol, mon_conv, init_sol,
-                             model_type=compartmental_model)
+    p_sol = fe_mod.solve_lin_sys(Vp, LHS, RHS, BCs, lin_solver, precond, rtol, mon_conv, init_sol,
+                                 model_type=compartmental_model)
     end2 = time.time()
 
     # %% COMPUTE VELOCITY FIELDS, SAVE SOLUTION, EXTRACT FIELD VARIABLES
@@ -191,7 +228,7 @@ if not GeneralFunctions.is_non_zero_file(coupled_resistance_file):
     start3 = time.time()
 
     myResults = {}
-    suppl_fcts.compute_my_variables(p, K1, K2, K3, beta12, beta23, p_venous, Vp, Vvel, K2_space, configs,
+    suppl_fcts.compute_my_variables(p_sol, K1, K2, K3, beta12, beta23, p_venous, Vp, Vvel, K2_space, configs,
                                     myResults, compartmental_model, rank)
     my_integr_vars = {}
     surf_int_values, surf_int_header, volu_int_values, volu_int_header = \
@@ -409,7 +446,7 @@ else:
             node.R2 = float(line[1])
             node.R1 = 0
 
-comm.Barrier()
+timed_barrier('calibration')
 exit_program = comm.bcast(exit_program, root=0)
 if exit_program:
     sys.exit()
@@ -432,65 +469,246 @@ if exit_program:
 
 
 # %% RUN COUPLED MODEL
-def coupledmodel(P, stopp):
-    stopp[0] = comm.bcast(stopp[0], root=0)
-    # update boundary file and vessel outlet
+# linear solver shared by every evaluation of the coupled model (permeabilities do not change)
+pressure_solver = fe_mod.LinSysSolver(Vp, lin_solver, precond, rtol, mon_conv)
+
+# coupled surface regions (labels > 2), the ith coupling point of the 1-D model belongs to the ith region
+boundary_labels = suppl_fcts.region_label_assembler(boundaries)[0]
+coupling_labels = boundary_labels[boundary_labels > 2]
+
+# with pressure boundary conditions, forms and boundary conditions are set up once and the coupling point pressures
+# are Constants, otherwise they are set up from the boundary data broadcast by rank 0 in every evaluation
+coupling_pressures = None
+if configs['input']['inlet_BC_type'] == 'DBC':
+    coupled_LHS, coupled_RHS, sigma1, sigma2, sigma3, coupled_BCs, coupling_pressures = \
+        fe_mod.set_up_fe_solver_const_bc(mesh, boundaries, Vp, v_1, v_2, v_3, p, p1, p2, p3, K1, K2, K3,
+                                         beta12, beta23, p_arterial, p_venous, coupling_labels,
+                                         model_type=compartmental_model)
+
+# surface integral of the arterial velocity (-K1*grad(p1)) compiled once, evaluated on the solution of pressure_solver
+if compartmental_model == 'acv':
+    solved_p1 = split(pressure_solver.p)[0]
+else:
+    solved_p1 = pressure_solver.p
+flux_form = suppl_fcts.label_form(dot(-K1 * grad(solved_p1), FacetNormal(mesh)), mesh, boundaries)
+
+# timing of every evaluation of the coupled model
+timing_file = configs['output']['res_fldr'] + 'coupling_timings.csv'
+timings = {}
+if rank == 0:
+    with open(timing_file, 'w') as f:
+        f.write('evaluation,type,3-D setup [s],3-D solve [s],flux integration [s],1-D model [s],total [s]\n')
+
+
+def log_timings(evaluation_type):
     if rank == 0:
-        for index, node in enumerate(Patient.Perfusion.CouplingPoints):
-            node.Node.OutPressure = P[index]  # set pressure at the coupling point
-            node.Node.Pressure = P[index]  # for updating boundary file
+        timings['evaluation'] = timings.get('evaluation', 0) + 1
+        with open(timing_file, 'a') as f:
+            f.write('%d,%s,%e,%e,%e,%e,%e\n' % (
+                timings['evaluation'], evaluation_type, timings.get('setup', 0), timings.get('solve', 0),
+                timings.get('flux', 0), timings.get('1d', 0), timings.get('total', 0)))
+    for key in ['setup', 'solve', 'flux', '1d', 'total']:
+        timings[key] = 0
+
+
+# boundary data are exchanged in memory, the boundary file is only written in every evaluation for auditing
+try:
+    save_boundary_file = configs['output']['save_boundary_file']
+except KeyError:
+    save_boundary_file = False
+
+
+def set_coupling_pressures(P, write_file=False):
+    # pressure at the coupling points of the 1-D model (rank 0 only)
+    for index, node in enumerate(Patient.Perfusion.CouplingPoints):
+        node.Node.OutPressure = P[index]  # set pressure at the coupling point
+        node.Node.Pressure = P[index]  # for updating boundary file
+    if write_file:
         Patient.Perfusion.UpdateMappedRegionsFlowdata(configs['input']['inlet_boundary_file'])
-    P = comm.bcast(P, root=0)
-    # Run perfusion model
-    with contextlib.redirect_stdout(None):
-        Vp, Vvel, v_1, v_2, v_3, p, p1, p2, p3, K1_space, K2_space = \
-            fe_mod.alloc_fct_spaces(mesh, configs['simulation']['fe_degr'],
-                                    model_type=compartmental_model, vel_order=velocity_order)
 
+
+def coupling_boundary_data(pressures, bc_type):
+    # boundary data of the coupled surface regions with the flow rates of the 1-D model (rank 0 only)
+    points = Patient.Perfusion.CouplingPoints
+    return IO_fcts.boundary_data([Constants.StartClusteringIndex + index for index in range(len(points))],
+                                 [cp.Node.WKNode.AccumulatedFlowRate for cp in points], pressures,
+                                 [Constants.MajorIDdict[cp.Node.MajorVesselID] for cp in points], bc_type)
+
+
+def coupling_flow_rates():
+    # flow rates through the coupled surface regions and total inflow from the solution of pressure_solver
+    # (sign to match 1-d bf model, positive flow towards the brain)
+    surface_flux = suppl_fcts.integrate_by_label(flux_form, mesh, boundaries)
+    FlowRateAtBoundary = surface_flux[coupling_labels] * -1
+    return numpy.append(FlowRateAtBoundary, -numpy.sum(surface_flux[boundary_labels[boundary_labels > 0]]))
+
+
+def perfusion_flow_rates(P):
+    # 3-D solve (every process) with coupling point pressures P, returns the flow rates through the surface regions
+    start = time.time()
+    if coupling_pressures is not None:
+        for pressure, value in zip(coupling_pressures, P):
+            pressure.assign(float(value))
+        LHS, RHS, BCs = coupled_LHS, coupled_RHS, coupled_BCs
+    else:
+        bc_data = None
+        if rank == 0:
+            bc_data = coupling_boundary_data(P, numpy.zeros(len(P)))
+        timed_barrier('coupling')
+        bc_data = IO_fcts.bcast_boundary_data(bc_data)
         LHS, RHS, sigma1, sigma2, sigma3, BCs = \
             fe_mod.set_up_fe_solver2(mesh, subdomains, boundaries, Vp, v_1, v_2, v_3,
                                      p, p1, p2, p3, K1, K2, K3, beta12, beta23,
                                      p_arterial, p_venous,
                                      configs['input']['read_inlet_boundary'], configs['input']['inlet_boundary_file'],
-                                     configs['input']['inlet_BC_type'], model_type=compartmental_model)
+                                     configs['input']['inlet_BC_type'], model_type=compartmental_model,
+                                     boundary_data=bc_data)
+    start_solve = time.time()
 
-        p = fe_mod.solve_lin_sys(Vp, LHS, RHS, BCs, lin_solver, precond, rtol, mon_conv, init_sol,
-                                 model_type=compartmental_model)
-        myResults = {}
-        suppl_fcts.compute_my_variables(p, K1, K2, K3, beta12, beta23, p_venous, Vp, Vvel, K2_space, configs,
-                                        myResults, compartmental_model, rank, save_data=False)
-        my_integr_vars = {}
-        surf_int_values, surf_int_header, volu_int_values, volu_int_header = \
-            suppl_fcts.compute_integral_quantities(configs, myResults, my_integr_vars,
-                                                   mesh, subdomains, boundaries, rank, save_data=False)
-
-        # Flow rate from the perfusion model (sign to match 1-d bf model, positive flow towards the brain)
-        coupled_surface_index_start = 2 if 1 in surf_int_values[:, 0] else 1
-        FlowRateAtBoundary = my_integr_vars['vel1_surfint'][coupled_surface_index_start:] * -1
-        FlowRateAtBoundary = numpy.append(FlowRateAtBoundary, -numpy.sum(my_integr_vars['vel1_surfint'][:]))
-        # Pressure from the perfusion model
-        # PressureAtBoundary = my_integr_vars['press1_surfave'][coupled_surface_index_start:]
+    # the operator and its preconditioner are reused, only the Dirichlet values change
+    pressure_solver.solve(LHS, RHS, BCs, timer=False)
+    start_flux = time.time()
+
+    FlowRateAtBoundary = coupling_flow_rates()
+    end = time.time()
+    timings['setup'] = start_solve - start
+    timings['solve'] = start_flux - start_solve
+    timings['flux'] = end - start_flux
+    return FlowRateAtBoundary
+
+
+def run_1d_model():
+    # steady state 1-D bf model with the current coupling point pressures (rank 0 only)
+    start = time.time()
+    Patient.Run1DSteadyStateModel(model="Linear", tol=1e-7, clotactive=clotactive, PressureInlets=True,
+                                  FlowRateOutlets=False, coarseCollaterals=coarseCollaterals,
+                                  frictionconstant=frictionconstant, scale_resistance=False)
+    timings['1d'] = time.time() - start
+    return [Node.Node.WKNode.AccumulatedFlowRate for index, Node in enumerate(Patient.Perfusion.CouplingPoints)]
+
+
+# The 1-D model only depends on the coupling point pressures, so it can run in a forked process of rank 0 while every
+# process solves the 3-D model (the forked process keeps its own copy of the 1-D model between evaluations, the
+# coupling point flow rates are copied back to rank 0).
+model_pool = None
+
+
+def solve_1d_model(P):
+    # 1-D bf model in the forked process, returns the flow rates and the execution time
+    set_coupling_pressures(P)
+    with contextlib.redirect_stdout(None):
+        flowrate1d = run_1d_model()
+    return flowrate1d, timings['1d']
+
+
+def coupledmodel(P, stopp):
+    start = time.time()
+    stopp[0] = timed_bcast(stopp[0], 'coupling')
+    # update vessel outlet
+    pending_1d = None
+    if rank == 0:
+        set_coupling_pressures(P, write_file=save_boundary_file)
+        # the last evaluation runs in this process to keep the state of the 1-D model for the output
+        if model_pool is not None and stopp[0] == 0:
+            pending_1d = model_pool.apply_async(solve_1d_model, (P,))
+    P = timed_bcast(P, 'coupling')
+    # Run perfusion model
+    with contextlib.redirect_stdout(None):
+        FlowRateAtBoundary = perfusion_flow_rates(P)
 
         # Run 1-D bf model
         residualFlowrate = 0
         if rank == 0:
-            Patient.Run1DSteadyStateModel(model="Linear", tol=1e-7, clotactive=clotactive, PressureInlets=True,
-                                          FlowRateOutlets=False, coarseCollaterals=coarseCollaterals,
-                                          frictionconstant=frictionconstant, scale_resistance=False)
-
+            if pending_1d is not None:
+                start_wait = time.time()
+                flowrate1d, timings['1d'] = pending_1d.get()
+                idle_time['coupling'] += time.time() - start_wait
+                # the boundary data of the next evaluation (NBC, mixed) use the flow rates of this process
+                for cp, flowrate in zip(Patient.Perfusion.CouplingPoints, flowrate1d):
+                    cp.Node.WKNode.AccumulatedFlowRate = flowrate
+            else:
+                flowrate1d = run_1d_model()
             # return residuals
-            flowrate1d = [Node.Node.WKNode.AccumulatedFlowRate for index, Node in
-                          enumerate(Patient.Perfusion.CouplingPoints)]
-            # pressure1d = [Node.Node.WKNode.Pressure for index, Node in enumerate(Patient.Perfusion.CouplingPoints)]
             residualFlowrate = [(i * 1e-3 - j) for i, j in zip(FlowRateAtBoundary, flowrate1d)]
-        residualFlowrate = comm.bcast(residualFlowrate, root=0)
+        residualFlowrate = timed_bcast(residualFlowrate, 'coupling')
+    timings['total'] = time.time() - start
+    log_timings('direct')
     return residualFlowrate
 
+
+# The 3-D model is linear, so the flow rates through the coupled surface regions are an affine function of the
+# coupling point pressures: F(P) = F(P0) + J (P - P0). The response (F(P0), J) is computed with one 3-D solve for P0
+# and one for each coupling point (pressure increased by dp) and kept for the rest of the run.
+flux_response = {}
+
+
+def comp_flux_response(P0, dp):
+    # every process has to call it, P0 is taken from rank 0
+    if 'matrix' not in flux_response:
+        P0 = numpy.array(timed_bcast(P0, 'coupling'), dtype=float)
+        n_points = len(P0)
+        flow_rates = []
+        for i in range(n_points + 1):
+            start = time.time()
+            P = P0.copy()
+            if i > 0:
+                P[i - 1] += dp
+            with contextlib.redirect_stdout(None):
+                flow_rates.append(perfusion_flow_rates(P)[:n_points])
+            timings['total'] = time.time() - start
+            log_timings('response setup')
+            if rank == 0:
+                print(f"\t3-D response {i}/{n_points}")
+                sys.stdout.flush()
+        flux_response['pressure'] = P0
+        flux_response['base'] = flow_rates[0]
+        flux_response['matrix'] = (numpy.array(flow_rates[1:]).T - flow_rates[0][:, numpy.newaxis]) / dp
+    return flux_response
+
+
+def predicted_flow_rates(P):
+    # flow rates of the 3-D model from the affine response [mm^3/s]
+    return flux_response['base'] + flux_response['matrix'].dot(numpy.asarray(P) - flux_response['pressure'])
+
+
+def coupledmodel_response(P):
+    # residual with the 1-D model and the response of the 3-D model (rank 0 only)
+    start = time.time()
+    set_coupling_pressures(P, write_file=False)
+    with contextlib.redirect_stdout(None):
+        flowrate1d = run_1d_model()
+    residualFlowrate = predicted_flow_rates(P) * 1e-3 - numpy.array(flowrate1d)
+    timings['total'] = time.time() - start
+    log_timings('response')
+    return residualFlowrate
+
+
 clotactive = True
 # Find the pressure at coupling points (identical to the surface regions) such that flowrate of the models are equal.
-coupled_model = configs['simulation']['coupled_model'] if 'coupled_model' in configs['simulation'] else True
 number_coupling_points = suppl_fcts.region_label_assembler(boundaries)[1] - 3
-if coupled_model:
+final_bc_data = None
+if coupled_model and coupling_mode == 'response':
+    if rank == 0:
+        print("\033[96mRunning two-way coupling with the response of the 3-D model\033[m")
+        sys.stdout.flush()
+        guessPressure = numpy.array([p_arterial for node in Patient.Perfusion.CouplingPoints])
+    else:
+        guessPressure = numpy.zeros(number_coupling_points)
+    comp_flux_response(guessPressure, p_arterial - p_venous)
+    if rank == 0:
+        print(f"Initial guess: {guessPressure}")
+        sys.stdout.flush()
+        sol = scipy.optimize.root(coupledmodel_response, guessPressure, method='krylov',
+                                  options={'disp': True, 'maxiter': 50,
+                                           'fatol': configs['simulation']['cpld_conv_crit'],
+                                           'jac_options': {'rdiff': 1e-6}})
+        # 1-D model at the solution, the full 3-D solve follows in step 3
+        set_coupling_pressures(sol.x)
+        with contextlib.redirect_stdout(None):
+            run_1d_model()
+        final_bc_data = coupling_boundary_data(sol.x, numpy.zeros(len(sol.x)))
+        sys.stdout.flush()
+elif coupled_model:
     if rank == 0:
         print("\033[96mRunning two-way coupling\033[m")
         sys.stdout.flush()
@@ -499,12 +717,21 @@ if coupled_model:
         print(f"Initial guess: {guessPressure}")
         sys.stdout.flush()
         stop = [0]
-        sol = scipy.optimize.root(coupledmodel, guessPressure, args=(stop,), method='krylov',
-                                  options={'disp': True, 'maxiter': 10,
-                                           'fatol': configs['simulation']['cpld_conv_crit'],
-                                           'jac_options': {'rdiff': 1e-6}})
+        if overlap_1d_model:
+            model_pool = multiprocessing.get_context('fork').Pool(1)
+        try:
+            sol = scipy.optimize.root(coupledmodel, guessPressure, args=(stop,), method='krylov',
+                                      options={'disp': True, 'maxiter': 10,
+                                               'fatol': configs['simulation']['cpld_conv_crit'],
+                                               'jac_options': {'rdiff': 1e-6}})
+        finally:
+            # the forked process must not outlive the MPI rank
+            if model_pool is not None:
+                model_pool.terminate()
+                model_pool = None
         stop = [1]
         coupledmodel(sol.x, stop)
+        final_bc_data = coupling_boundary_data(sol.x, numpy.zeros(len(sol.x)))
         sys.stdout.flush()
     else:
         stop = [0]
@@ -549,17 +776,18 @@ else:  # decoupled
                                            'fatol': configs['simulation']['cpld_conv_crit'],
                                            'jac_options': {'rdiff': 1e-6}})
 
-        with open(configs['input']['inlet_boundary_file'], 'w') as f:
-            f.write("# region I,Q [ml/s],p [Pa],feeding artery ID,BC: p->0 or Q->1\n")
-            for index, i in enumerate(Patient.Perfusion.CouplingPoints):
-                flow_rate = i.Node.WKNode.AccumulatedFlowRate
-                pressure = i.Node.WKNode.Pressure
-                boundary_type = 1 if flow_rate < 1e-6 else 0
-                f.write("%d,%.16g,%.16g,%d,%d\n" % (
-                    Constants.StartClusteringIndex + index, flow_rate, pressure,
-                    Constants.MajorIDdict[i.Node.MajorVesselID], boundary_type))
+        final_bc_data = coupling_boundary_data(
+            [i.Node.WKNode.Pressure for i in Patient.Perfusion.CouplingPoints],
+            [1 if i.Node.WKNode.AccumulatedFlowRate < 1e-6 else 0 for i in Patient.Perfusion.CouplingPoints])
     configs['input']['inlet_BC_type'] = "mixed"
 
+# boundary conditions of the solution for the full 3-D solve, the boundary file is kept as result
+if rank == 0:
+    IO_fcts.write_boundary_data(final_bc_data, configs['input']['inlet_boundary_file'])
+# the other processes wait here during the 1-D model iterations of rank 0 (response and decoupled models)
+timed_barrier('coupling')
+final_bc_data = IO_fcts.bcast_boundary_data(final_bc_data)
+
 if rank == 0:
     print(sol)
     sys.stdout.flush()
@@ -567,7 +795,7 @@ if rank == 0:
         for key, value in sol.items():
             f.write('%s:%s\n' % (key, value))
 
-comm.Barrier()
+timed_barrier('coupling')
 
 end2 = time.time()
 if rank == 0:
@@ -575,37 +803,38 @@ if rank == 0:
 start3 = time.time()
 
 with contextlib.redirect_stdout(None):
-    Vp, Vvel, v_1, v_2, v_3, p, p1, p2, p3, K1_space, K2_space = \
-        fe_mod.alloc_fct_spaces(mesh, configs['simulation']['fe_degr'],
-                                model_type=compartmental_model, vel_order=velocity_order)
-
     LHS, RHS, sigma1, sigma2, sigma3, BCs = \
         fe_mod.set_up_fe_solver2(mesh, subdomains, boundaries, Vp, v_1, v_2, v_3, p, p1, p2, p3, K1, K2, K3, beta12,
                                  beta23, p_arterial, p_venous,
                                  configs['input']['read_inlet_boundary'], configs['input']['inlet_boundary_file'],
-                                 configs['input']['inlet_BC_type'], model_type=compartmental_model)
+                                 configs['input']['inlet_BC_type'], model_type=compartmental_model,
+                                 boundary_data=final_bc_data)
 
-    p = fe_mod.solve_lin_sys(Vp, LHS, RHS, BCs, lin_solver, precond, rtol, mon_conv, init_sol,
-                             model_type=compartmental_model)
+    p_sol = pressure_solver.solve(LHS, RHS, BCs)
     myResults = {}
-    suppl_fcts.compute_my_variables(p, K1, K2, K3, beta12, beta23, p_venous, Vp, Vvel, K2_space, configs,
+    suppl_fcts.compute_my_variables(p_sol, K1, K2, K3, beta12, beta23, p_venous, Vp, Vvel, K2_space, configs,
                                     myResults, compartmental_model, rank)
     my_integr_vars = {}
     surf_int_values, surf_int_header, volu_int_values, volu_int_header = \
         suppl_fcts.compute_integral_quantities(configs, myResults, my_integr_vars,
                                                mesh, subdomains, boundaries, rank)
 
-    # Flow rate from the perfusion model (sign to match 1-d bf model, positive flow towards the brain)
+    # Flow rate from the perfusion model, integrated as in the coupling (the projected velocity is only saved)
     coupled_surface_index_start = 2 if 1 in surf_int_values[:, 0] else 1
-    FlowRateAtBoundary = my_integr_vars['vel1_surfint'][coupled_surface_index_start:] * -1
-    FlowRateAtBoundary = numpy.append(FlowRateAtBoundary, -numpy.sum(my_integr_vars['vel1_surfint'][:]))
+    FlowRateAtBoundary = coupling_flow_rates()
     # Pressure from the perfusion model
     PressureAtBoundary = my_integr_vars['press1_surfave'][coupled_surface_index_start:]
 
     # perfusion_stroke = project(abs(beta12 * (p1 - p2) * 6000), K2_space, solver_type='bicgstab', preconditioner_type='petsc_amg')
-comm.Barrier()
+timed_barrier('output')
 
 if rank == 0:
+    if 'matrix' in flux_response:
+        # deviation of the affine response from the full 3-D solve
+        n_points = len(flux_response['base'])
+        response_error = numpy.abs(predicted_flow_rates(sol.x) - FlowRateAtBoundary[:n_points]).max()
+        print(f"\tMax. flow rate difference of the 3-D response: {response_error} mm^3/s")
+
     # export some results
     Patient.Results1DSteadyStateModel()
     # export data in same format as the 1-D pulsatile model
@@ -643,9 +872,18 @@ if rank == 0:
                 cp.Node.WKNode.AccumulatedFlowRate,
                 FlowRateAtBoundary[index] * 1e-3))
 
+timed_barrier('output')
 end3 = time.time()
 end0 = time.time()
 
+# idle time of every process
+idle_times = comm.gather([idle_time['calibration'], idle_time['coupling'], idle_time['output']], root=0)
+if rank == 0:
+    with open(configs['output']['res_fldr'] + "rank_idle_times.csv", 'w') as f:
+        f.write('rank,calibration idle [s],coupling idle [s],output idle [s],total execution [s]\n')
+        for r, values in enumerate(idle_times):
+            f.write('%d,%e,%e,%e,%e\n' % (r, values[0], values[1], values[2], end0 - start0))
+
 # %% REPORT EXECUTION TIME
 if rank == 0:
     oldstdout = sys.stdout
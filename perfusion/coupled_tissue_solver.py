@@ -0,0 +1,181 @@
+"""
+Coupled perfusion - tissue health time loop
+
+The perfusion worker (mesh, function spaces, permeability forms and linear
+solver) and the dead/toxic states are kept in memory for the whole
+simulation. In each cycle of perfusion_timestep_hours:
+1; perfusion is computed with capillary permeability and coupling
+   coefficients scaled by the dead tissue fraction (feedback_limit);
+2; the cell death model (see ../tissue_health/cell_death_fcts.py) is advanced
+   cell by cell with the hypoxic fraction of the new perfusion field.
+Fields are exchanged in memory. Perfusion results and tissue states are only
+written at checkpoints (every checkpoint_every cycles and at the end) in the
+format used by infarct_estimate_treatment_FEM.py (feedback/infarct.xdmf,
+feedback/toxic.xdmf, feedback/time.txt), so that a simulation can be
+restarted from the last checkpoint by either code.
+
+From treatment_time_hours on, the treatment scenario (--treatment_scenario,
+YAML file mirroring the sections of the configuration file) is applied.
+
+Usage:
+mpirun -n #number_of_processors python3 coupled_tissue_solver.py --config_file config_coupled_flow_solver.yaml
+"""
+
+# IMPORT MODULES
+# installed python3 modules
+from dolfin import *
+import time
+import sys
+import os
+import argparse
+import yaml
+import numpy
+
+# added module
+import IO_fcts
+from perfusion_worker import PerfusionWorker, is_non_zero_file
+# cell death model of the tissue health module (module names of the perfusion folder take precedence)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tissue_health'))
+import cell_death_fcts
+
+# define MPI variables
+comm = MPI.comm_world
+rank = comm.Get_rank()
+
+start0 = time.time()
+
+# %% READ INPUT
+parser = argparse.ArgumentParser(description="coupled perfusion and tissue health simulation")
+parser.add_argument("--config_file", help="path to configuration file of the perfusion model",
+                    type=str, default='./config_coupled_flow_solver.yaml')
+parser.add_argument("--tissue_config_file", help="path to configuration file of the tissue health model",
+                    type=str, default='../tissue_health/config_tissue_damage.yaml')
+parser.add_argument("--treatment_scenario", help="YAML file with the settings changed by the treatment",
+                    type=str, default=None)
+parser.add_argument("--res_fldr", help="path to results folder (string ended with /)", type=str, default=None)
+args = parser.parse_args()
+
+configs = IO_fcts.basic_flow_config_reader_yml(args.config_file, parser)
+with open(args.tissue_config_file, "r") as configfile:
+    tissue_parameters = yaml.load(configfile, yaml.SafeLoader)['parameter']
+treatment = {}
+if args.treatment_scenario is not None:
+    with open(args.treatment_scenario, "r") as scenario_file:
+        treatment = yaml.load(scenario_file, yaml.SafeLoader)
+
+# perfusion is needed in memory for the tissue model
+if configs['output']['res_vars'] is None:
+    configs['output']['res_vars'] = {}
+configs['output']['res_vars']['perfusion'] = None
+
+# time parameters - hours
+simulation_time = configs['simulation']['simulation_time_hours']
+perfusion_dt = configs['simulation']['perfusion_timestep_hours']
+try:
+    treatment_time = configs['simulation']['treatment_time_hours']
+except KeyError:
+    treatment_time = simulation_time
+try:
+    checkpoint_every = configs['simulation']['checkpoint_every']
+except KeyError:
+    checkpoint_every = 1
+
+# tissue health model parameters (see infarct_estimate_treatment_FEM.py)
+ks1, ks2 = tissue_parameters['ks1'], tissue_parameters['ks2']
+kf, kt, kb = tissue_parameters['kf'], tissue_parameters['kt'], tissue_parameters['kb']
+perfusion_scale = tissue_parameters['perfusion_gm_wm']
+core_threshold = tissue_parameters['core_threshold']
+try:
+    tissue_rate_step = tissue_parameters['tissue_rate_step']
+except KeyError:
+    tissue_rate_step = 0.5
+
+
+def hypoxia_estimate(perfusion):
+    # hypoxic fraction as in infarct_estimate_treatment_FEM.py
+    return 1-1/(1+numpy.exp(-(ks1*perfusion+ks2))**2)
+
+
+# %% INITIALISE PERFUSION WORKER AND TISSUE STATE
+if rank == 0:
+    print('Step 1: Initialising the perfusion worker and the tissue state')
+worker = PerfusionWorker(configs)
+K2_space = worker.K2_space
+
+# white matter perfusion is scaled (DG0 dofs follow the local cells)
+scale = numpy.where(worker.subdomains.array() == 11, perfusion_scale, 1.0)
+cell_volumes = cell_death_fcts.comp_cell_volumes(worker.mesh)
+
+feedback_fldr = configs['output']['res_fldr'] + '../feedback/'
+time_file = feedback_fldr + 'time.txt'
+dead = Function(K2_space)
+toxic = Function(K2_space)
+current_time = 0.0
+if is_non_zero_file(time_file) and is_non_zero_file(feedback_fldr + 'infarct.xdmf'):
+    # restart from the last checkpoint
+    with open(time_file, "r") as f:
+        current_time = float(f.read().replace('\n', ''))
+    f_in = XDMFFile(feedback_fldr + 'infarct.xdmf')
+    f_in.read_checkpoint(dead, 'dead', 0)
+    f_in.close()
+    f_in = XDMFFile(feedback_fldr + 'toxic.xdmf')
+    f_in.read_checkpoint(toxic, 'toxic', 0)
+    f_in.close()
+    if rank == 0:
+        print('\t restarting from ' + str(current_time) + ' hours')
+dead_vec = dead.vector().get_local()
+toxic_vec = toxic.vector().get_local()
+
+
+def write_checkpoint(current_time):
+    dead.vector().set_local(dead_vec)
+    dead.vector().apply('insert')
+    toxic.vector().set_local(toxic_vec)
+    toxic.vector().apply('insert')
+    with XDMFFile(feedback_fldr + 'infarct.xdmf') as myfile:
+        myfile.write_checkpoint(dead, "dead", 0, XDMFFile.Encoding.HDF5, False)
+    with XDMFFile(feedback_fldr + 'toxic.xdmf') as myfile:
+        myfile.write_checkpoint(toxic, "toxic", 0, XDMFFile.Encoding.HDF5, False)
+    if rank == 0:
+        with open(time_file, "w") as f:
+            f.write(str(current_time))
+
+
+# %% TIME LOOP
+if rank == 0:
+    print('Step 2: Coupled perfusion and tissue health simulation')
+    if not os.path.exists(feedback_fldr):
+        os.makedirs(feedback_fldr)
+    if current_time == 0:
+        with open(feedback_fldr + 'coupled_cycles.csv', 'w') as f:
+            f.write('time [h],core volume [mL],perfusion time [s],tissue time [s]\n')
+comm.Barrier()
+
+n_cycles = int(round((simulation_time-current_time)/perfusion_dt))
+for cycle in range(n_cycles):
+    checkpoint = (cycle+1) % checkpoint_every == 0 or cycle == n_cycles-1
+
+    # perfusion with tissue feedback (results are only saved at checkpoints)
+    scenario = treatment if current_time >= treatment_time else {}
+    timings = worker.solve(scenario, dead_tissue=dead_vec, save_data=checkpoint)
+    perfusion_vec = worker.results['perfusion'].vector().get_local()*6000  # ml/100ml/min
+
+    # cell death model with the new hypoxic fraction
+    start1 = time.time()
+    dead_vec, toxic_vec = cell_death_fcts.integrate_cell_death(
+        dead_vec, toxic_vec, hypoxia_estimate(perfusion_vec*scale), perfusion_dt*3600,
+        kf, kt, kb, rate_step=tissue_rate_step)
+    current_time += perfusion_dt
+    core = MPI.sum(comm, cell_volumes[dead_vec >= core_threshold].sum())*1e-3  # mL
+    end1 = time.time()
+
+    if checkpoint:
+        write_checkpoint(current_time)
+    if rank == 0:
+        with open(feedback_fldr + 'coupled_cycles.csv', 'a') as f:
+            f.write('%e,%e,%e,%e\n' % (current_time, core, timings['total'], end1-start1))
+        print('\t ' + str(current_time) + ' hours, core volume ' + str(core) + ' mL')
+
+end0 = time.time()
+if rank == 0:
+    print('Simulation finished - Total execution time [s]; \t\t\t', end0 - start0)
@@ -2,6 +2,7 @@ from dolfin import *
 import numpy as np
 import time
 import suppl_fcts
+import IO_fcts
 
 #%%
 def mesh_reader(mesh_file):
@@ -143,6 +144,8 @@ def set_up_fe_solver2(mesh, subdomains, boundaries, V, v_1, v_2, v_3, \
         model_type = kwarg.get('model_type')
     else:
         model_type = 'acv'
+    # boundary data (see IO_fcts.boundary_data) used instead of the inlet boundary file
+    boundary_data = kwarg.get('boundary_data', None)
     
     comm = MPI.comm_world
     rank = comm.Get_rank()
@@ -161,7 +164,10 @@ def set_up_fe_solver2(mesh, subdomains, boundaries, V, v_1, v_2, v_3, \
         integrals_N = []
         # based on inlet boundary file
         if read_inlet_boundary == True:
-            BC_data = np.loadtxt(inlet_boundary_file,skiprows=1,delimiter=',')
+            if boundary_data is not None:
+                BC_data = IO_fcts.boundary_data_array(boundary_data)
+            else:
+                BC_data = np.loadtxt(inlet_boundary_file,skiprows=1,delimiter=',')
             if BC_data.ndim>1:
                 b1 = 1000 * BC_data[:,1]
                 boundary_labels = list(BC_data[:,0])
@@ -247,7 +253,10 @@ def set_up_fe_solver2(mesh, subdomains, boundaries, V, v_1, v_2, v_3, \
         integrals_N = []
         # based on inlet boundary file
         if read_inlet_boundary == True:
-            BC_data = np.loadtxt(inlet_boundary_file,skiprows=1,delimiter=',')
+            if boundary_data is not None:
+                BC_data = IO_fcts.boundary_data_array(boundary_data)
+            else:
+                BC_data = np.loadtxt(inlet_boundary_file,skiprows=1,delimiter=',')
             if BC_data.ndim>1:
                 b1 = 1000 * BC_data[:,1]
                 boundary_labels = list(BC_data[:,0])
@@ -325,6 +334,58 @@ def set_up_fe_solver2(mesh, subdomains, boundaries, V, v_1, v_2, v_3, \
     return LHS, RHS, sigma1, sigma2, sigma3, BCs
 
 
+#%%
+def set_up_fe_solver_const_bc(mesh, boundaries, V, v_1, v_2, v_3, \
+                              p, p_1, p_2, p_3, K1, K2, K3, beta12, beta23, \
+                              pa, pv, boundary_labels, **kwarg):
+    """
+    Variational problem of set_up_fe_solver2 with Dirichlet (pressure)
+    boundary conditions on the boundary_labels surface regions. The arterial
+    pressure of every region is a Constant (initialised to pa, returned in the
+    order of boundary_labels), so that new boundary pressures only require
+    assigning the Constants while forms and DirichletBC objects are reused.
+    """
+    model_type = kwarg.get('model_type', 'acv')
+    
+    # source terms are equal to zero
+    sigma1 = Constant(0.0)
+    sigma2 = Constant(0.0)
+    sigma3 = Constant(0.0)
+    
+    pressures = [Constant(pa) for label in boundary_labels]
+    BCs = []
+    if model_type == 'acv':
+        # set constant venous pressure
+        for label in boundary_labels:
+            BCs.append( DirichletBC(V.sub(2), Constant(pv), boundaries, int(label)) )
+        for label, pressure in zip(boundary_labels, pressures):
+            BCs.append( DirichletBC(V.sub(0), pressure, boundaries, int(label)) )
+        
+        # Define variational problem
+        LHS = \
+        inner(K1*grad(p_1), grad(v_1))*dx + beta12*(p_1-p_2)*v_1*dx \
+        + inner(K2*grad(p_2), grad(v_2))*dx + beta12*(p_2-p_1)*v_2*dx + beta23*(p_2-p_3)*v_2*dx \
+        + inner(K3*grad(p_3), grad(v_3))*dx + beta23*(p_3-p_2)*v_3*dx
+        
+        RHS = sigma1*v_1*dx + sigma2*v_2*dx + sigma3*v_3*dx
+    elif model_type == 'a':
+        # set constant venous pressure
+        p_venous =  Constant(pv)
+        for label, pressure in zip(boundary_labels, pressures):
+            BCs.append( DirichletBC(V, pressure, boundaries, int(label)) )
+        
+        # Define variational problem
+        beta_total = 1 / (1/beta12+1/beta23)
+        LHS = \
+        inner(K1*grad(p), grad(v_1))*dx + beta_total*p*v_1*dx
+        
+        RHS = sigma1*v_1*dx + beta_total*p_venous*v_1*dx
+    else:
+        raise Exception("unknown model type: " + model_type)
+    
+    return LHS, RHS, sigma1, sigma2, sigma3, BCs, pressures
+
+
 #%%s
 def solve_lin_sys(Vp,LHS,RHS,BCs,lin_solver,precond,rtol,mon_conv,init_sol,**kwarg):
     comm = MPI.comm_world
@@ -377,4 +438,81 @@ def solve_lin_sys(Vp,LHS,RHS,BCs,lin_solver,precond,rtol,mon_conv,init_sol,**kwa
     # sytanx for mesh refinement
     #new_mesh = refine(mesh)
     #File("new_mesh.pvd") << new_mesh
-    return p
\ No newline at end of file
+    return p
+
+#%%
+class LinSysSolver:
+    """
+    Krylov solver keeping the assembled operator and its preconditioner (e.g.
+    the AMG hierarchy) between solves. The operator is re-assembled only when
+    flagged by update_operator() or when the Dirichlet dofs change, otherwise
+    new right hand sides and Dirichlet values are solved using the previous
+    pressure field as initial guess.
+    """
+    def __init__(self, Vp, lin_solver, precond, rtol, mon_conv, warm_start=True, reuse_precond=False):
+        self.comm = MPI.comm_world
+        self.rank = self.comm.Get_rank()
+        
+        if precond != False:
+            self.solver = PETScKrylovSolver(lin_solver, precond)
+        else:
+            self.solver = PETScKrylovSolver(lin_solver)
+        prm = self.solver.parameters
+        if rtol != False:
+            prm['relative_tolerance'] = rtol
+        prm['monitor_convergence'] = mon_conv
+        prm['nonzero_initial_guess'] = warm_start
+        # keep the preconditioner even if the operator has been re-assembled
+        self.solver.set_reuse_preconditioner(reuse_precond)
+        
+        self.p = Function(Vp)
+        self.A = None
+        self.bc_key = None
+        self.operator_outdated = True
+        self.n_assembly = 0
+        self.n_solve = 0
+    
+    def update_operator(self):
+        # coefficients of the LHS (permeabilities, coupling coefficients) have changed
+        self.operator_outdated = True
+    
+    def reset_initial_guess(self):
+        self.p.vector().zero()
+    
+    def comp_bc_key(self, BCs):
+        # the operator depends on the Dirichlet dofs but not on the Dirichlet values
+        dofs = [np.sort(np.fromiter(bc.get_boundary_values().keys(), dtype=np.int64)) for bc in BCs]
+        return hash(b''.join(dof_array.tobytes() for dof_array in dofs))
+    
+    def solve(self, LHS, RHS, BCs, **kwarg):
+        start = time.time()
+        bc_key = self.comp_bc_key(BCs)
+        # every process has to take part in the re-assembly
+        reassemble = MPI.max(self.comm, int(self.operator_outdated or bc_key != self.bc_key))
+        if reassemble:
+            self.A = assemble(LHS)
+            for bc in BCs:
+                bc.apply(self.A)
+            self.solver.set_operator(self.A)
+            self.bc_key = bc_key
+            self.operator_outdated = False
+            self.n_assembly += 1
+        
+        b = assemble(RHS)
+        for bc in BCs:
+            bc.apply(b)
+        
+        try:
+            self.solver.solve(self.p.vector(), b)
+        except RuntimeError:
+            # do not start the next solve from a diverged solution
+            self.reset_initial_guess()
+            raise
+        self.n_solve += 1
+        end = time.time()
+        
+        if self.rank == 0:
+            if kwarg.get('timer', True) == True:
+                print ('\t\t pressure computation took', end - start, '[s]',
+                       '(operator assembled)' if reassemble else '(operator reused)')
+        return self.p.copy(deepcopy=True)
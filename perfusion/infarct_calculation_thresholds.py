@@ -116,9 +116,12 @@ f_in.close()
 
 if rank == 0:
     print('Step 3: Calculating change in perfusion and infarct volume')
-# calculate change in perfusion and infarct
-perfusion_change = project(((perfusion - perfusion_stroke) / perfusion) * -100, K2_space, solver_type='bicgstab',
-                           preconditioner_type='petsc_amg')
+# calculate change in perfusion and infarct (cell-wise, both fields are DG0)
+perfusion_change = Function(K2_space)
+with np.errstate(divide='ignore', invalid='ignore'):
+    perfusion_array = perfusion.vector().get_local()
+    perfusion_change.vector().set_local(
+        ((perfusion_array - perfusion_stroke.vector().get_local()) / perfusion_array) * -100)
 
 # thresholds = [-10, -20, -30, -40, -50, -60, -70, -80, -90, -100]
 thresholds = np.linspace(0, -100, args.thresholds)
@@ -131,14 +134,8 @@ if target not in thresholds:
     # [::-1] to reverse sort direction, maintain descending order
     thresholds = np.sort(np.append(thresholds, target))[::-1]
 
-vol_infarct_values_thresholds = np.empty((0, 4), float)
-
-for threshold in thresholds:
-    infarct = project(conditional(gt(perfusion_change, Constant(threshold)), Constant(0.0), Constant(1.0)), K2_space,
-                      solver_type='bicgstab', preconditioner_type='petsc_amg')
-    infarctvolume = suppl_fcts.infarct_vol(mesh, subdomains, infarct)
-    vol_infarct_values = np.concatenate((np.array([threshold, threshold, threshold])[:, np.newaxis], infarctvolume), axis=1)
-    vol_infarct_values_thresholds = np.append(vol_infarct_values_thresholds, vol_infarct_values, axis=0)
+# infarct volumes of all thresholds and regions from a single sweep over the cells
+vol_infarct_values_thresholds = suppl_fcts.infarct_vol_thresholds(mesh, subdomains, perfusion_change, thresholds)
 
 if rank == 0:
     fheader = 'threshold [%],volume ID,Volume [mm^3],infarct volume [mL]'
@@ -1,12 +1,13 @@
 #!/usr/bin/python3
 # -*- coding:utf-8 -*-
 """Usage:
-  script.py <config_file> <pressure> [--mpi=<mpi>]
+  script.py <config_file> <pressure> [--mpi=<mpi>] [--method=<method>]
   script.py (-h | --help)
 
 Options:
   -h --help     Show this screen.
   --mpi=<mpi>   activate MPI [default: False]
+  --method=<method>   optimisation method, e.g. Nelder-Mead or surrogate (default: from the config file)
 """
 
 from Blood_Flow_1D import GeneralFunctions, docopt
@@ -16,8 +17,9 @@ import os
 import pandas as pd
 
 # todo add calculation for white and grey matter volumes (only the ratio is used so this is not needed for uniform scaling)
-def generate_profiles(mpi=True):
+def generate_profiles(mpi=True, method=None):
     # Script to compute all parameters of the perfusion model for different surface pressures and target perfusion levels.
+    # With method='surrogate' the evaluations of the finite element model are cached and reused between calibrations.
     pressures = (10000, 9500, 9000, 8500, 8000, 7500, 7000, 6500, 6000)
     for pressure in pressures:
         # Assuming total CBF of 600mL/min
@@ -52,6 +54,8 @@ def generate_profiles(mpi=True):
         configs['optimisation']['FWtarget'] = F_wm
         configs['simulation']['fe_degr'] = 1
         configs['input']['read_inlet_boundary'] = False
+        if method is not None:
+            configs['optimisation']['method'] = method
         with open(ymlfile, 'w') as file:
             yaml.dump(configs, file)
 
@@ -62,7 +66,7 @@ def generate_profiles(mpi=True):
             os.system('python3 parameter_optimiser.py --config_file '+ymlfile)
 
         # load optim results
-        optim_results = configs['output']['res_fldr'] + "opt_res_Nelder-Mead.csv"
+        optim_results = configs['output']['res_fldr'] + "opt_res_" + configs['optimisation']['method'] + ".csv"
 
         data = pd.read_csv(optim_results)
         configs['physical']['gmowm_beta_rat'] = float(data["# gmowm_beta_rat"].iloc[-1])
@@ -76,7 +80,7 @@ def generate_profiles(mpi=True):
             yaml.dump(configs, file)
 
         src_dir = optim_results
-        dst_dir = configs['output']['res_fldr']+"opt_res"+str(P_a)+"_Nelder-Mead_Q.csv"
+        dst_dir = configs['output']['res_fldr']+"opt_res"+str(P_a)+"_"+configs['optimisation']['method']+"_Q.csv"
         shutil.copy(src_dir, dst_dir)
 
     for pressure in pressures:
@@ -113,6 +117,8 @@ def generate_profiles(mpi=True):
         configs['optimisation']['FWtarget'] = F_wm
         configs['simulation']['fe_degr'] = 1
         configs['input']['read_inlet_boundary'] = False
+        if method is not None:
+            configs['optimisation']['method'] = method
 
         with open(ymlfile, 'w') as file:
             yaml.dump(configs, file)
@@ -124,7 +130,7 @@ def generate_profiles(mpi=True):
             os.system('python3 parameter_optimiser.py --config_file '+ymlfile)
 
         # load optim results
-        optim_results = configs['output']['res_fldr'] + "opt_res_Nelder-Mead.csv"
+        optim_results = configs['output']['res_fldr'] + "opt_res_" + configs['optimisation']['method'] + ".csv"
 
         data = pd.read_csv(optim_results)
         configs['physical']['gmowm_beta_rat'] = float(data["# gmowm_beta_rat"].iloc[-1])
@@ -139,11 +145,11 @@ def generate_profiles(mpi=True):
             yaml.dump(configs, file)
 
         src_dir = optim_results
-        dst_dir = configs['output']['res_fldr']+"opt_res"+str(P_a)+"_Nelder-Mead_CBF.csv"
+        dst_dir = configs['output']['res_fldr']+"opt_res"+str(P_a)+"_"+configs['optimisation']['method']+"_CBF.csv"
         shutil.copy(src_dir, dst_dir)
 
 
-def update_profile(config_file, pressure, mpi=True):
+def update_profile(config_file, pressure, mpi=True, method=None):
     # assuming total CBF of 50 ml/min/100mL
     print("Patient")
     V_gm = 894  # mL
@@ -175,6 +181,8 @@ def update_profile(config_file, pressure, mpi=True):
     configs['optimisation']['FWtarget'] = F_wm
     configs['simulation']['fe_degr'] = 1
     configs['input']['read_inlet_boundary'] = False
+    if method is not None:
+        configs['optimisation']['method'] = method
 
     with open(ymlfile, 'w') as file:
         yaml.dump(configs, file)
@@ -186,7 +194,7 @@ def update_profile(config_file, pressure, mpi=True):
         os.system('python3 parameter_optimiser.py --config_file ' + ymlfile)
 
     # load optim results
-    optim_results = configs['output']['res_fldr'] + "opt_res_Nelder-Mead.csv"
+    optim_results = configs['output']['res_fldr'] + "opt_res_" + configs['optimisation']['method'] + ".csv"
 
     data = pd.read_csv(optim_results)
     configs['physical']['gmowm_beta_rat'] = float(data["# gmowm_beta_rat"].iloc[-1])
@@ -205,7 +213,8 @@ if __name__ == '__main__':
     config_file = arguments["<config_file>"]
     pressure = float(arguments["<pressure>"])
     mpi = eval(arguments["--mpi"])
+    method = arguments["--method"]
 
-    update_profile(config_file, pressure, mpi)
+    update_profile(config_file, pressure, mpi, method)
 
-    # generate_profiles(mpi)
+    # generate_profiles(mpi, method)
@@ -1,5 +1,28 @@
 def cost_function(param_values, configs, mesh, subdomains, boundaries, K2_space, K1form, K2form, K3form, p, p1, p2, p3,
                   iter_info, compartmental_model, save_fields):
+    # perfusion values of parameters evaluated before (this or a previous calibration) are taken from the cache
+    key = evaluation_key(param_values)
+    if key in evaluation_cache and save_fields == False:
+        Fmin, Fmax, FW, FG = evaluation_cache[key]
+        J = perfusion_cost(Fmin, Fmax, FW, FG, configs)
+    else:
+        Fmin, Fmax, FW, FG, J = fe_evaluation(param_values, configs, mesh, subdomains, boundaries, K2_space,
+                                              K1form, K2form, K3form, p, p1, p2, p3, compartmental_model, save_fields)
+
+    info = list(pow(10, numpy.asarray(param_values)))
+    info.append(Fmin)
+    info.append(Fmax)
+    info.append(FW)
+    info.append(FG)
+    info.append(J)
+    iter_info.append(info)
+    if (len(iter_info) - 2) % 1 == 0:
+        if rank == 0: print(len(iter_info) - 2, info)
+    return J
+
+
+def fe_evaluation(param_values, configs, mesh, subdomains, boundaries, K2_space, K1form, K2form, K3form, p, p1, p2, p3,
+                  compartmental_model, save_fields):
     for i in range(len(configs['optimisation']['parameters'])):
         if configs['optimisation']['parameters'][i] != 'beta_total_gm':
             configs['physical'][configs['optimisation']['parameters'][i]] = pow(10, param_values[i])
@@ -13,14 +36,14 @@ def cost_function(param_values, configs, mesh, subdomains, boundaries, K2_space,
                                                             configs['physical']['beta12gm'],
                                                             configs['physical']['beta23gm'],
                                                             configs['physical']['gmowm_beta_rat'],
-                                                            K2_space, configs['output']['res_fldr'])
+                                                            K2_space, configs['output']['res_fldr'],
+                                                            out=(beta12c, beta23c))
     configs['physical']['K3gm_ref'] = 2 * configs['physical']['K1gm_ref']
-    # set permeabilities
-    K1, K2, K3 = suppl_fcts.scale_permeabilities(subdomains, K1form.copy(deepcopy=True), K2form.copy(deepcopy=True),
-                                                 K3form.copy(deepcopy=True),
+    # set permeabilities (scaled copies of the forms are written into preallocated functions)
+    K1, K2, K3 = suppl_fcts.scale_permeabilities(subdomains, K1form, K2form, K3form,
                                                  configs['physical']['K1gm_ref'], configs['physical']['K2gm_ref'],
                                                  configs['physical']['K3gm_ref'], configs['physical']['gmowm_perm_rat'],
-                                                 configs['output']['res_fldr'])
+                                                 configs['output']['res_fldr'], out=(K1c, K2c, K3c))
 
     # set up finite element solver
     LHS, RHS, sigma1, sigma2, sigma3, BCs = \
@@ -30,10 +53,12 @@ def cost_function(param_values, configs, mesh, subdomains, boundaries, K2_space,
                                  configs['input']['read_inlet_boundary'], configs['input']['inlet_boundary_file'],
                                  configs['input']['inlet_BC_type'], model_type = compartmental_model)
 
-    lin_solver, precond, rtol, mon_conv, init_sol = 'bicgstab', 'petsc_amg', False, False, False
+    # permeabilities change between iterations: reassemble the operator but keep the Krylov solver
+    # and start from the pressure field of the previous iteration
+    lin_sys_solver.update_operator()
 
     try:
-        p = fe_mod.solve_lin_sys(Vp, LHS, RHS, BCs, lin_solver, precond, rtol, mon_conv, init_sol, timer=False)
+        p = lin_sys_solver.solve(LHS, RHS, BCs, timer=False)
 
         if compartmental_model == 'acv':
             p1, p2, p3 = p.split()
@@ -59,13 +84,12 @@ def cost_function(param_values, configs, mesh, subdomains, boundaries, K2_space,
         # check global minimum and maximum computation
         # print(Fmin,Fmin_loc,Fmax,Fmax_loc,rank)
 
-        J = 0
-        J = int(Fmin < configs['optimisation']['Fmintarget']) * pow(Fmin - configs['optimisation']['Fmintarget'], 2) \
-            + int(Fmax > configs['optimisation']['Fmaxtarget']) * pow(Fmax - configs['optimisation']['Fmaxtarget'], 2) \
-            + pow(FW - configs['optimisation']['FWtarget'], 2) + pow(FG - configs['optimisation']['FGtarget'], 2)
+        J = perfusion_cost(Fmin, Fmax, FW, FG, configs)
+        store_evaluation(param_values, [Fmin, Fmax, FW, FG])
 
     # TODO: fix so that if solver fails for initial guess then new guess is tried
     except RuntimeError:
+        Fmin, Fmax, FW, FG = numpy.nan, numpy.nan, numpy.nan, numpy.nan
         J = 1e15
 
     if save_fields == True:
@@ -95,18 +119,188 @@ def cost_function(param_values, configs, mesh, subdomains, boundaries, K2_space,
         vtkfile = File(wdir + "beta23.pvd")
         vtkfile << beta23
 
-    info = list(pow(10, param_values))
-    info.append(Fmin)
-    info.append(Fmax)
-    info.append(FW)
-    info.append(FG)
-    info.append(J)
-    iter_info.append(info)
-    if (len(iter_info) - 2) % 1 == 0:
-        if rank == 0: print(len(iter_info) - 2, info)
+    return Fmin, Fmax, FW, FG, J
+
+
+def perfusion_cost(Fmin, Fmax, FW, FG, configs):
+    # cost of the perfusion values (also for arrays, e.g. surrogate predictions)
+    J = (Fmin < configs['optimisation']['Fmintarget']) * pow(Fmin - configs['optimisation']['Fmintarget'], 2) \
+        + (Fmax > configs['optimisation']['Fmaxtarget']) * pow(Fmax - configs['optimisation']['Fmaxtarget'], 2) \
+        + pow(FW - configs['optimisation']['FWtarget'], 2) + pow(FG - configs['optimisation']['FGtarget'], 2)
     return J
 
 
+# %% CACHE OF FINITE ELEMENT EVALUATIONS
+# (log10) parameters -> Fmin, Fmax, FW, FG of every successful evaluation, the same on every process and appended
+# to a file named by the hash of the settings which determine the perfusion field (except the optimised parameters)
+evaluation_cache = {}
+cache_file = None
+
+
+def evaluation_key(param_values):
+    return tuple(numpy.round(numpy.asarray(param_values, dtype=float), 10))
+
+
+def settings_hash(configs, compartmental_model):
+    physical = dict(configs['physical'])
+    # K3gm_ref follows K1gm_ref, only the ratio of beta12gm and beta23gm matters if beta_total_gm is optimised
+    for name in configs['optimisation']['parameters'] + ['K3gm_ref']:
+        physical.pop(name, None)
+    if 'beta_total_gm' in configs['optimisation']['parameters']:
+        physical['beta12gm/beta23gm'] = physical.pop('beta12gm') / physical.pop('beta23gm')
+    settings = {'input': configs['input'], 'physical': physical, 'fe_degr': configs['simulation']['fe_degr'],
+                'model_type': compartmental_model, 'parameters': configs['optimisation']['parameters']}
+    my_hash = hashlib.sha1(yaml.dump(settings).encode())
+    if configs['input']['read_inlet_boundary'] and os.path.isfile(configs['input']['inlet_boundary_file']):
+        with open(configs['input']['inlet_boundary_file'], 'rb') as f:
+            my_hash.update(f.read())
+    return my_hash.hexdigest()[:16]
+
+
+def load_evaluation_cache(file_name, n_params):
+    global cache_file
+    cache_file = file_name
+    cache_data = None
+    if rank == 0 and os.path.isfile(file_name):
+        cache_data = numpy.loadtxt(file_name, delimiter=',', ndmin=2)
+    cache_data = comm.bcast(cache_data, root=0)
+    if cache_data is not None:
+        for row in cache_data:
+            evaluation_cache[evaluation_key(row[:n_params])] = list(row[n_params:])
+
+
+def store_evaluation(param_values, values):
+    evaluation_cache[evaluation_key(param_values)] = list(values)
+    if rank == 0 and cache_file is not None:
+        with open(cache_file, 'a') as f:
+            f.write(','.join(['%.16e' % value for value in list(param_values) + list(values)]) + '\n')
+
+
+# %% SURROGATE OPTIMISATION
+def quadratic_basis(X):
+    # constant, linear and quadratic terms of the rows of X
+    X = numpy.atleast_2d(X)
+    n = X.shape[1]
+    columns = [numpy.ones(len(X))] + [X[:, i] for i in range(n)] \
+        + [X[:, i] * X[:, j] for i in range(n) for j in range(i, n)]
+    return numpy.column_stack(columns)
+
+
+def fit_response_surface(X, Y, centre, scale):
+    """
+    Least squares quadratic response surfaces of the columns of Y (Fmin, Fmax,
+    FW, FG) in the log-parameters X (shifted by centre and scaled by scale).
+    Positive outputs are fitted in log scale. Returns the predictor.
+    """
+    positive = numpy.all(Y > 0, axis=0)
+    Y_fit = numpy.where(positive, numpy.log(numpy.where(Y > 0, Y, 1)), Y)
+    coefficients = numpy.linalg.lstsq(quadratic_basis((X - centre) / scale), Y_fit, rcond=None)[0]
+
+    def predict(x):
+        values = quadratic_basis((numpy.atleast_2d(x) - centre) / scale).dot(coefficients)
+        return numpy.where(positive, numpy.exp(values), values)
+    return predict
+
+
+def latin_hypercube(n_samples, bounds, rng):
+    # one sample in each of the n_samples intervals of every parameter range
+    n = len(bounds)
+    u = (numpy.argsort(rng.random((n_samples, n)), axis=0) + rng.random((n_samples, n))) / n_samples
+    return bounds[:, 0] + u * (bounds[:, 1] - bounds[:, 0])
+
+
+def surrogate_candidate(X, Y, x_best, radius, bounds, n_local, configs):
+    # minimum of the surrogate cost in the trust region around x_best (fitted to the closest evaluations)
+    distance = numpy.max(numpy.abs(X - x_best) / radius, axis=1)
+    local = numpy.argsort(distance)[:max(n_local, numpy.sum(distance <= 2))]
+    predict = fit_response_surface(X[local], Y[local], x_best, radius)
+    region = list(zip(numpy.maximum(x_best - radius, bounds[:, 0]), numpy.minimum(x_best + radius, bounds[:, 1])))
+
+    def surrogate_cost(x):
+        Fmin, Fmax, FW, FG = predict(x)[0]
+        return perfusion_cost(Fmin, Fmax, FW, FG, configs)
+
+    starts = [x_best] + [numpy.clip(X[i], [r[0] for r in region], [r[1] for r in region]) for i in local[1:len(x_best) + 1]]
+    results = [minimize(surrogate_cost, x0, method='L-BFGS-B', bounds=region) for x0 in starts]
+    return min(results, key=lambda r: r.fun).x
+
+
+def surrogate_minimise(initial_values, bounds, cost_args, n_design, max_fev, xtol, seed):
+    """
+    Minimisation of the cost function with quadratic response surfaces of the
+    perfusion values in log-parameter space. Cached evaluations within the
+    bounds are completed to n_design points by a latin hypercube design (the
+    first point is initial_values). Then the surrogate is minimised in a trust
+    region around the best evaluation and its minimum is evaluated with the FE
+    model (at most max_fev times). The trust region grows after improvements
+    and shrinks otherwise until it is smaller than xtol (relative to bounds).
+    The bounds are hard, so a minimum on a bound is not reported as success.
+    """
+    # the perfusion targets are taken from the configs of the cost function arguments
+    configs = cost_args[0]
+    n = len(initial_values)
+    n_local = (n + 1) * (n + 2)
+    width = bounds[:, 1] - bounds[:, 0]
+
+    def evaluated_points():
+        X = numpy.array(list(evaluation_cache.keys()), dtype=float).reshape(-1, n)
+        Y = numpy.array(list(evaluation_cache.values()), dtype=float).reshape(-1, 4)
+        inside = numpy.all((X >= bounds[:, 0] - 1e-10) & (X <= bounds[:, 1] + 1e-10), axis=1)
+        X, Y = X[inside], Y[inside]
+        return X, Y, perfusion_cost(Y[:, 0], Y[:, 1], Y[:, 2], Y[:, 3], configs)
+
+    X, Y, J = evaluated_points()
+    n_new = max(n_design - len(X), 0)
+    design = None
+    if rank == 0 and n_new > 0:
+        design = latin_hypercube(n_new, bounds, numpy.random.default_rng(seed))
+        design[0] = numpy.clip(initial_values, bounds[:, 0], bounds[:, 1])
+    design = comm.bcast(design, root=0)
+    if rank == 0:
+        print('\t surrogate design:', len(X), 'cached and', n_new, 'new evaluations')
+    for x in ([] if design is None else design):
+        cost_function(x, *cost_args)
+
+    X, Y, J = evaluated_points()
+    if len(X) == 0:
+        raise Exception("no successful evaluation within the parameter range")
+    x_best, J_best = X[numpy.argmin(J)], J.min()
+    radius = 0.25 * width
+    n_fev = 0
+    while n_fev < max_fev and numpy.max(radius / width) > xtol:
+        candidate = None
+        if rank == 0:
+            candidate = surrogate_candidate(X, Y, x_best, radius, bounds, n_local, configs)
+        candidate = comm.bcast(candidate, root=0)
+        # the surrogate minimum is an evaluated point: refine the trust region
+        if numpy.min(numpy.max(numpy.abs(X - candidate) / width, axis=1)) <= xtol:
+            radius = radius / 2
+            continue
+
+        J_new = cost_function(candidate, *cost_args)
+        n_fev += 1
+        if J_new < J_best:
+            x_best, J_best = candidate, J_new
+            radius = numpy.minimum(2 * radius, 0.5 * width)
+        else:
+            radius = radius / 2
+        X, Y, J = evaluated_points()
+
+    converged = bool(numpy.max(radius / width) <= xtol)
+    # the optimum may lie outside the bounds if the best point is on one of them
+    on_bound = bool(numpy.any(numpy.minimum(x_best - bounds[:, 0], bounds[:, 1] - x_best) / width <= xtol))
+    if not converged:
+        message = 'maximum number of evaluations reached'
+    elif on_bound:
+        message = 'minimum on the bound of init_param_range, the optimum may lie outside the range'
+    else:
+        message = 'trust region smaller than xtol'
+    if rank == 0 and on_bound:
+        print('\t WARNING: surrogate ' + message)
+    return OptimizeResult(x=x_best, fun=J_best, nfev=n_new + n_fev,
+                          success=converged and not on_bound, message=message)
+
+
 """
 Multi-compartment Darcy flow model with mixed Dirichlet and Neumann
 boundary conditions
@@ -129,7 +323,10 @@ import numpy
 # %% IMPORT MODULES
 # installed python3 modules
 from dolfin import *
-from scipy.optimize import minimize
+from scipy.optimize import minimize, OptimizeResult
+import hashlib
+import os
+import yaml
 
 numpy.set_printoptions(linewidth=200)
 
@@ -187,10 +384,17 @@ Vp, Vvel, v_1, v_2, v_3, p, p1, p2, p3, K1_space, K2_space = \
     fe_mod.alloc_fct_spaces(mesh, configs['simulation']['fe_degr'], \
                             model_type = compartmental_model, vel_order = velocity_order)
 
+# linear solver reused by every cost function evaluation
+lin_sys_solver = fe_mod.LinSysSolver(Vp, 'bicgstab', 'petsc_amg', False, False)
+
 # initialise permeability tensors
 K1form, K2form, K3form = IO_fcts.initialise_permeabilities(K1_space, K2_space, mesh,
                                                            configs['input']['permeability_folder'])
 
+# preallocated permeabilities and coupling coefficients overwritten by every cost function evaluation
+K1c, K2c, K3c = Function(K1_space), Function(K2_space), Function(K1_space)
+beta12c, beta23c = Function(K2_space), Function(K2_space)
+
 if 'beta_total_gm' in set(configs['optimisation']['parameters']):
     if 'beta_total_gm' in configs['physical']:
         beta_gm_rat = configs['physical']['beta12gm']/configs['physical']['beta23gm']
@@ -210,6 +414,24 @@ param_values = numpy.log10(numpy.array(param_values))
 iter_info = []
 save_fields = False
 
+# settings of the surrogate optimisation (method: surrogate) and folder of the evaluation cache
+n_params = len(param_values)
+surrogate_settings = {'surrogate_design': (n_params + 1) * (n_params + 2), 'surrogate_maxfev': 30,
+                      'surrogate_xtol': 1e-3, 'surrogate_seed': None, 'cache_folder': configs['output']['res_fldr']}
+for key in surrogate_settings:
+    try:
+        surrogate_settings[key] = configs['optimisation'][key]
+    except KeyError:
+        pass
+
+# evaluations of previous calibrations with the same settings are reused
+if rank == 0 and not os.path.exists(surrogate_settings['cache_folder']):
+    os.makedirs(surrogate_settings['cache_folder'])
+load_evaluation_cache(surrogate_settings['cache_folder'] + 'opt_cache_' + settings_hash(configs, compartmental_model)
+                      + '.csv', n_params)
+if rank == 0:
+    print('\t', len(evaluation_cache), 'cached evaluations')
+
 # Test cost function evaluation
 start = time.time()
 cost_function(param_values, configs, mesh, subdomains, boundaries, K2_space, K1form, K2form, K3form, p, p1, p2, p3,
@@ -232,11 +454,21 @@ if configs['optimisation']['random_init'] == True:
 comm.Bcast(initial_values, root=0)
 
 start = time.time()
-res = minimize(cost_function, param_values,
-               args=(configs, mesh, subdomains, boundaries, K2_space, K1form, K2form, K3form, p, p1, p2, p3, iter_info,
-                     compartmental_model, False),
-               method=configs['optimisation']['method'], bounds=param_bounds,
-               options={'disp': True, 'maxfev': 1000, 'maxiter': len(param_values) * 800})
+cost_args = (configs, mesh, subdomains, boundaries, K2_space, K1form, K2form, K3form, p, p1, p2, p3, iter_info,
+             compartmental_model, False)
+if configs['optimisation']['method'] == 'surrogate':
+    # log-parameter range of the design
+    surrogate_bounds = numpy.sort(numpy.log10(numpy.array(configs['optimisation']['init_param_range'], dtype=float)),
+                                  axis=1)
+    res = surrogate_minimise(initial_values, surrogate_bounds, cost_args, surrogate_settings['surrogate_design'],
+                             surrogate_settings['surrogate_maxfev'], surrogate_settings['surrogate_xtol'],
+                             surrogate_settings['surrogate_seed'])
+    # the last row of the results is the optimum (cached evaluation)
+    cost_function(res.x, *cost_args)
+else:
+    res = minimize(cost_function, param_values, args=cost_args,
+                   method=configs['optimisation']['method'], bounds=param_bounds,
+                   options={'disp': True, 'maxfev': 1000, 'maxiter': len(param_values) * 800})
 print('\n\n', res.x, '\n', rank)
 
 end = time.time()
@@ -0,0 +1,340 @@
+"""
+Persistent perfusion worker
+
+The worker wraps the steps of basic_flow_solver.py in a long-lived object so
+that the mesh, the function spaces and the permeability tensor forms (K1_form)
+are read only once. Scenarios (boundary condition files, physical parameters,
+result folders) are then solved one after the other in the same process, so
+that baseline, occluded and treated scenarios of a patient only pay for the
+linear solve and the post-processing.
+
+Scenarios can be passed in two ways:
+1; as a list in a YAML file (--scenarios), solved sequentially;
+2; through a local socket (--port), served until a 'stop' message is received.
+
+A scenario is a dictionary mirroring the sections of the configuration file,
+e.g. {'input': {'inlet_boundary_file': 'BCs.csv'}, 'output': {'res_fldr': 'occluded/'}}
+
+Usage (serving scenarios through a socket):
+mpirun -n #number_of_processors python3 perfusion_worker.py --config_file config_basic_flow_solver.yaml --port 6000
+
+@author: Tamas Istvan Jozsa
+"""
+
+# IMPORT MODULES
+# installed python3 modules
+from dolfin import *
+import time
+import sys
+import os
+import copy
+import argparse
+import yaml
+from multiprocessing.connection import Listener, Client
+
+# ghost mode options: 'none', 'shared_facet', 'shared_vertex'
+parameters['ghost_mode'] = 'none'
+
+# added module
+import IO_fcts
+import suppl_fcts
+import finite_element_fcts as fe_mod
+import worker_key
+
+# solver runs is "silent" mode
+set_log_level(50)
+
+
+#%%
+def merge_configs(configs, scenario):
+    # nested update of a configuration dictionary with the entries of a scenario
+    merged = copy.deepcopy(configs)
+    for key, value in scenario.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_configs(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+#%%
+def is_non_zero_file(fpath):
+    """
+    Return 1 if file exists and has data.
+    :param fpath: path to file
+    :return: boolean
+    """
+    return os.path.isfile(fpath) and os.path.getsize(fpath) > 0
+
+
+#%%
+class PerfusionWorker:
+    """
+    Multi-compartment Darcy flow solver keeping the mesh, function spaces and
+    permeability tensor forms resident between scenarios.
+    """
+    def __init__(self, configs):
+        self.comm = MPI.comm_world
+        self.rank = self.comm.Get_rank()
+        self.configs = configs
+        self.mesh_file = None
+        self.permeability_folder = None
+        self.load_mesh(configs)
+
+    def load_mesh(self, configs):
+        # (re-)read mesh and permeability forms only if the patient has changed
+        mesh_file = configs['input']['mesh_file']
+        permeability_folder = configs['input']['permeability_folder']
+        try:
+            model_type = configs['simulation']['model_type'].lower().strip()
+        except KeyError:
+            model_type = 'acv'
+        try:
+            velocity_order = configs['simulation']['vel_order']
+        except KeyError:
+            velocity_order = configs['simulation']['fe_degr'] - 1
+        fe_setup = (mesh_file, model_type, configs['simulation']['fe_degr'], velocity_order)
+
+        if self.mesh_file is not None and fe_setup == self.fe_setup \
+                and permeability_folder == self.permeability_folder:
+            return False
+
+        if fe_setup != getattr(self, 'fe_setup', None):
+            if self.rank == 0:
+                print('\t Reading mesh and allocating function spaces')
+            self.mesh, self.subdomains, self.boundaries = IO_fcts.mesh_reader(mesh_file)
+            self.compartmental_model = model_type
+            self.Vp, self.Vvel, self.v_1, self.v_2, self.v_3, self.p, self.p1, self.p2, self.p3, \
+                self.K1_space, self.K2_space = \
+                fe_mod.alloc_fct_spaces(self.mesh, configs['simulation']['fe_degr'],
+                                        model_type=model_type, vel_order=velocity_order)
+            self.fe_setup = fe_setup
+            self.mesh_file = mesh_file
+            self.pressure_solver = fe_mod.LinSysSolver(self.Vp, 'bicgstab', 'petsc_amg', False, False)
+            # scaled parameters are written into the same functions for every scenario
+            self.K1, self.K2, self.K3 = Function(self.K1_space), Function(self.K2_space), Function(self.K1_space)
+            self.beta12, self.beta23 = Function(self.K2_space), Function(self.K2_space)
+            self.parameter_key = None
+
+        if self.rank == 0:
+            print('\t Reading permeability tensor forms')
+        self.K1form, self.K2form, self.K3form = \
+            IO_fcts.initialise_permeabilities(self.K1_space, self.K2_space, self.mesh,
+                                              permeability_folder, model_type=self.compartmental_model)
+        self.permeability_folder = permeability_folder
+        self.parameter_key = None
+        return True
+
+    def scale_parameters(self, configs):
+        # permeabilities and coupling coefficients based on the unscaled forms
+        physical = configs['physical']
+        suppl_fcts.scale_coupling_coefficients(self.subdomains, physical['beta12gm'], physical['beta23gm'],
+                                               physical['gmowm_beta_rat'], self.K2_space,
+                                               configs['output']['res_fldr'],
+                                               model_type=self.compartmental_model,
+                                               out=(self.beta12, self.beta23))
+        suppl_fcts.scale_permeabilities(self.subdomains, self.K1form, self.K2form, self.K3form,
+                                        physical['K1gm_ref'], physical['K2gm_ref'], physical['K3gm_ref'],
+                                        physical['gmowm_perm_rat'], configs['output']['res_fldr'],
+                                        model_type=self.compartmental_model, out=(self.K1, self.K2, self.K3))
+
+    def apply_tissue_feedback(self, configs, dead_tissue=None, save_data=True):
+        """
+        Scale capillary permeability and coupling coefficients based on dead tissue fraction.
+        The dead fraction (local DG0 values) can be passed in memory, otherwise it is read
+        from the feedback folder if available.
+        """
+        if dead_tissue is None:
+            tissue_health_file = configs['output']['res_fldr'] + '../feedback/infarct.xdmf'
+            if not is_non_zero_file(tissue_health_file):
+                return
+            dead_fct = Function(self.K2_space)
+            f_in = XDMFFile(tissue_health_file)
+            f_in.read_checkpoint(dead_fct, 'dead', 0)
+            f_in.close()
+            dead_tissue = dead_fct.vector().get_local()
+
+        lower_limit = configs['simulation']['feedback_limit']
+        scaling = (1-dead_tissue)*(1-lower_limit)+lower_limit
+        for myfct in [self.K2, self.beta12, self.beta23]:
+            myfct.vector().set_local(myfct.vector().get_local()*scaling)
+            myfct.vector().apply('insert')
+
+        if save_data:
+            with XDMFFile(configs['output']['res_fldr'] + 'K2_scaled.xdmf') as myfile:
+                myfile.write_checkpoint(self.K2, "K2_scaled", 0, XDMFFile.Encoding.HDF5, False)
+            with XDMFFile(configs['output']['res_fldr'] + 'beta12_scaled.xdmf') as myfile:
+                myfile.write_checkpoint(self.beta12, "K2_scaled", 0, XDMFFile.Encoding.HDF5, False)
+            with XDMFFile(configs['output']['res_fldr'] + 'beta23_scaled.xdmf') as myfile:
+                myfile.write_checkpoint(self.beta23, "K2_scaled", 0, XDMFFile.Encoding.HDF5, False)
+
+    def solve(self, scenario=None, dead_tissue=None, save_data=True):
+        """
+        Solve a scenario. The dead tissue fraction (local DG0 values) can be passed in
+        memory, and without save_data no result files are written. The fields of the
+        last solution are kept in self.results.
+        """
+        start0 = time.time()
+        configs = merge_configs(self.configs, scenario or {})
+        # output folder errors of rank 0 are raised on every rank (instead of a barrier waiting forever)
+        folder_error = None
+        if self.rank == 0:
+            try:
+                if not os.path.exists(configs['output']['res_fldr']):
+                    os.makedirs(configs['output']['res_fldr'])
+                with open(configs['output']['res_fldr'] + 'settings.yaml', 'w') as outfile:
+                    yaml.dump(configs, outfile, default_flow_style=False)
+            except OSError as err:
+                folder_error = repr(err)
+        folder_error = self.comm.bcast(folder_error, root=0)
+        if folder_error is not None:
+            raise Exception("cannot write results folder: " + folder_error)
+
+        # Step 1: reuse mesh, function spaces and permeability forms
+        start1 = time.time()
+        self.load_mesh(configs)
+        self.scale_parameters(configs)
+        self.apply_tissue_feedback(configs, dead_tissue=dead_tissue, save_data=save_data)
+        # the operator is reassembled only if permeabilities or coupling coefficients have changed
+        feedback_file = configs['output']['res_fldr'] + '../feedback/infarct.xdmf'
+        parameter_key = (yaml.dump(configs['physical']), configs['simulation'].get('feedback_limit'),
+                         os.path.getmtime(feedback_file) if is_non_zero_file(feedback_file) else None)
+        if parameter_key != self.parameter_key or dead_tissue is not None:
+            self.pressure_solver.update_operator()
+            self.parameter_key = parameter_key
+        end1 = time.time()
+
+        # Step 2: set up boundary conditions and solve governing equations
+        start2 = time.time()
+        LHS, RHS, sigma1, sigma2, sigma3, BCs = \
+            fe_mod.set_up_fe_solver2(self.mesh, self.subdomains, self.boundaries, self.Vp,
+                                     self.v_1, self.v_2, self.v_3, self.p, self.p1, self.p2, self.p3,
+                                     self.K1, self.K2, self.K3, self.beta12, self.beta23,
+                                     configs['physical']['p_arterial'], configs['physical']['p_venous'],
+                                     configs['input']['read_inlet_boundary'],
+                                     configs['input']['inlet_boundary_file'],
+                                     configs['input']['inlet_BC_type'],
+                                     model_type=self.compartmental_model)
+
+        p = self.pressure_solver.solve(LHS, RHS, BCs)
+        end2 = time.time()
+
+        # Step 3: compute velocity fields, save solution, extract field variables
+        start3 = time.time()
+        myResults = {}
+        suppl_fcts.compute_my_variables(p, self.K1, self.K2, self.K3, self.beta12, self.beta23,
+                                        configs['physical']['p_venous'], self.Vp, self.Vvel, self.K2_space,
+                                        configs, myResults, self.compartmental_model, self.rank,
+                                        save_data=save_data)
+        my_integr_vars = {}
+        suppl_fcts.compute_integral_quantities(configs, myResults, my_integr_vars,
+                                               self.mesh, self.subdomains, self.boundaries, self.rank,
+                                               save_data=save_data)
+        self.results = myResults
+        end3 = time.time()
+        end0 = time.time()
+
+        timings = {'total': end0 - start0, 'step1': end1 - start1,
+                   'step2': end2 - start2, 'step3': end3 - start3}
+        if self.rank == 0 and save_data:
+            with open(configs['output']['res_fldr'] + "time_info.log", 'w') as logfile:
+                logfile.write('Total execution time [s]; \t\t\t' + str(timings['total']) + '\n')
+                logfile.write('Step 1: Reading input files [s]; \t\t' + str(timings['step1']) + '\n')
+                logfile.write('Step 2: Solving governing equations [s]; \t\t' + str(timings['step2']) + '\n')
+                logfile.write('Step 3: Preparing and saving output [s]; \t\t' + str(timings['step3']) + '\n')
+        if self.rank == 0:
+            print('\t scenario finished in', timings['total'], '[s] (' + configs['output']['res_fldr'] + ')')
+        return timings
+
+    def reset_state(self):
+        # after a failed scenario, forms and operator are set up again and the solve starts from zero
+        self.permeability_folder = None
+        self.parameter_key = None
+        self.pressure_solver.update_operator()
+        self.pressure_solver.reset_initial_guess()
+
+    def serve(self, port):
+        # rank 0 receives scenarios through a local socket, every rank solves them
+        # (clients authenticate with the random key of the key file, see worker_key.py)
+        listener = None
+        if self.rank == 0:
+            listener = Listener(('localhost', port), authkey=worker_key.create_worker_key(port))
+            print('Perfusion worker listening on port', port)
+            sys.stdout.flush()
+        running = True
+        while running:
+            conn = listener.accept() if self.rank == 0 else None
+            connected = True
+            while connected:
+                message = None
+                if self.rank == 0:
+                    try:
+                        message = conn.recv()
+                    except EOFError:
+                        message = 'disconnect'
+                message = self.comm.bcast(message, root=0)
+                if message in ['disconnect', 'stop']:
+                    connected = False
+                    running = message != 'stop'
+                    continue
+                error = None
+                try:
+                    reply = {'status': 'done', 'timings': self.solve(message)}
+                except Exception as err:
+                    error = repr(err)
+                # every rank has to agree on the status (a scenario may fail on some ranks only)
+                errors = self.comm.gather(error, root=0)
+                if MPI.max(self.comm, int(error is not None)):
+                    self.reset_state()
+                    if self.rank == 0:
+                        reply = {'status': 'failed',
+                                 'error': '; '.join('rank ' + str(r) + ': ' + e
+                                                    for r, e in enumerate(errors) if e is not None)}
+                if self.rank == 0:
+                    conn.send(reply)
+            if self.rank == 0:
+                conn.close()
+        if self.rank == 0:
+            listener.close()
+            worker_key.remove_worker_key(port)
+
+
+#%%
+def submit_scenarios(scenarios, port, stop=False):
+    # send scenarios to a running worker and wait for each of them to finish
+    replies = []
+    with Client(('localhost', port), authkey=worker_key.read_worker_key(port)) as conn:
+        for scenario in scenarios:
+            conn.send(scenario)
+            reply = conn.recv()
+            if reply['status'] != 'done':
+                raise Exception("perfusion worker failed: " + reply['error'])
+            replies.append(reply)
+        if stop:
+            conn.send('stop')
+    return replies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="persistent perfusion solver handling multiple scenarios")
+    parser.add_argument("--config_file", help="path to configuration file",
+                        type=str, default='./config_basic_flow_solver.yaml')
+    parser.add_argument("--res_fldr", help="path to results folder (string ended with /)", type=str, default=None)
+    parser.add_argument("--scenarios", help="YAML file listing scenarios to be solved sequentially",
+                        type=str, default=None)
+    parser.add_argument("--port", help="port of the local socket receiving scenarios",
+                        type=int, default=None)
+    args = parser.parse_args()
+
+    configs = IO_fcts.basic_flow_config_reader_yml(args.config_file, parser)
+    worker = PerfusionWorker(configs)
+
+    if args.scenarios is not None:
+        with open(args.scenarios, "r") as scenario_file:
+            scenarios = yaml.load(scenario_file, yaml.SafeLoader)
+        for scenario in scenarios:
+            worker.solve(scenario)
+    elif args.port is not None:
+        worker.serve(args.port)
+    else:
+        worker.solve()
@@ -0,0 +1,227 @@
+"""
+Resampling of finite element fields on regular voxel grids
+
+Voxel centres are located in the tetrahedral mesh in one batched pass: each
+cell is paired with the voxel centres inside its bounding box and the pairs
+are tested with barycentric coordinates computed from the inverse affine map
+of the cells. The resulting voxel-to-cell map (voxel index, cell index,
+barycentric coordinates) depends only on the mesh and the voxel size, so it
+is stored next to the mesh file and reused for every variable and scenario
+of the same patient.
+
+Fields are evaluated from the map without point location:
+- degree 0 (DG0) fields by gathering cell values;
+- degree 1 and 2 Lagrange fields using barycentric weights;
+- other elements by pointwise evaluation of the mapped voxels.
+Scalar, vector and tensor valued functions are supported.
+
+@author: Tamas Istvan Jozsa
+"""
+
+from dolfin import *
+import numpy as np
+import os
+
+
+#%%
+def image_grid(mesh, vxl_size):
+    """
+    Voxel centre coordinates along the axes of the image enclosing the mesh
+    (same grid as the original point-by-point conversion).
+    """
+    comm = MPI.comm_world
+    # bounding box of the whole (possibly distributed) mesh
+    coord_min = np.min(comm.allgather(np.min(mesh.coordinates(), axis=0)), axis=0)
+    coord_max = np.max(comm.allgather(np.max(mesh.coordinates(), axis=0)), axis=0)
+
+    img_coord_min = np.int32(np.floor(coord_min))-1
+    img_coord_max = np.int32(np.ceil(coord_max))+vxl_size
+
+    x = np.arange(img_coord_min[0], img_coord_max[0], vxl_size)
+    y = np.arange(img_coord_min[1], img_coord_max[1], vxl_size)
+    z = np.arange(img_coord_min[2], img_coord_max[2], vxl_size)
+    return x, y, z, img_coord_min
+
+
+#%%
+def comp_voxel_cell_map(mesh, x, y, z, **kwarg):
+    """
+    Locate the voxel centres of the grid (x,y,z) in the local cells of the mesh.
+    Returns the flat (C order) indices of the voxels inside the mesh, the
+    containing cells and the barycentric coordinates (shape (n,4)).
+    """
+    tol = kwarg.get('tol', 1e-8)
+    chunk_size = kwarg.get('chunk_size', 200000)
+
+    origin = np.array([x[0], y[0], z[0]], dtype=float)
+    vxl_size = np.array([x[1]-x[0] if len(x) > 1 else 1,
+                         y[1]-y[0] if len(y) > 1 else 1,
+                         z[1]-z[0] if len(z) > 1 else 1], dtype=float)
+    shape = np.array([len(x), len(y), len(z)])
+
+    coords = mesh.coordinates()
+    cells = mesh.cells()
+
+    vox_idx, cell_idx, bary = [], [], []
+    for c0 in range(0, len(cells), chunk_size):
+        chunk = np.arange(c0, min(c0+chunk_size, len(cells)))
+        X = coords[cells[chunk]] # (n,4,3) vertex coordinates
+
+        # range of voxel indices inside the bounding box of each cell
+        i_min = np.maximum(np.ceil((X.min(axis=1)-origin)/vxl_size-tol), 0).astype(np.int64)
+        i_max = np.minimum(np.floor((X.max(axis=1)-origin)/vxl_size+tol), shape-1).astype(np.int64)
+        n_ijk = np.maximum(i_max-i_min+1, 0)
+        counts = n_ijk.prod(axis=1)
+        if counts.sum() == 0:
+            continue
+
+        # candidate (cell, voxel) pairs
+        pair_cell = np.repeat(np.arange(len(chunk)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)
+        n_jk = n_ijk[pair_cell, 1]*n_ijk[pair_cell, 2]
+        ijk = i_min[pair_cell] + np.stack([local//n_jk,
+                                           (local//n_ijk[pair_cell, 2]) % n_ijk[pair_cell, 1],
+                                           local % n_ijk[pair_cell, 2]], axis=1)
+        points = origin + ijk*vxl_size
+
+        # barycentric coordinates from the inverse affine map of the cells
+        M = np.transpose(X[:, 1:, :]-X[:, :1, :], (0, 2, 1))
+        M_inv = np.linalg.inv(M)
+        lam = np.einsum('nij,nj->ni', M_inv[pair_cell], points-X[pair_cell, 0, :])
+        lam = np.concatenate([1-lam.sum(axis=1, keepdims=True), lam], axis=1)
+
+        inside = np.all(lam >= -tol, axis=1)
+        vox_idx.append(np.ravel_multi_index(ijk[inside].T, shape))
+        cell_idx.append(chunk[pair_cell[inside]])
+        bary.append(lam[inside])
+
+    if len(vox_idx) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 4))
+    vox_idx = np.concatenate(vox_idx)
+    cell_idx = np.concatenate(cell_idx)
+    bary = np.concatenate(bary)
+
+    # voxels on shared faces/edges are assigned to a single cell
+    vox_idx, first = np.unique(vox_idx, return_index=True)
+    return vox_idx, cell_idx[first], np.clip(bary[first], 0, 1)
+
+
+#%%
+def voxel_cell_map(mesh, vxl_size, **kwarg):
+    """
+    Voxel-to-cell map of the image grid enclosing the mesh. If cache_file is
+    given, the map is read from it when it matches the (local) mesh and
+    voxel size, otherwise it is computed and saved there.
+    """
+    comm = MPI.comm_world
+    rank, size = comm.Get_rank(), comm.Get_size()
+    cache_file = kwarg.get('cache_file', None)
+    if cache_file is not None and size > 1:
+        cache_file = cache_file[:-4] + '_np' + str(size) + '_r' + str(rank) + '.npz'
+
+    x, y, z, img_coord_min = image_grid(mesh, vxl_size)
+    shape = np.array([len(x), len(y), len(z)])
+    mesh_key = np.array([mesh.num_cells(), mesh.num_vertices(),
+                         mesh.coordinates().sum(), mesh.cells().sum()], dtype=float)
+
+    vxl_map = None
+    if cache_file is not None and os.path.isfile(cache_file):
+        data = np.load(cache_file)
+        if np.array_equal(data['mesh_key'], mesh_key) and np.array_equal(data['shape'], shape) \
+                and data['vxl_size'] == vxl_size:
+            vxl_map = {key: data[key] for key in ['vox_idx', 'cell_idx', 'bary']}
+
+    if vxl_map is None:
+        vox_idx, cell_idx, bary = comp_voxel_cell_map(mesh, x, y, z)
+        vxl_map = {'vox_idx': vox_idx, 'cell_idx': cell_idx, 'bary': bary}
+        if cache_file is not None:
+            np.savez(cache_file, mesh_key=mesh_key, shape=shape, vxl_size=vxl_size, **vxl_map)
+
+    vxl_map.update({'x': x, 'y': y, 'z': z, 'img_coord_min': img_coord_min,
+                    'shape': tuple(shape), 'vxl_size': vxl_size, 'cell_dofs': {}})
+    return vxl_map
+
+
+#%%
+def tabulate_cell_dofs(V, vxl_map):
+    # local dofs of the mapped cells, cached in the map for each function space
+    key = V.id()
+    if key not in vxl_map['cell_dofs']:
+        dofmap = V.dofmap()
+        cell_dofs = np.array([dofmap.cell_dofs(int(c)) for c in vxl_map['cell_idx']], dtype=np.int64)
+        vxl_map['cell_dofs'][key] = cell_dofs.reshape((len(vxl_map['cell_idx']), -1))
+    return vxl_map['cell_dofs'][key]
+
+
+#%%
+def basis_weights(degree, bary):
+    """
+    Values of the degree 0, 1 or 2 Lagrange basis functions at the points
+    given by barycentric coordinates (UFC dof order: vertices, then edges
+    (2,3),(1,3),(1,2),(0,3),(0,2),(0,1)).
+    """
+    if degree == 0:
+        return np.ones((len(bary), 1))
+    elif degree == 1:
+        return bary
+    elif degree == 2:
+        edges = [(2, 3), (1, 3), (1, 2), (0, 3), (0, 2), (0, 1)]
+        w_vertex = bary*(2*bary-1)
+        w_edge = np.stack([4*bary[:, a]*bary[:, b] for a, b in edges], axis=1)
+        return np.concatenate([w_vertex, w_edge], axis=1)
+    else:
+        return None
+
+
+#%%
+def resample_function(myvar, vxl_map, bckg_val, **kwarg):
+    """
+    Image data of a scalar, vector or tensor function on the grid of vxl_map.
+    The full image is returned on root (None on other processes).
+    """
+    comm = MPI.comm_world
+    rank = comm.Get_rank()
+    root = kwarg.get('root', 0)
+
+    V = myvar.function_space()
+    value_size = max(int(np.prod(myvar.ufl_shape)), 1)
+    element = V.ufl_element()
+    if element.num_sub_elements() > 0:
+        element = element.sub_elements()[0]
+    weights = basis_weights(element.degree(), vxl_map['bary'])
+
+    if weights is not None:
+        cell_dofs = tabulate_cell_dofs(V, vxl_map)
+        # values of the local (owned and ghost) dofs of the mapped cells
+        needed, inverse = np.unique(cell_dofs, return_inverse=True)
+        l2g = V.dofmap().tabulate_local_to_global_dofs()
+        dof_values = myvar.vector().gather(l2g[needed].astype(np.intc))
+        cell_values = dof_values[inverse.reshape(cell_dofs.shape)]
+        # dofs of vector and tensor functions are blocked by component
+        cell_values = cell_values.reshape((len(cell_dofs), value_size, -1))
+        vox_values = np.einsum('nkd,nd->nk', cell_values, weights)
+    else:
+        grid = np.stack(np.unravel_index(vxl_map['vox_idx'], vxl_map['shape']), axis=1)
+        points = np.stack([vxl_map['x'][grid[:, 0]], vxl_map['y'][grid[:, 1]], vxl_map['z'][grid[:, 2]]], axis=1)
+        vox_values = np.array([myvar(point) for point in points]).reshape((len(points), value_size))
+
+    # assemble image on root
+    gathered = comm.gather((vxl_map['vox_idx'], vox_values), root=root)
+    if rank != root:
+        return None
+
+    img_data = np.ones((int(np.prod(vxl_map['shape'])), value_size))*bckg_val
+    for vox_idx, values in gathered:
+        img_data[vox_idx, :] = values
+    if value_size == 1:
+        return img_data.reshape(vxl_map['shape'])
+    return img_data.reshape(tuple(vxl_map['shape']) + (value_size,))
+
+
+#%%
+def image_affine(vxl_map):
+    # affine matrix of the image (same convention as the original conversion)
+    affine_matrix = np.eye(4)
+    affine_matrix[:3, :3] = vxl_map['vxl_size']*affine_matrix[:3, :3]
+    affine_matrix[:3, -1] = vxl_map['img_coord_min']+1
+    return affine_matrix
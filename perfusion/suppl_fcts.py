@@ -111,16 +111,20 @@ def comp_vessel_orientation(subdomains,boundaries,mesh,res_fldr,save_subres):
     if fe_degr > 1:
         e = interpolate(e,Ve_DG)
     
-    e_array = e.vector().get_local()
-    for i in range(int(len(e_array)/3)):
-        e_array[i*3:(i+1)*3] = e_array[i*3:(i+1)*3]/np.linalg.norm(e_array[i*3:(i+1)*3])
-    e.vector().set_local(e_array)
-    
+    # normalise cell-wise vectors, shape (N,3)
+    e_array = e.vector().get_local().reshape((-1,3))
+    e_norm = np.linalg.norm(e_array,axis=1)
+    e_array = e_array/np.where(e_norm>0,e_norm,1)[:,np.newaxis]
+    e.vector().set_local(e_array.reshape(-1))
+    
+    # first component with |e_i| >= 1/sqrt(3), the largest component if
+    # round-off leaves every component just below the limit
+    e_abs = abs(e_array)
+    main_comp = e_abs>=np.sqrt(1/3)
     main_direction = Function(Vdir)
-    main_direction_array = main_direction.vector().get_local()
-    for i in range(int(len(e_array)/3)):
-        main_direction_array[i] = np.where(abs(e_array[i*3:(i+1)*3])>=np.sqrt(1/3))[0][0]
-    main_direction.vector().set_local(main_direction_array)
+    main_direction.vector().set_local( np.where(main_comp.any(axis=1),
+                                                main_comp.argmax(axis=1),
+                                                e_abs.argmax(axis=1)).astype(float) )
     
     e.rename("e","normalised penetrating vessel axis direction")
     main_direction.rename("main_direction","main direction of penetrating vessel axes")
@@ -134,17 +138,13 @@ def perm_tens_comp(K_space,subdomains,mesh,e_ref,e_loc,K1_form):
     K1 = Function(K_space)    
     K1_array = K1.vector().get_local()
     
-    e_loc_array = e_loc.vector().get_local()
+    e_loc_array = e_loc.vector().get_local().reshape((-1,3))
     
-    for i in range(mesh.num_cells()):
-        e1 = e_loc_array[i*3:i*3+3]
-        T = comp_transf_mat(e_ref,e1)
-        
-        # rotate local permeability tensor
-        K1_loc = np.reshape( np.matmul(np.matmul(T,K1_form),T.transpose()),9 )
-        
-        # set local permeability tensor
-        K1_array[i*9:i*9+9] = K1_loc
+    # transformation matrices of every cell, shape (N,3,3)
+    T = comp_transf_mat_batch(e_ref,e_loc_array)
+    
+    # rotate local permeability tensors: T K1_form T^T
+    K1_array[:] = np.einsum('nij,jk,nlk->nil',T,np.asarray(K1_form,dtype=float),T).reshape(-1)
     
     tolerance = 1e-9
     mask = abs(K1_array) < tolerance
@@ -155,62 +155,70 @@ def perm_tens_comp(K_space,subdomains,mesh,e_ref,e_loc,K1_form):
     return K1
 
 
+#%%
+def subdomain_lookup(subdomains, value_wm, value_gm, default):
+    # cell-wise values of white matter (11) and gray matter (12) cells obtained
+    # from a label-to-value lookup table, other cells get the default value
+    labels = subdomains.array()
+    n_lookup = max(int(labels.max())+1 if len(labels)>0 else 0, 13)
+    lookup = np.full(n_lookup, default, dtype=float)
+    lookup[11] = value_wm
+    lookup[12] = value_gm
+    return lookup[labels]
+
+
 #%%
 def scale_permeabilities(subdomains, K1, K2, K3, \
                          K1_ref_gm, K2_ref_gm, K3_ref_gm, gmowm_perm_rat,res_fldr,**kwarg):
-    
-    loc1 = subdomains.where_equal(11)# white matter cell indices
-    loc2 = subdomains.where_equal(12)# gray matter cell indices
-    
-    K1_array = K1.vector().get_local()
-    K2_array = K2.vector().get_local()
-    K3_array = K3.vector().get_local()
+    """
+    Scale the permeability forms K1, K3 and set K2 in white and gray matter.
+    The input functions are modified in place unless preallocated functions
+    are provided via out=(K1_out,K2_out,K3_out), in which case K1, K2 and K3
+    are left untouched and the scaled values are written into out.
+    """
     
     # obtain reference values    
     K1_ref_wm = K1_ref_gm/gmowm_perm_rat
     K2_ref_wm = K2_ref_gm/gmowm_perm_rat
     K3_ref_wm = K3_ref_gm/gmowm_perm_rat
     
-    location = 0
-    for loc in [loc1,loc2]:
-        for i in range(len(loc)):
-            idx1 = int(loc[i])*9
-            idx2 = int(loc[i])*9+9
-            if location == 0: #WM
-                K1_array[idx1:idx2] *= K1_ref_wm
-                K3_array[idx1:idx2] *= K3_ref_wm
-                K2_array[loc[i]] = K2_ref_wm
-            else: #GM
-                K1_array[idx1:idx2] *= K1_ref_gm
-                K3_array[idx1:idx2] *= K3_ref_gm
-                K2_array[loc[i]] = K2_ref_gm
-        location = location + 1
+    K1_factor = subdomain_lookup(subdomains, K1_ref_wm, K1_ref_gm, 1.0)
+    K3_factor = subdomain_lookup(subdomains, K3_ref_wm, K3_ref_gm, 1.0)
+    K2_value = subdomain_lookup(subdomains, K2_ref_wm, K2_ref_gm, np.nan)
     
-    K1.vector().set_local(K1_array)
+    # tensor arrays reshaped to (N,9), one row per cell
+    K1_array = K1.vector().get_local().reshape((-1,9))
+    K2_array = K2.vector().get_local()
+    K3_array = K3.vector().get_local().reshape((-1,9))
+    
+    K1_array *= K1_factor[:,np.newaxis]
+    K3_array *= K3_factor[:,np.newaxis]
+    K2_array = np.where(np.isnan(K2_value), K2_array, K2_value)
+    
+    if 'out' in kwarg:
+        K1, K2, K3 = kwarg['out']
+    K1.vector().set_local(K1_array.reshape(-1))
     K2.vector().set_local(K2_array)
-    K3.vector().set_local(K3_array)
+    K3.vector().set_local(K3_array.reshape(-1))
     
     return K1, K2, K3
     
 #%%
 def scale_coupling_coefficients(subdomains, beta12gm, beta23gm, gmowm_beta_rat, \
                                 K2_space, res_fldr,**kwarg): 
+    """
+    Coupling coefficients in white and gray matter (zero elsewhere). New
+    functions are allocated unless out=(beta12,beta23) is provided.
+    """
     
-    loc1 = subdomains.where_equal(11)# white matter cell indices
-    loc2 = subdomains.where_equal(12)# gray matter cell indices
-    
-    beta12 = Function(K2_space)
-    beta23 = Function(K2_space)
-    beta12_array = beta12.vector().get_local()
-    beta23_array = beta23.vector().get_local()
-    
-    beta12_array[loc2] = beta12gm
-    beta12_array[loc1] = beta12gm/gmowm_beta_rat
-    beta23_array[loc2] = beta23gm
-    beta23_array[loc1] = beta23gm/gmowm_beta_rat
+    if 'out' in kwarg:
+        beta12, beta23 = kwarg['out']
+    else:
+        beta12 = Function(K2_space)
+        beta23 = Function(K2_space)
     
-    beta12.vector().set_local(beta12_array)
-    beta23.vector().set_local(beta23_array)
+    beta12.vector().set_local(subdomain_lookup(subdomains, beta12gm/gmowm_beta_rat, beta12gm, 0.0))
+    beta23.vector().set_local(subdomain_lookup(subdomains, beta23gm/gmowm_beta_rat, beta23gm, 0.0))
     
     return beta12, beta23
     
@@ -244,6 +252,37 @@ def comp_transf_mat(e0,e1):
     return T
 
 
+#%%
+def comp_transf_mat_batch(e0,e1):
+    # batched version of comp_transf_mat: rotation matrices taking e0 into
+    # every row of e1 (shape (N,3)), returned as an array of shape (N,3,3)
+    e0 = np.asarray(e0,dtype=float)
+    e0 = e0/np.linalg.norm(e0)
+    e1 = np.asarray(e1,dtype=float).reshape((-1,3))
+    norm = np.linalg.norm(e1,axis=1)
+    e1 = np.where(norm[:,np.newaxis]>0, e1/np.where(norm>0,norm,1)[:,np.newaxis], e0)
+    
+    v = np.cross(e0,e1) # rotation axis scaled by the sine
+    c = e1.dot(e0) # cosine
+    vx = np.zeros((len(e1),3,3))
+    vx[:,0,1], vx[:,0,2], vx[:,1,2] = -v[:,2], v[:,1], -v[:,0]
+    vx[:,1,0], vx[:,2,0], vx[:,2,1] = v[:,2], -v[:,1], v[:,0]
+    
+    # Rodrigues' formula with (1-c)/s^2 = 1/(1+c), i.e. without dividing by the
+    # sine, which vanishes for e1 = e0 (T = I)
+    antiparallel = c < -1 + 1e-9
+    scale = 1/np.where(antiparallel,1,1+c)
+    T = c[:,np.newaxis,np.newaxis]*np.identity(3) + vx \
+        + scale[:,np.newaxis,np.newaxis]*np.einsum('ni,nj->nij',v,v)
+    
+    # e1 = -e0: rotation by pi around an axis normal to e0
+    if antiparallel.any():
+        u = np.cross(e0,np.identity(3)[np.argmin(abs(e0))])
+        u = u/np.linalg.norm(u)
+        T[antiparallel] = 2*np.tensordot(u,u,axes=0) - np.identity(3)
+    return T
+
+
 #%%
 def perm_tens_comp_old(K_space,subdomains,mesh,e0,K1_ref,K2_ref,K3_ref,pial_surf_file):
     # function spaces for permeability tensors
@@ -316,29 +355,28 @@ def surface_ave(mesh,boundaries,vels,ps):
     n_labels = n_labels - 1
     
     n = FacetNormal(mesh)
-    dS = ds(subdomain_data=boundaries)
+    
+    # areas, fluxes and pressure integrals of every boundary region
+    areas = region_measure(mesh,boundaries)
+    flux_integrals = [integrate_by_label(dot(vels[j],n),mesh,boundaries) for j in range(3)]
+    p_integrals = [integrate_by_label(ps[j],mesh,boundaries) for j in range(3)]
+    total_area = areas.sum()
     
     fluxes = []
     surf_p_values = []
     p_pial_ave = [0,0,0]
-    
-    
-    total_area = assemble( Constant(1.0)*ds(domain=mesh) )
     pial_weighting_area = 0
-    pressure_weight = 0
-    # compute fluxes and surface area for each boundary region
     for i in range(n_labels):
         ID = int(boundary_labels[i])
-        area = assemble( Constant(1.0)*dS(ID,domain=mesh) )
+        area = areas[ID]
         
         fluxes_ID = [ ID, area ]
         surf_p = [ ID, area ]
         for j in range(3):
-            fluxes_ID.append( assemble(dot(vels[j],n)*dS(ID)) )
-            p_ave = assemble( Constant(1.0)*ps[j]*dS(ID) )
-            surf_p.append( p_ave/area )
+            fluxes_ID.append( flux_integrals[j][ID] )
+            surf_p.append( p_integrals[j][ID]/area )
             if ID > 2:
-                p_pial_ave[j] = p_pial_ave[j] + p_ave
+                p_pial_ave[j] = p_pial_ave[j] + p_integrals[j][ID]
         fluxes.append(fluxes_ID)
         surf_p_values.append(surf_p)
         if ID > 2:
@@ -348,8 +386,8 @@ def surface_ave(mesh,boundaries,vels,ps):
     fluxes_ID = [ sum(boundary_labels), total_area ]
     surf_p = [ sum(boundary_labels), total_area ]
     for j in range(3):
-        fluxes_ID.append( assemble(dot(vels[j],n)*ds) )
-        surf_p.append( assemble(ps[j]*ds)/total_area )
+        fluxes_ID.append( flux_integrals[j].sum() )
+        surf_p.append( p_integrals[j].sum()/total_area )
     fluxes.append( fluxes_ID )
     surf_p_values.append(surf_p)
     
@@ -388,6 +426,54 @@ def infarct_vol(mesh,subdomains,infarct):
     return np.array(vol_p_values)
 
 
+#%%
+def infarct_vol_thresholds(mesh,subdomains,perfusion_change,thresholds):
+    """
+    Infarct volumes for a sweep of perfusion change thresholds [%] evaluated
+    in a single pass: cells with a perfusion change not exceeding the threshold
+    (or undefined change) are infarcted. Rows are [threshold, region ID,
+    region volume [mm^3], infarct volume [mL]] ordered as in infarct_vol, with
+    the net volume labelled by the sum of region IDs.
+    """
+    comm = MPI.comm_world
+    
+    subdom_labels, n_labels = region_label_assembler(subdomains)
+    thresholds = np.asarray(thresholds, dtype=float)
+    
+    # perfusion change and volume of cells (DG0 dofs follow cell indices)
+    V = perfusion_change.function_space()
+    cell_vol = assemble(TestFunction(V)*dx(domain=mesh)).get_local()
+    change = perfusion_change.vector().get_local()
+    labels = subdomains.array()
+    
+    undefined = np.isnan(change)
+    region_vol = np.zeros(n_labels)
+    infarct_vol = np.zeros((len(thresholds), n_labels))
+    for i in range(n_labels):
+        in_region = labels == subdom_labels[i]
+        region_vol[i] = cell_vol[in_region].sum()
+        
+        # cumulative volume of cells sorted by perfusion change
+        defined = in_region & ~undefined
+        order = np.argsort(change[defined])
+        sorted_change = change[defined][order]
+        cum_vol = np.concatenate(([0], np.cumsum(cell_vol[defined][order])))
+        infarct_vol[:, i] = cum_vol[np.searchsorted(sorted_change, thresholds, side='right')] \
+            + cell_vol[in_region & undefined].sum()
+    
+    region_vol = comm.allreduce(region_vol)
+    infarct_vol = comm.allreduce(infarct_vol)
+    
+    # region values followed by the net volume for every threshold
+    n_rows = n_labels+1
+    vol_infarct_values = np.zeros((len(thresholds)*n_rows, 4))
+    vol_infarct_values[:, 0] = np.repeat(thresholds, n_rows)
+    vol_infarct_values[:, 1] = np.tile(np.append(subdom_labels, int(sum(subdom_labels))), len(thresholds))
+    vol_infarct_values[:, 2] = np.tile(np.append(region_vol, assemble(Constant(1.0)*dx(domain=mesh))), len(thresholds))
+    vol_infarct_values[:, 3] = np.concatenate((infarct_vol, infarct_vol.sum(axis=1, keepdims=True)), axis=1).reshape(-1)/1000
+    
+    return vol_infarct_values
+
 
 # perfusion calculation
 def perfusion_vol(mesh,subdomains,perfusion):
@@ -426,24 +512,25 @@ def vol_ave(mesh,subdomains,ps,vels):
     
     subdom_labels, n_labels = region_label_assembler(subdomains)
     
-    dV = dx(subdomain_data=subdomains)
+    # volumes and integrals of every region
+    volumes = region_measure(mesh,subdomains)
+    p_integrals = [integrate_by_label(ps[j],mesh,subdomains) for j in range(3)]
+    vel_integrals = [integrate_by_label(sqrt(inner(vels[j], vels[j])),mesh,subdomains) for j in range(3)]
     
-    vel_mag = []
     vol_p_values = []
     vol_vel_values = []
     
-    
     # compute volume and characteristic values for each region
     for i in range(n_labels):
         ID = int(subdom_labels[i])
-        vol = assemble( Constant(1.0)*dV(ID,domain=mesh) )
+        vol = volumes[ID]
         char_p_ID = [ ID, vol ]
         char_vel_ID = [ ID, vol ]
         
         # volume averaged quantities
         for j in range(3):
-            char_p_ID.append( assemble( ps[j]*dV(ID) )/vol )
-            char_vel_ID.append( assemble( sqrt(inner(vels[j], vels[j]))*dV(ID) )/vol )
+            char_p_ID.append( p_integrals[j][ID]/vol )
+            char_vel_ID.append( vel_integrals[j][ID]/vol )
         
         # TODO: add min and max
         vol_p_values.append(char_p_ID)
@@ -451,12 +538,12 @@ def vol_ave(mesh,subdomains,ps,vels):
     
     # compute the net volume and average
     ID = int(sum(subdom_labels))
-    vol = assemble( Constant(1.0)*dx(domain=mesh) )
+    vol = volumes.sum()
     char_p_ID = [ ID, vol ]
     char_vel_ID = [ ID, vol ]
     for j in range(3):
-        char_p_ID.append( assemble(ps[j]*dx)/vol )
-        char_vel_ID.append( assemble( sqrt(inner(vels[j], vels[j]))*dx )/vol )
+        char_p_ID.append( p_integrals[j].sum()/vol )
+        char_vel_ID.append( vel_integrals[j].sum()/vol )
     
     vol_p_values.append(char_p_ID)
     vol_vel_values.append(char_vel_ID)
@@ -465,118 +552,139 @@ def vol_ave(mesh,subdomains,ps,vels):
 
 
 #%%
+# labels of every MeshFunction passed to region_label_assembler (the MeshFunction
+# is kept in the registry so that its id cannot be reused by another object)
+region_label_registry = {}
+
+
 def region_label_assembler(region):
     # in parallel region labels might be distributed between cores
     # this function assembles labels and distributes the corresponding array to each processor
-    
-    comm = MPI.comm_world
-    rank = comm.Get_rank()
-    size = comm.Get_size()
-    root = 0
-    
-    region_labels = region.array()
     # 0: interior face, 1: brain stem cut plane,
     # 2: ventricular surface, 2+: brain surface
     
-    # STEP 0: collect total array of region labels on root
-    sendbuf = region_labels
-    # Collect local array sizes using the high-level mpi4py gather
-    sendcounts = np.array(comm.gather(len(sendbuf), root))
-    
-    if rank == root:
-        # print("sendcounts: {}, total: {}".format(sendcounts, sum(sendcounts)))
-        recvbuf = np.empty(sum(sendcounts), dtype=int)
-    else:
-        recvbuf = None
-    comm.Gatherv(sendbuf=sendbuf, recvbuf=(recvbuf, sendcounts), root=root)
-    
-    # STEP 1: broadcast total array of region labels from root
-    if rank == root:
-        # print("Gathered array: {}".format(recvbuf))
-        # print(len(recvbuf),len(set(recvbuf)))
-        recvbuf = np.array(list(set(recvbuf)))
-        n_labels = np.array([len(recvbuf)])
-    else:
-        n_labels = np.array([0])
-    comm.Bcast(n_labels, root=root)
-    # print(rank,n_labels)
-    
-    if rank == root:
-        region_labels=recvbuf
-    else:
-        region_labels=np.zeros(n_labels[0],dtype=int)
-    comm.Bcast(region_labels, root=0)
+    key = region.id()
+    if key not in region_label_registry:
+        comm = MPI.comm_world
+        
+        # union of the (few) local labels of every process
+        local_labels = np.unique(region.array()).astype(int)
+        region_labels = np.unique(np.concatenate(comm.allgather(local_labels))).astype(int)
+        region_label_registry[key] = (region, region_labels)
     
-    # if rank==root:
-    #     print('\n\n TEST ARRAY \n\n')
-    # print(rank,region_labels)
-
-    n_labels = n_labels[0]
+    region_labels = region_label_registry[key][1].copy()
+    n_labels = len(region_labels)
     
     return region_labels, n_labels
     
     
+#%%
+# function spaces, test functions and labels used for integration by label,
+# as well as region areas/volumes, kept for each mesh and MeshFunction
+integration_cache = {}
+
+
+def label_bins(mesh,region):
+    """
+    Test function with one dof per facet (HDiv Trace) or per cell (DG0) and
+    the label of every owned dof of the region MeshFunction.
+    """
+    key = (mesh.id(), region.id())
+    if key not in integration_cache:
+        dim = region.dim()
+        if dim == mesh.topology().dim():
+            V = FunctionSpace(mesh, "DG", 0)
+        else:
+            V = FunctionSpace(mesh, "HDiv Trace", 0)
+        dofmap = V.dofmap()
+        entity_dofs = np.array(dofmap.entity_dofs(mesh, dim), dtype=np.int64)
+        owned_range = dofmap.ownership_range()
+        n_owned = owned_range[1] - owned_range[0]
+        
+        # dofs shared between processes are labelled by their owner only
+        owned = entity_dofs < n_owned
+        dof_labels = np.zeros(n_owned, dtype=np.int64)
+        dof_labels[entity_dofs[owned]] = region.array()[owned]
+        
+        region_labels, n_labels = region_label_assembler(region)
+        integration_cache[key] = {'region': region, 'test': TestFunction(V), 'labels': dof_labels,
+                                  'n_bins': int(max(region_labels))+1, 'measure': None}
+    return integration_cache[key]
+
+
+#%%
+def label_form(integrand,mesh,region):
+    # compiled form of integrate_by_label for integrands evaluated repeatedly
+    bins = label_bins(mesh,region)
+    if region.dim() == mesh.topology().dim():
+        return Form(integrand*bins['test']*dx(domain=mesh))
+    else:
+        return Form(integrand*bins['test']*ds(domain=mesh))
+
+
+#%%
+def integrate_by_label(integrand,mesh,region):
+    """
+    Integrals of the integrand over every label of region (exterior facets if
+    region is a facet MeshFunction, cells otherwise) obtained from a single
+    assembly. The integrand can also be a form returned by label_form. The
+    returned array (same on every process) is indexed by label.
+    """
+    bins = label_bins(mesh,region)
+    if isinstance(integrand, Form):
+        my_form = integrand
+    elif region.dim() == mesh.topology().dim():
+        my_form = integrand*bins['test']*dx(domain=mesh)
+    else:
+        my_form = integrand*bins['test']*ds(domain=mesh)
+    values = assemble(my_form).get_local()
+    local_integrals = np.bincount(bins['labels'], weights=values, minlength=bins['n_bins'])
+    return MPI.comm_world.allreduce(local_integrals)
+
+
+#%%
+def region_measure(mesh,region):
+    # area (facets) or volume (cells) of every label, computed once per mesh
+    bins = label_bins(mesh,region)
+    if bins['measure'] is None:
+        bins['measure'] = integrate_by_label(Constant(1.0),mesh,region)
+    return bins['measure']
+
+
 #%%
 def compute_boundary_area(mesh,boundaries,labels,n_labels):
-    area = []
-    
-    n = FacetNormal(mesh)
-    dS = ds(subdomain_data=boundaries)
-    for i in range(n_labels):
-        ID = int(labels[i])
-        area.append( assemble( Constant(1.0)*dS(ID,domain=mesh) ) )
-    return np.array(area)
+    return region_measure(mesh,boundaries)[np.array(labels[:n_labels], dtype=int)]
 
 
 #%%
 def compute_subdm_vol(mesh,subdomains,labels,n_labels):
-    volume = []
-    
-    dV = dx(subdomain_data=subdomains)
-    for i in range(n_labels):
-        ID = int(labels[i])
-        volume.append(  assemble( Constant(1.0)*dV(ID,domain=mesh) ) )
-    return np.array(volume)
+    return region_measure(mesh,subdomains)[np.array(labels[:n_labels], dtype=int)]
     
 
 #%%
 def surface_integrate(variable,mesh,boundaries,labels,n_labels,magn):
-    dS = ds(subdomain_data=boundaries)
-    surface_integrals = []
-    
     if variable.value_rank()==0:
-        for i in range(n_labels):
-            ID = int(labels[i])
-            surface_integrals.append( assemble( variable*dS(ID) ) )
+        integrand = variable
     elif magn:
-        for i in range(n_labels):
-            ID = int(labels[i])
-            surface_integrals.append( assemble( sqrt(inner(variable, variable))*dS(ID) ) )
+        integrand = sqrt(inner(variable, variable))
     else:
         n = FacetNormal(mesh)
-        for i in range(n_labels):
-            ID = int(labels[i])
-            surface_integrals.append( assemble(dot(variable,n)*dS(ID)) )
-    return np.array(surface_integrals)
+        integrand = dot(variable,n)
+    surface_integrals = integrate_by_label(integrand,mesh,boundaries)
+    return surface_integrals[np.array(labels[:n_labels], dtype=int)]
 
 
 #%%
 def volume_integrate(variable,mesh,subdomains,labels,n_labels,magn):
-    dV = dx(subdomain_data=subdomains)
-    volume_integrals = []
-    
     if variable.value_rank()==0:
-        for i in range(n_labels):
-            ID = int(labels[i])
-            volume_integrals.append( assemble( variable*dV(ID) ) )
+        integrand = variable
     elif magn:
-        for i in range(n_labels):
-            ID = int(labels[i])
-            volume_integrals.append( assemble( sqrt(inner(variable, variable))*dV(ID) ) )
+        integrand = sqrt(inner(variable, variable))
     else:
         print("warning: volumetric integration of non-scalar variables has not been implemented!")
-        return volume_integrals
-    return np.array(volume_integrals)
+        return []
+    volume_integrals = integrate_by_label(integrand,mesh,subdomains)
+    return volume_integrals[np.array(labels[:n_labels], dtype=int)]
 
 
 #%%
@@ -0,0 +1,46 @@
+"""
+Authentication key of the persistent perfusion worker (perfusion_worker.py)
+
+Messages of the local socket are unpickled, so the key is generated randomly
+when the worker starts and written to a key file only readable by the user.
+The file is given by the environment variable PERFUSION_WORKER_KEY_FILE,
+otherwise it is ~/.perfusion_worker_<port>.key. Clients (submit_scenarios,
+API.py) read the key from the same file.
+"""
+import os
+import secrets
+
+
+#%%
+def worker_key_file(port):
+    # path of the key file of the worker listening on port
+    default = os.path.join(os.path.expanduser('~'), '.perfusion_worker_' + str(port) + '.key')
+    return os.environ.get('PERFUSION_WORKER_KEY_FILE', default)
+
+
+#%%
+def create_worker_key(port):
+    # new random key written to the key file (permissions 0600)
+    key = secrets.token_bytes(32)
+    key_file = worker_key_file(port)
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+
+#%%
+def read_worker_key(port):
+    key_file = worker_key_file(port)
+    if not os.path.isfile(key_file):
+        raise Exception('key file of the perfusion worker not found: ' + key_file)
+    with open(key_file, 'rb') as f:
+        return f.read()
+
+
+#%%
+def remove_worker_key(port):
+    key_file = worker_key_file(port)
+    if os.path.isfile(key_file):
+        os.remove(key_file)
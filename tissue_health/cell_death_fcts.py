@@ -0,0 +1,230 @@
+"""
+Hypoxia-based cell death model evaluated for every element at once
+
+h[0] - dead fraction
+h[1] - toxic state
+hypo - hypoxic fraction (constant in each phase)
+
+d(dead)/dt  = (1-dead)*kf*toxic
+d(toxic)/dt = (1-dead)*(kt*hypo - kb*toxic*(1-hypo))
+
+The states of all cells are stored in NumPy arrays and advanced
+simultaneously with the classical fourth order Runge-Kutta scheme.
+
+Since hypo is constant in each phase, the state after a phase depends only on
+the initial state, hypo and the duration. For repeated evaluations with the
+same kf, kt, kb the solution can be tabulated once and interpolated:
+- from the zero state on a (hypo, time) grid;
+- from any other state on a (hypo, alive, toxic, time) grid storing the alive
+  fraction relative to the initial one and the toxic state.
+(An exact solution is only available in the "alive time" tau, d(tau)/dt =
+1-dead, in which toxic relaxes exponentially, so the mapping to time is
+tabulated as well.) Tables are saved together with the rate constants and
+error estimates (dead fraction and toxic state of one phase, dead fraction
+after two phases) obtained by comparison with fine time integration.
+"""
+import numpy as np
+import os
+from scipy.interpolate import RegularGridInterpolator
+
+
+#%%
+def hypoxia_estimate(perfusion, ks1, ks2):
+    # relationship between hypoxic fraction and perfusion - based on Green's function simulations
+    return 1-1/(1+np.exp(-(ks1*perfusion+ks2)))
+
+
+#%%
+def cell_death_rhs(dead, toxic, hypo, kf, kt, kb):
+    a = 1 - dead
+    return a*kf*toxic, a*kt*hypo-kb*toxic*(1-hypo)*a
+
+
+#%%
+def integrate_cell_death(dead, toxic, hypo, duration, kf, kt, kb, **kwarg):
+    """
+    Advance the dead fraction and toxic state of every cell over duration [s]
+    with constant hypoxic fractions (arrays of equal length). The duration can
+    be a scalar or an array with one entry per cell.
+    The time step is chosen so that the largest rate constant times the time
+    step does not exceed rate_step (default 0.05).
+    """
+    rate_step = kwarg.get('rate_step', 0.05)
+
+    dead = np.array(dead, dtype=float)
+    toxic = np.array(toxic, dtype=float)
+    hypo = np.asarray(hypo, dtype=float)
+    duration = np.asarray(duration, dtype=float)
+    if len(dead) == 0 or np.all(duration <= 0):
+        return dead, toxic
+
+    n_steps = max(int(np.ceil(duration.max()*max(kf, kt, kb)/rate_step)), 1)
+    dt = np.maximum(duration, 0)/n_steps
+    for step in range(n_steps):
+        k1d, k1t = cell_death_rhs(dead, toxic, hypo, kf, kt, kb)
+        k2d, k2t = cell_death_rhs(dead+dt/2*k1d, toxic+dt/2*k1t, hypo, kf, kt, kb)
+        k3d, k3t = cell_death_rhs(dead+dt/2*k2d, toxic+dt/2*k2t, hypo, kf, kt, kb)
+        k4d, k4t = cell_death_rhs(dead+dt*k3d, toxic+dt*k3t, hypo, kf, kt, kb)
+        dead = dead + dt/6*(k1d+2*k2d+2*k3d+k4d)
+        toxic = toxic + dt/6*(k1t+2*k2t+2*k3t+k4t)
+    return dead, toxic
+
+
+#%%
+def comp_cell_volumes(mesh):
+    # volume of every (tetrahedral) cell of the mesh
+    X = mesh.coordinates()[mesh.cells()]
+    return abs(np.linalg.det(X[:, 1:, :]-X[:, :1, :]))/6
+
+
+#%%
+def tabulate_cell_death_path(dead, toxic, hypo, time_grid, kf, kt, kb, **kwarg):
+    # dead fraction and toxic state of every cell at the nodes of time_grid (shape (n_time, n_cells))
+    dead_path = np.empty((len(time_grid), len(dead)))
+    toxic_path = np.empty((len(time_grid), len(dead)))
+    dead_path[0], toxic_path[0] = dead, toxic
+    for i in range(1, len(time_grid)):
+        dead_path[i], toxic_path[i] = integrate_cell_death(dead_path[i-1], toxic_path[i-1], hypo,
+                                                           time_grid[i]-time_grid[i-1], kf, kt, kb, **kwarg)
+    return dead_path, toxic_path
+
+
+#%%
+def build_cell_death_table(kf, kt, kb, **kwarg):
+    """
+    Tabulate the solution of the cell death model for the rate constants
+    kf, kt, kb up to t_max [s] (default 80 hours). Grid sizes are given by
+    n_hypo, n_alive, n_toxic, n_time (4D table) and n_zero (2D table from the
+    zero state). The time and alive grids are refined quadratically towards 0.
+    The interpolation errors of the dead fraction and the toxic state are
+    estimated at n_sample random points of a single phase and the error of
+    the dead fraction after two phases (from the zero state, the second one
+    starting from the interpolated state of the first one) at n_sample random
+    pairs of phases.
+    """
+    t_max = kwarg.get('t_max', 80*3600.)
+    n_hypo = kwarg.get('n_hypo', 65)
+    n_alive = kwarg.get('n_alive', 17)
+    n_toxic = kwarg.get('n_toxic', 33)
+    n_time = kwarg.get('n_time', 129)
+    n_zero = kwarg.get('n_zero', 257)
+    n_sample = kwarg.get('n_sample', 2000)
+    rate_step = kwarg.get('rate_step', 0.05)
+
+    table = {'kf': kf, 'kt': kt, 'kb': kb, 't_max': t_max}
+
+    # solution from the zero state
+    hypo_zero = np.linspace(0, 1, n_zero)
+    time_zero = t_max*np.linspace(0, 1, n_zero)**2
+    dead_path, toxic_path = tabulate_cell_death_path(np.zeros(n_zero), np.zeros(n_zero), hypo_zero,
+                                                     time_zero, kf, kt, kb, rate_step=rate_step)
+    table.update({'hypo_zero': hypo_zero, 'time_zero': time_zero,
+                  'dead_zero': dead_path.T, 'toxic_zero': toxic_path.T})
+    # states reachable from the zero state bound the toxic grid
+    toxic_max = kwarg.get('toxic_max', toxic_path.max())
+
+    # solution from arbitrary states, alive fraction is stored relative to the initial one
+    hypo_grid = np.linspace(0, 1, n_hypo)
+    alive_grid = np.linspace(0, 1, n_alive)**2
+    toxic_grid = np.linspace(0, toxic_max, n_toxic)
+    time_grid = t_max*np.linspace(0, 1, n_time)**2
+    H, A, T = [X.ravel() for X in np.meshgrid(hypo_grid, alive_grid, toxic_grid, indexing='ij')]
+    dead_path, toxic_path = tabulate_cell_death_path(1-A, T, H, time_grid, kf, kt, kb, rate_step=rate_step)
+    alive_ratio = (1-dead_path)/np.where(A > 0, A, 1)
+    shape = (n_hypo, n_alive, n_toxic, n_time)
+    table.update({'hypo_grid': hypo_grid, 'alive_grid': alive_grid, 'toxic_grid': toxic_grid,
+                  'time_grid': time_grid,
+                  'alive_ratio': np.moveaxis(alive_ratio, 0, -1).reshape(shape).astype(np.float32),
+                  'toxic': np.moveaxis(toxic_path, 0, -1).reshape(shape).astype(np.float32)})
+
+    # error estimate with respect to fine time integration
+    rng = np.random.default_rng(0)
+    hypo = rng.uniform(0, 1, n_sample)
+    dead = 1-rng.uniform(0, 1, n_sample)
+    toxic = rng.uniform(0, toxic_max, n_sample)
+    duration = rng.uniform(0, t_max, n_sample)
+    dead_ref, toxic_ref = integrate_cell_death(dead, toxic, hypo, duration, kf, kt, kb, rate_step=rate_step/10)
+    dead_tab, toxic_tab = tabulated_cell_death(table, dead, toxic, hypo, duration)
+    err = abs(dead_tab-dead_ref)
+    toxic_err = abs(toxic_tab-toxic_ref)
+    table.update({'max_error': err.max(), 'p99_error': np.percentile(err, 99),
+                  'max_toxic_error': toxic_err.max(), 'p99_toxic_error': np.percentile(toxic_err, 99)})
+
+    # errors of the toxic state propagate to the dead fraction of the next phase
+    hypo2 = rng.uniform(0, 1, n_sample)
+    duration2 = rng.uniform(0, t_max, n_sample)
+    zero = np.zeros(n_sample)
+    dead_ref, toxic_ref = integrate_cell_death(zero, zero, hypo, duration, kf, kt, kb, rate_step=rate_step/10)
+    dead_ref = integrate_cell_death(dead_ref, toxic_ref, hypo2, duration2, kf, kt, kb, rate_step=rate_step/10)[0]
+    dead_tab, toxic_tab = tabulated_cell_death(table, zero, zero, hypo, duration)
+    dead_tab = tabulated_cell_death(table, dead_tab, toxic_tab, hypo2, duration2)[0]
+    err = abs(dead_tab-dead_ref)
+    table.update({'max_two_phase_error': err.max(), 'p99_two_phase_error': np.percentile(err, 99)})
+    return table
+
+
+#%%
+def load_cell_death_table(file_name, kf, kt, kb, **kwarg):
+    """
+    Read the cell death table from file_name if it was computed with the same
+    rate constants and t_max, otherwise build it (see build_cell_death_table)
+    and save it there. With comm given, the table is built on root only and
+    broadcast to all processes.
+    """
+    comm = kwarg.pop('comm', None)
+    t_max = kwarg.get('t_max', 80*3600.)
+    rank = 0 if comm is None else comm.Get_rank()
+
+    table = None
+    if rank == 0:
+        if os.path.isfile(file_name):
+            data = np.load(file_name)
+            # tables without the two-phase error estimate are rebuilt
+            if np.allclose([data['kf'], data['kt'], data['kb']], [kf, kt, kb], rtol=1e-12, atol=0) \
+                    and data['t_max'] >= t_max and 'max_two_phase_error' in data.files:
+                table = {key: data[key] for key in data.files}
+        if table is None:
+            table = build_cell_death_table(kf, kt, kb, **kwarg)
+            np.savez(file_name, **table)
+    if comm is not None:
+        table = comm.bcast(table, root=0)
+    return table
+
+
+#%%
+def tabulated_cell_death(table, dead, toxic, hypo, duration, **kwarg):
+    """
+    Same as integrate_cell_death with the solution interpolated from table.
+    Cells outside the range of the table (duration > t_max or toxic above the
+    toxic grid) are integrated in time (rate_step passed on).
+    """
+    dead = np.array(dead, dtype=float)
+    toxic = np.array(toxic, dtype=float)
+    hypo = np.clip(np.asarray(hypo, dtype=float), 0, 1)
+    duration = np.broadcast_to(np.asarray(duration, dtype=float), dead.shape)
+    if len(dead) == 0:
+        return dead, toxic
+
+    t = np.maximum(duration, 0)
+    outside = (t > table['time_grid'][-1]) | (toxic > table['toxic_grid'][-1]) | (toxic < 0)
+    zero = (dead == 0) & (toxic == 0) & ~(t > table['time_zero'][-1])
+    other = ~zero & ~outside
+
+    dead_new, toxic_new = dead.copy(), toxic.copy()
+    if zero.any():
+        points = np.stack([hypo[zero], t[zero]], axis=1)
+        grid = (table['hypo_zero'], table['time_zero'])
+        dead_new[zero] = RegularGridInterpolator(grid, table['dead_zero'])(points)
+        toxic_new[zero] = RegularGridInterpolator(grid, table['toxic_zero'])(points)
+    if other.any():
+        alive = np.clip(1-dead[other], 0, 1)
+        points = np.stack([hypo[other], alive, toxic[other], t[other]], axis=1)
+        grid = (table['hypo_grid'], table['alive_grid'], table['toxic_grid'], table['time_grid'])
+        dead_new[other] = 1-alive*RegularGridInterpolator(grid, table['alive_ratio'])(points)
+        toxic_new[other] = RegularGridInterpolator(grid, table['toxic'])(points)
+    outside &= ~zero
+    if outside.any():
+        dead_new[outside], toxic_new[outside] = integrate_cell_death(
+            dead[outside], toxic[outside], hypo[outside], t[outside],
+            table['kf'], table['kt'], table['kb'], **kwarg)
+    return dead_new, toxic_new
@@ -20,7 +20,6 @@ Yidan Xue - 2021/11
 """
 from dolfin import *
 import scipy.interpolate
-from scipy.integrate import odeint
 import numpy as np
 import yaml
 import time
@@ -29,6 +28,7 @@ import sys
 # added module
 import IO_fcts
 import finite_element_fcts as fe_mod
+import cell_death_fcts
 
 # define MPI variables
 comm = MPI.comm_world
@@ -86,13 +86,9 @@ core_threshold = configs['parameter']['core_threshold']
 
 # define the relationship between hypoxic fraction and perfusion - based on Green's function simulations
 def hypoxia_estimate(perfusion):
-    return 1-1/(1+np.exp(-(ks1*perfusion+ks2)))
+    return cell_death_fcts.hypoxia_estimate(perfusion, ks1, ks2)
 
-# define the ODE for cell death, h[0] - dead, h[1] - toxic, h[2] - hypoxic fraction
-def cell_death(h, t):
-    a = 1 - h[0]
-    hypo = h[2]
-    return [a*kf*h[1], a*kt*hypo-kb*h[1]*(1-hypo)*a, 0]
+# the ODE for cell death (dead, toxic, hypoxic fraction) is solved in cell_death_fcts
 
 if rank == 0:
     print('Step 2: Reading perfusion files')
@@ -130,51 +126,60 @@ dead_vec = dead.vector().get_local()
 toxic = Function(K2_space)
 toxic_vec = toxic.vector().get_local()
 
-# initialise the ODEs
-# before treatment - time in seconds now
-t_b = np.linspace(0,arrival_time*3600,2)
-# after treatment - time in seconds now
-t_a = np.linspace(0,recovery_time*3600,2)
+# cell volumes are computed once for the core volume
+cell_volumes = cell_death_fcts.comp_cell_volumes(mesh)
 
 start1 = time.time()
-core = 0
-# for grey matter
-for i in range(num_gm_idx):
-    # if the change in perfusion is smaller than 5% - no cell death
-    if (perfusion_healthy_vec[gm_idx[i]]-perfusion_stroke_vec[gm_idx[i]])/perfusion_healthy_vec[gm_idx[i]] < 0.05:
-        dead_vec[gm_idx[i]] = 0
-    # if the change is larger
-    else:
-        hi1 = [0,0,hypoxia_estimate(perfusion_stroke_vec[gm_idx[i]])] # first input: after onset
-        hs = odeint(cell_death, hi1, t_b)
-        Dead = hs[-1,0]
-        Toxic = hs[-1,1]
-        hi2 = [Dead,Toxic,hypoxia_estimate(perfusion_treatment_vec[gm_idx[i]])] # second input: after treatment
-        hs = odeint(cell_death, hi2, t_a)
-        dead_vec[gm_idx[i]] = hs[-1,0]
-        # core volume
-        if dead_vec[gm_idx[i]] > core_threshold:
-            ID = int(gm_idx[i])
-            core = core + Cell(mesh, ID).volume()/1000
-
-# for white matter
-for i in range(num_wm_idx):
-    # if the change in perfusion is smaller than 5% - no cell death
-    if (perfusion_healthy_vec[wm_idx[i]]-perfusion_stroke_vec[wm_idx[i]])/perfusion_healthy_vec[wm_idx[i]] < 0.05:
-        dead_vec[wm_idx[i]] = 0
-    # if the change is larger
-    else:
-        hi1 = [0,0,hypoxia_estimate(perfusion_stroke_vec[wm_idx[i]]*perfusion_scale)] # first input: after onset
-        hs = odeint(cell_death, hi1, t_b)
-        Dead = hs[-1,0]
-        Toxic = hs[-1,1]
-        hi2 = [Dead,Toxic,hypoxia_estimate(perfusion_treatment_vec[wm_idx[i]]*perfusion_scale)] # second input: after treatment
-        hs = odeint(cell_death, hi2, t_a)
-        dead_vec[wm_idx[i]] = hs[-1,0]
-        # core volume
-        if dead_vec[wm_idx[i]] > core_threshold:
-            ID = int(wm_idx[i])
-            core = core + Cell(mesh, ID).volume()/1000
+# grey and white matter cells, white matter perfusion is scaled
+cell_idx = np.concatenate((gm_idx, wm_idx)).astype(int)
+scale = np.concatenate((np.ones(num_gm_idx), perfusion_scale*np.ones(num_wm_idx)))
+
+# if the change in perfusion is smaller than 5% - no cell death
+with np.errstate(divide='ignore', invalid='ignore'):
+    perfusion_drop = (perfusion_healthy_vec[cell_idx]-perfusion_stroke_vec[cell_idx])/perfusion_healthy_vec[cell_idx]
+affected = ~(perfusion_drop < 0.05)
+dead_vec[cell_idx[~affected]] = 0
+cell_idx, scale = cell_idx[affected], scale[affected]
+
+# solve the ODEs of all affected cells simultaneously (time in seconds)
+# the solution is interpolated from a table (computed once for kf, kt, kb) if 'ode_table' is given and its
+# estimated error of the dead fraction (one or two phases) does not exceed ode_table_tol
+use_ode_table = 'ode_table' in configs['parameter']
+if use_ode_table:
+    try:
+        ode_table_tol = configs['parameter']['ode_table_tol']
+    except KeyError:
+        ode_table_tol = 1e-2
+    ode_table = cell_death_fcts.load_cell_death_table(configs['parameter']['ode_table'], kf, kt, kb, comm=comm,
+                                                      t_max=max(arrival_time, recovery_time, 80)*3600)
+    table_error = max(float(ode_table['max_error']), float(ode_table['max_two_phase_error']))
+    use_ode_table = table_error <= ode_table_tol
+    if rank == 0:
+        print('Cell death table error estimate (max, 99th percentile):')
+        print('\t dead fraction, one phase:', float(ode_table['max_error']), float(ode_table['p99_error']))
+        print('\t toxic state, one phase:', float(ode_table['max_toxic_error']), float(ode_table['p99_toxic_error']))
+        print('\t dead fraction, two phases:', float(ode_table['max_two_phase_error']),
+              float(ode_table['p99_two_phase_error']))
+        if not use_ode_table:
+            print('Cell death table error above ode_table_tol (' + str(ode_table_tol) + '), integrating in time')
+if use_ode_table:
+    def cell_death(dead, toxic, hypo, duration):
+        return cell_death_fcts.tabulated_cell_death(ode_table, dead, toxic, hypo, duration)
+else:
+    def cell_death(dead, toxic, hypo, duration):
+        return cell_death_fcts.integrate_cell_death(dead, toxic, hypo, duration, kf, kt, kb)
+
+# first input: after onset, before treatment
+Dead, Toxic = cell_death(np.zeros(len(cell_idx)), np.zeros(len(cell_idx)),
+                         hypoxia_estimate(perfusion_stroke_vec[cell_idx]*scale), arrival_time*3600)
+# second input: after treatment
+Dead, Toxic = cell_death(Dead, Toxic, hypoxia_estimate(perfusion_treatment_vec[cell_idx]*scale), recovery_time*3600)
+dead_vec[cell_idx] = Dead
+toxic_vec[cell_idx] = Toxic
+
+# core volume
+core = cell_volumes[cell_idx[Dead > core_threshold]].sum()/1000
+core = MPI.sum(comm, core)
 
 end1 = time.time()
 dead.vector().set_local(dead_vec)
@@ -5,8 +5,11 @@ import time
 import sys
 import os
 from tqdm import tqdm
+import numpy as np
 
 import IO_fcts
+import cell_death_fcts
+import time_series_fcts
 
 # define MPI variables
 comm = MPI.comm_world
@@ -56,6 +59,22 @@ arrival_steps = int(arrival_time*3600/dt) if arrival_time > 0 else 0
 recovery_steps = int((recovery_time-arrival_time)*3600/dt) if recovery_time > arrival_time else 0
 total_steps = arrival_steps+recovery_steps
 simulation_time = total_steps*dt/3600
+
+# time stepping of the cell death model
+# 'explicit' - forward Euler per cell with NumPy (identical to the DG0 FEM system, which has a diagonal mass matrix)
+# 'rk4' - fourth order Runge-Kutta per cell with steps limited by tissue_rate_step (see cell_death_fcts),
+#         the time series is written at the same times but larger steps are taken without it
+# 'fem' - DG0 mixed finite element system solved with a Krylov solver
+try:
+    tissue_update = configs['parameter']['tissue_update']
+except KeyError:
+    tissue_update = 'explicit'
+try:
+    tissue_rate_step = configs['parameter']['tissue_rate_step']
+except KeyError:
+    tissue_rate_step = 0.5
+if tissue_update not in ['explicit', 'rk4', 'fem']:
+    raise Exception("tissue_update must be 'explicit', 'rk4' or 'fem'")
 if rank == 0:
     print('Step 2: Reading perfusion files')
 # load previous results
@@ -145,6 +164,26 @@ if configs['output']['time_series']:
     # file.write_checkpoint(H2, "Hypoxic fraction", 0, XDMFFile.Encoding.HDF5, False)
     file.close()
 
+# time series format: 'xdmf' (every step) or 'hdf5' (float32, compressed, every Nth changed step)
+try:
+    time_series_format = configs['output']['time_series_format']
+except KeyError:
+    time_series_format = 'xdmf'
+
+if configs['output']['time_series'] and time_series_format == 'hdf5':
+    try:
+        time_series_every = configs['output']['time_series_every']
+    except KeyError:
+        time_series_every = 1
+    try:
+        time_series_tol = configs['output']['time_series_tol']
+    except KeyError:
+        time_series_tol = 0
+    # a restarted simulation continues the time series
+    time_series_writer = time_series_fcts.TimeSeriesWriter(
+        configs['output']['res_fldr']+'time_series.h5', ['dead', 'toxic'],
+        every=time_series_every, change_tol=time_series_tol, append=total_time > 0)
+elif configs['output']['time_series']:
     dead_file = XDMFFile(configs['output']['res_fldr']+'dead.xdmf')
     toxic_file = XDMFFile(configs['output']['res_fldr']+'toxic.xdmf')
     # dead_file = File(configs['output']['res_fldr'] + 'time_series/dead.pvd')
@@ -179,30 +218,75 @@ F = (T_1 - T_n1) * t_1 * dx - dt_const*(a * kf_const * T_n2) * t_1 * dx + \
 a, L = lhs(F), rhs(F)
 T = Function(T_space)
 
-problem = LinearVariationalProblem(a, L, T)
-solver = LinearVariationalSolver(problem)
-solver.parameters["linear_solver"] = "bicgstab"
-solver.parameters["preconditioner"] = "amg"
+if tissue_update == 'fem':
+    problem = LinearVariationalProblem(a, L, T)
+    solver = LinearVariationalSolver(problem)
+    solver.parameters["linear_solver"] = "bicgstab"
+    solver.parameters["preconditioner"] = "amg"
+else:
+    # dead and toxic states are advanced cell by cell (DG0 dofs)
+    dead_fn, toxic_fn = Function(K2_space), Function(K2_space)
+    assign([dead_fn, toxic_fn], u_n)
+    dead_vec, toxic_vec = dead_fn.vector().get_local(), toxic_fn.vector().get_local()
+    H2_vec = H2.vector().get_local()
+
+
+def tissue_steps(n_steps, t):
+    """
+    Advance the dead and toxic states by n_steps time steps starting from t [s]
+    (the time series is written after every step). Returns the final time.
+    """
+    global dead_vec, toxic_vec
+    if tissue_update == 'rk4' and not configs['output']['time_series']:
+        # the whole interval at once with steps limited by the rate constants only
+        dead_vec, toxic_vec = cell_death_fcts.integrate_cell_death(
+            dead_vec, toxic_vec, H2_vec, n_steps*dt, kf, kt, kb, rate_step=tissue_rate_step)
+        return t + n_steps*dt
+
+    for n in tqdm(range(n_steps)):
+        t += dt
+
+        if tissue_update == 'fem':
+            solver.solve()
+            u_n.assign(T)
+        elif tissue_update == 'explicit':
+            # forward Euler with the previous state (the DG0 mass matrix is diagonal)
+            alive = 1 - dead_vec
+            dead_vec, toxic_vec = dead_vec + dt*alive*kf*toxic_vec, \
+                toxic_vec + dt*(alive*kt*H2_vec - kb*toxic_vec*(1-H2_vec)*alive)
+        else:
+            dead_vec, toxic_vec = cell_death_fcts.integrate_cell_death(
+                dead_vec, toxic_vec, H2_vec, dt, kf, kt, kb, rate_step=tissue_rate_step)
+
+        if configs['output']['time_series'] and time_series_format == 'hdf5':
+            time_series_writer.write(total_time+t/3600, tissue_state(deepcopy=True), force=(n == n_steps-1))
+        elif configs['output']['time_series']:
+            _u_1, _u_2 = tissue_state()
+            dead_file.write(_u_1, total_time+t/3600)
+            toxic_file.write(_u_2, total_time+t/3600)
+            # dead_file << (_u_1, total_time + t / 3600)
+            # toxic_file << (_u_2, total_time + t / 3600)
+        # dead_file.write_checkpoint(_u_1, "dead", n, XDMFFile.Encoding.HDF5, True)
+        # toxic_file.write_checkpoint(_u_2, "toxic", n, XDMFFile.Encoding.HDF5, True)
+    return t
+
+
+def tissue_state(deepcopy=False):
+    # dead and toxic functions of the current state
+    if tissue_update == 'fem':
+        return T.split(deepcopy=deepcopy)
+    dead_fn.vector().set_local(dead_vec)
+    dead_fn.vector().apply('insert')
+    toxic_fn.vector().set_local(toxic_vec)
+    toxic_fn.vector().apply('insert')
+    return dead_fn, toxic_fn
+
 
 start1 = time.time()
 # arrival simulation
-t = 0
-for n in tqdm(range(arrival_steps)):
-    t += dt
-
-    solver.solve()
-    u_n.assign(T)
-
-    if configs['output']['time_series']:
-        _u_1, _u_2 = T.split()
-        dead_file.write(_u_1, total_time+t/3600)
-        toxic_file.write(_u_2, total_time+t/3600)
-        # dead_file << (_u_1, total_time + t / 3600)
-        # toxic_file << (_u_2, total_time + t / 3600)
-    # dead_file.write_checkpoint(_u_1, "dead", n, XDMFFile.Encoding.HDF5, True)
-    # toxic_file.write_checkpoint(_u_2, "toxic", n, XDMFFile.Encoding.HDF5, True)
-
-dead, toxic = T.split()
+t = tissue_steps(arrival_steps, 0)
+
+dead, toxic = tissue_state()
 infarct = project(conditional(lt(dead, Constant(core_threshold)), Constant(0.0), Constant(1.0)), K2_space,
                   solver_type='bicgstab', preconditioner_type='amg')
 core = assemble(infarct * dx) * 1e-3  # mL
@@ -214,27 +298,18 @@ if recovery_steps > 0:
     hypoxia_estimate_fem = 1-1/(1+(exp(-(ks1*perfusion_treatment*scaling+ks2)))**2)
     H2_new = project(hypoxia_estimate_fem, tissue_space, solver_type='bicgstab', preconditioner_type='amg')
     H2.assign(H2_new)
+    if tissue_update != 'fem':
+        H2_vec = H2.vector().get_local()
 
     # recovery simulation
-    for n in tqdm(range(recovery_steps)):
-        t += dt
-
-        solver.solve()
-        u_n.assign(T)
+    t = tissue_steps(recovery_steps, t)
 
-        if configs['output']['time_series']:
-            _u_1, _u_2 = T.split()
-            dead_file.write(_u_1, total_time+t/3600)
-            toxic_file.write(_u_2, total_time+t/3600)
-            # dead_file << (_u_1, total_time + t / 3600)
-            # toxic_file << (_u_2, total_time + t / 3600)
-
-        # dead_file.write_checkpoint(_u_1, "dead", n, XDMFFile.Encoding.HDF5, True)
-        # toxic_file.write_checkpoint(_u_2, "toxic", n, XDMFFile.Encoding.HDF5, True)
-
-dead, toxic = T.split()
+dead, toxic = tissue_state()
 end1 = time.time()
 
+if configs['output']['time_series'] and time_series_format == 'hdf5':
+    time_series_writer.close()
+
 infarct = project(conditional(lt(dead, Constant(core_threshold)), Constant(0.0), Constant(1.0)), K2_space,
                   solver_type='bicgstab', preconditioner_type='amg')
 core = assemble(infarct * dx) * 1e-3  # mL
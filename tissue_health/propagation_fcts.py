@@ -0,0 +1,222 @@
+"""
+Tissue health model with vulnerability propagation evaluated on images
+
+infarct - dead fraction
+toxin - toxic state
+vulnerable - vulnerability index (constant during a cell death step)
+
+d(infarct)/dt = kf*(1-infarct)*toxin  (if toxin > Td, otherwise 0)
+d(toxin)/dt   = kt*vulnerable*(1-toxin) - kc*(1-vulnerable)*(1-infarct)*toxin
+
+For a frozen alive fraction the toxic state relaxes exponentially, so each
+time step integrates it exactly (including the time spent above Td) and the
+alive fraction is updated with the resulting toxin integral. Freezing the
+alive fraction at the predicted mid-step value makes the scheme second order
+accurate with time steps limited by kf only (not by the fast kc).
+
+The vulnerability index propagates from voxels with toxin > Tp to their six
+neighbours (multiplied by kd) with shifted array maximums; the image borders
+are not periodic.
+
+Time stepping can use the dense engine (every vulnerable or toxic voxel of
+the brain in each step) or the frontier engine, which only touches voxels
+whose state can still change:
+- voxels are retired from the active set once the toxic state reached its
+  equilibrium and the dead fraction cannot change any more (within tol);
+- voxels whose vulnerability index increases are marked dirty and
+  reactivated;
+- the vulnerability index only increases, so a voxel propagates when it
+  becomes a source (toxin > Tp) or its index increases;
+- stepping stops early when both sets are empty.
+Its cost is thus proportional to the lesion size rather than the image size.
+"""
+import numpy as np
+
+
+#%%
+def toxin_relaxation(alive, vulnerable, kt, kc):
+    # equilibrium toxic state and relaxation rate for a frozen alive fraction
+    rate = kt*vulnerable + kc*(1-vulnerable)*alive
+    toxin_eq = kt*vulnerable/np.where(rate > 0, rate, 1)
+    return toxin_eq, rate
+
+
+#%%
+def toxin_step(toxin, toxin_eq, rate, dt, Td):
+    """
+    Toxic state after dt of exponential relaxation towards toxin_eq and the
+    time integral of the toxic state over the part of the step above Td.
+    """
+    safe_rate = np.where(rate > 0, rate, 1)
+
+    def toxin_integral(s):
+        # integral of the toxic state over [0,s]
+        return toxin_eq*s + (toxin-toxin_eq)*np.where(rate > 0, -np.expm1(-rate*s)/safe_rate, s)
+
+    toxin_new = toxin_eq + (toxin-toxin_eq)*np.exp(-rate*dt)
+
+    # the relaxation is monotone, so Td is crossed at most once
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s_cross = np.log((toxin-toxin_eq)/(Td-toxin_eq))/safe_rate
+    s_cross = np.clip(np.nan_to_num(s_cross, nan=0, posinf=dt, neginf=0), 0, dt)
+
+    above_start, above_end = toxin > Td, toxin_new > Td
+    integral = np.zeros_like(toxin_new)
+    both = above_start & above_end
+    integral[both] = toxin_integral(dt)[both]
+    leaves = above_start & ~above_end
+    integral[leaves] = toxin_integral(s_cross)[leaves]
+    enters = ~above_start & above_end
+    integral[enters] = (toxin_integral(dt)-toxin_integral(s_cross))[enters]
+    return toxin_new, integral
+
+
+#%%
+def advance_cell_death(infarct, toxin, vulnerable, duration, kf, kt, kc, Td, **kwarg):
+    """
+    Advance the dead fraction and toxic state of every voxel (arrays of equal
+    length) over duration [s] with constant vulnerability indices. The time
+    step does not exceed time_step [s] (default 60).
+    """
+    time_step = kwarg.get('time_step', 60.)
+
+    alive = 1-np.array(infarct, dtype=float)
+    toxin = np.array(toxin, dtype=float)
+    vulnerable = np.asarray(vulnerable, dtype=float)
+    if duration <= 0 or len(alive) == 0:
+        return 1-alive, toxin
+
+    n_steps = max(int(np.ceil(duration/time_step)), 1)
+    dt = duration/n_steps
+    for step in range(n_steps):
+        # predictor with the alive fraction at the start of the step
+        toxin_eq, rate = toxin_relaxation(alive, vulnerable, kt, kc)
+        toxin_pred, integral = toxin_step(toxin, toxin_eq, rate, dt, Td)
+        alive_pred = alive*np.exp(-kf*integral)
+        # corrector with the mid-step alive fraction
+        toxin_eq, rate = toxin_relaxation((alive+alive_pred)/2, vulnerable, kt, kc)
+        toxin, integral = toxin_step(toxin, toxin_eq, rate, dt, Td)
+        alive = alive*np.exp(-kf*integral)
+    return 1-alive, toxin
+
+
+#%%
+def neighbour_max(field):
+    # maximum of the six face neighbours of every voxel (zero outside the image)
+    nb_max = np.zeros_like(field)
+    for axis in range(field.ndim):
+        lo = [slice(None)]*field.ndim
+        hi = [slice(None)]*field.ndim
+        lo[axis], hi[axis] = slice(None, -1), slice(1, None)
+        lo, hi = tuple(lo), tuple(hi)
+        np.maximum(nb_max[lo], field[hi], out=nb_max[lo])
+        np.maximum(nb_max[hi], field[lo], out=nb_max[hi])
+    return nb_max
+
+
+#%%
+def propagate_vulnerability(vulnerable, toxin, brain_region, kd, Tp):
+    """
+    Vulnerability index after one propagation step: voxels of the brain take
+    the maximum of their own index and kd times the index of neighbours with
+    toxin > Tp.
+    """
+    source = brain_region & (toxin > Tp)
+    spread = neighbour_max(np.where(source, vulnerable*kd, 0))
+    return np.where(brain_region, np.maximum(vulnerable, spread), vulnerable)
+
+
+#%%
+def face_neighbours(idx, shape):
+    """
+    Flat indices of the face neighbours (inside the image) of the voxels with
+    flat indices idx. Returns the position in idx and the neighbour index.
+    """
+    ijk = np.unravel_index(idx, shape)
+    strides = np.cumprod((shape[1:]+(1,))[::-1])[::-1]
+    pos, nb = [], []
+    for axis in range(len(shape)):
+        for step in [-1, 1]:
+            inside = np.flatnonzero((ijk[axis]+step >= 0) & (ijk[axis]+step < shape[axis]))
+            pos.append(inside)
+            nb.append(idx[inside]+step*strides[axis])
+    return np.concatenate(pos), np.concatenate(nb)
+
+
+#%%
+def converged_voxels(infarct, toxin, vulnerable, kt, kc, Td, tol):
+    # voxels where neither the toxic state nor the dead fraction change any more
+    alive = 1-infarct
+    toxin_eq = toxin_relaxation(alive, vulnerable, kt, kc)[0]
+    no_death = ((toxin <= Td) & (toxin_eq <= Td)) | (alive <= tol)
+    return (abs(toxin-toxin_eq) <= tol) & no_death
+
+
+#%%
+def cell_death_steps(infarct, toxin, vulnerable, brain_region, n_steps, duration,
+                     kf, kt, kc, kd, Td, Tp, **kwarg):
+    """
+    Perform n_steps steps of duration [s], each solving the cell death model
+    and then propagating the vulnerability index (if propagate, default True).
+    The images infarct, toxin and vulnerable are updated in place. The engine
+    is 'frontier' (default) or 'dense', tol is the retirement tolerance of the
+    frontier engine (default 1e-6). Returns the number of performed steps
+    (smaller than n_steps if the frontier engine converged).
+    """
+    engine = kwarg.get('engine', 'frontier')
+    propagate = kwarg.get('propagate', True)
+    tol = kwarg.get('tol', 1e-6)
+    time_step = kwarg.get('time_step', 60.)
+
+    if engine == 'dense':
+        for n in range(n_steps):
+            active = np.flatnonzero(brain_region & ((vulnerable > 0) | (toxin > 0)))
+            infarct.flat[active], toxin.flat[active] = advance_cell_death(
+                infarct.flat[active], toxin.flat[active], vulnerable.flat[active],
+                duration, kf, kt, kc, Td, time_step=time_step)
+            if propagate:
+                vulnerable[...] = propagate_vulnerability(vulnerable, toxin, brain_region, kd, Tp)
+        return n_steps
+    elif engine != 'frontier':
+        raise Exception("engine must be 'frontier' or 'dense'")
+
+    shape = infarct.shape
+    brain_flat = brain_region.ravel()
+    infarct_flat, toxin_flat, vulnerable_flat = infarct.reshape(-1), toxin.reshape(-1), vulnerable.reshape(-1)
+    if not all(np.shares_memory(a, b) for a, b in [(infarct, infarct_flat), (toxin, toxin_flat),
+                                                     (vulnerable, vulnerable_flat)]):
+        raise Exception('infarct, toxin and vulnerable must be contiguous arrays')
+
+    # active voxels and propagation frontier (current sources)
+    active = np.flatnonzero(brain_flat & ((vulnerable_flat > 0) | (toxin_flat > 0)))
+    frontier = np.flatnonzero(brain_flat & (toxin_flat > Tp))
+    for n in range(n_steps):
+        if len(active) == 0 and len(frontier) == 0:
+            return n
+
+        # cell death model of the active voxels
+        was_source = toxin_flat[active] > Tp
+        infarct_flat[active], toxin_flat[active] = advance_cell_death(
+            infarct_flat[active], toxin_flat[active], vulnerable_flat[active],
+            duration, kf, kt, kc, Td, time_step=time_step)
+        new_sources = active[~was_source & (toxin_flat[active] > Tp)]
+        active = active[~converged_voxels(infarct_flat[active], toxin_flat[active],
+                                          vulnerable_flat[active], kt, kc, Td, tol)]
+        if not propagate:
+            frontier = np.zeros(0, dtype=np.int64)
+            continue
+
+        # propagation from the frontier, values are taken before the update
+        frontier = np.union1d(frontier, new_sources)
+        frontier = frontier[toxin_flat[frontier] > Tp]
+        pos, nb = face_neighbours(frontier, shape)
+        keep = brain_flat[nb]
+        pos, nb = pos[keep], nb[keep]
+        value = vulnerable_flat[frontier[pos]]*kd
+        old = vulnerable_flat[nb]
+        np.maximum.at(vulnerable_flat, nb, value)
+        # voxels with increased index are reactivated and propagate in the next step
+        dirty = np.unique(nb[vulnerable_flat[nb] > old])
+        active = np.union1d(active, dirty)
+        frontier = dirty
+    return n_steps
@@ -111,16 +111,20 @@ def comp_vessel_orientation(subdomains,boundaries,mesh,res_fldr,save_subres):
     if fe_degr > 1:
         e = interpolate(e,Ve_DG)
     
-    e_array = e.vector().get_local()
-    for i in range(int(len(e_array)/3)):
-        e_array[i*3:(i+1)*3] = e_array[i*3:(i+1)*3]/np.linalg.norm(e_array[i*3:(i+1)*3])
-    e.vector().set_local(e_array)
-    
+    # normalise cell-wise vectors, shape (N,3)
+    e_array = e.vector().get_local().reshape((-1,3))
+    e_norm = np.linalg.norm(e_array,axis=1)
+    e_array = e_array/np.where(e_norm>0,e_norm,1)[:,np.newaxis]
+    e.vector().set_local(e_array.reshape(-1))
+    
+    # first component with |e_i| >= 1/sqrt(3), the largest component if
+    # round-off leaves every component just below the limit
+    e_abs = abs(e_array)
+    main_comp = e_abs>=np.sqrt(1/3)
     main_direction = Function(Vdir)
-    main_direction_array = main_direction.vector().get_local()
-    for i in range(int(len(e_array)/3)):
-        main_direction_array[i] = np.where(abs(e_array[i*3:(i+1)*3])>=np.sqrt(1/3))[0][0]
-    main_direction.vector().set_local(main_direction_array)
+    main_direction.vector().set_local( np.where(main_comp.any(axis=1),
+                                                main_comp.argmax(axis=1),
+                                                e_abs.argmax(axis=1)).astype(float) )
     
     e.rename("e","normalised penetrating vessel axis direction")
     main_direction.rename("main_direction","main direction of penetrating vessel axes")
@@ -134,17 +138,13 @@ def perm_tens_comp(K_space,subdomains,mesh,e_ref,e_loc,K1_form):
     K1 = Function(K_space)    
     K1_array = K1.vector().get_local()
     
-    e_loc_array = e_loc.vector().get_local()
+    e_loc_array = e_loc.vector().get_local().reshape((-1,3))
     
-    for i in range(mesh.num_cells()):
-        e1 = e_loc_array[i*3:i*3+3]
-        T = comp_transf_mat(e_ref,e1)
-        
-        # rotate local permeability tensor
-        K1_loc = np.reshape( np.matmul(np.matmul(T,K1_form),T.transpose()),9 )
-        
-        # set local permeability tensor
-        K1_array[i*9:i*9+9] = K1_loc
+    # transformation matrices of every cell, shape (N,3,3)
+    T = comp_transf_mat_batch(e_ref,e_loc_array)
+    
+    # rotate local permeability tensors: T K1_form T^T
+    K1_array[:] = np.einsum('nij,jk,nlk->nil',T,np.asarray(K1_form,dtype=float),T).reshape(-1)
     
     tolerance = 1e-9
     mask = abs(K1_array) < tolerance
@@ -243,6 +243,37 @@ def comp_transf_mat(e0,e1):
     return T
 
 
+#%%
+def comp_transf_mat_batch(e0,e1):
+    # batched version of comp_transf_mat: rotation matrices taking e0 into
+    # every row of e1 (shape (N,3)), returned as an array of shape (N,3,3)
+    e0 = np.asarray(e0,dtype=float)
+    e0 = e0/np.linalg.norm(e0)
+    e1 = np.asarray(e1,dtype=float).reshape((-1,3))
+    norm = np.linalg.norm(e1,axis=1)
+    e1 = np.where(norm[:,np.newaxis]>0, e1/np.where(norm>0,norm,1)[:,np.newaxis], e0)
+    
+    v = np.cross(e0,e1) # rotation axis scaled by the sine
+    c = e1.dot(e0) # cosine
+    vx = np.zeros((len(e1),3,3))
+    vx[:,0,1], vx[:,0,2], vx[:,1,2] = -v[:,2], v[:,1], -v[:,0]
+    vx[:,1,0], vx[:,2,0], vx[:,2,1] = v[:,2], -v[:,1], v[:,0]
+    
+    # Rodrigues' formula with (1-c)/s^2 = 1/(1+c), i.e. without dividing by the
+    # sine, which vanishes for e1 = e0 (T = I)
+    antiparallel = c < -1 + 1e-9
+    scale = 1/np.where(antiparallel,1,1+c)
+    T = c[:,np.newaxis,np.newaxis]*np.identity(3) + vx \
+        + scale[:,np.newaxis,np.newaxis]*np.einsum('ni,nj->nij',v,v)
+    
+    # e1 = -e0: rotation by pi around an axis normal to e0
+    if antiparallel.any():
+        u = np.cross(e0,np.identity(3)[np.argmin(abs(e0))])
+        u = u/np.linalg.norm(u)
+        T[antiparallel] = 2*np.tensordot(u,u,axes=0) - np.identity(3)
+    return T
+
+
 #%%
 def perm_tens_comp_old(K_space,subdomains,mesh,e0,K1_ref,K2_ref,K3_ref,pial_surf_file):
     # function spaces for permeability tensors
@@ -464,53 +495,28 @@ def vol_ave(mesh,subdomains,ps,vels):
 
 
 #%%
+# labels of every MeshFunction passed to region_label_assembler (the MeshFunction
+# is kept in the registry so that its id cannot be reused by another object)
+region_label_registry = {}
+
+
 def region_label_assembler(region):
     # in parallel region labels might be distributed between cores
     # this function assembles labels and distributes the corresponding array to each processor
-    
-    comm = MPI.comm_world
-    rank = comm.Get_rank()
-    size = comm.Get_size()
-    root = 0
-    
-    region_labels = region.array()
     # 0: interior face, 1: brain stem cut plane,
     # 2: ventricular surface, 2+: brain surface
     
-    # STEP 0: collect total array of region labels on root
-    sendbuf = region_labels
-    # Collect local array sizes using the high-level mpi4py gather
-    sendcounts = np.array(comm.gather(len(sendbuf), root))
-    
-    if rank == root:
-        # print("sendcounts: {}, total: {}".format(sendcounts, sum(sendcounts)))
-        recvbuf = np.empty(sum(sendcounts), dtype=int)
-    else:
-        recvbuf = None
-    comm.Gatherv(sendbuf=sendbuf, recvbuf=(recvbuf, sendcounts), root=root)
-    
-    # STEP 1: broadcast total array of region labels from root
-    if rank == root:
-        # print("Gathered array: {}".format(recvbuf))
-        # print(len(recvbuf),len(set(recvbuf)))
-        recvbuf = np.array(list(set(recvbuf)))
-        n_labels = np.array([len(recvbuf)])
-    else:
-        n_labels = np.array([0])
-    comm.Bcast(n_labels, root=root)
-    # print(rank,n_labels)
-    
-    if rank == root:
-        region_labels=recvbuf
-    else:
-        region_labels=np.zeros(n_labels[0],dtype=int)
-    comm.Bcast(region_labels, root=0)
+    key = region.id()
+    if key not in region_label_registry:
+        comm = MPI.comm_world
+        
+        # union of the (few) local labels of every process
+        local_labels = np.unique(region.array()).astype(int)
+        region_labels = np.unique(np.concatenate(comm.allgather(local_labels))).astype(int)
+        region_label_registry[key] = (region, region_labels)
     
-    # if rank==root:
-    #     print('\n\n TEST ARRAY \n\n')
-    # print(rank,region_labels)
-
-    n_labels = n_labels[0]
+    region_labels = region_label_registry[key][1].copy()
+    n_labels = len(region_labels)
     
     return region_labels, n_labels
     
@@ -0,0 +1,161 @@
+"""
+Compressed time series of finite element fields (e.g. dead and toxic states)
+
+Every variable is stored in a single HDF5 (PyTables) array with a time axis:
+- shape (number of written times, number of global dofs), float32;
+- one chunk per time and block of dofs, compressed with zlib (shuffled);
+- the times are stored in a separate array.
+The PETSc dof order depends on the mesh partitioning, so values are
+gathered on root and stored in the order of a partition independent key
+(global cell index and local dof number of the cell). Frames can thus be
+appended and read back (lazily, only the required chunks are decompressed)
+on any number of processes for the same mesh and a cell-wise (DG) space.
+
+Frames can be written every Nth step only and frames identical (within a
+tolerance) to the last written one are skipped.
+"""
+from dolfin import *
+import numpy as np
+import tables
+import os
+
+
+#%%
+def dof_keys(V):
+    """
+    Partition independent keys of the dofs owned by the process (global cell
+    index * dofs per cell + local dof number in the cell). Only spaces where
+    every dof belongs to a single cell (DG) have such keys.
+    """
+    dofmap = V.dofmap()
+    n_cell_dofs = dofmap.max_element_dofs()
+    lo, hi = dofmap.ownership_range()
+    keys = np.full(hi-lo, -1, dtype=np.int64)
+    count = np.zeros(hi-lo, dtype=np.int64)
+    for cell in cells(V.mesh()):
+        dofs = dofmap.cell_dofs(cell.index())
+        owned = np.flatnonzero(dofs < hi-lo)
+        keys[dofs[owned]] = cell.global_index()*n_cell_dofs + owned
+        count[dofs[owned]] += 1
+    if MPI.max(MPI.comm_world, int((count != 1).any())) > 0:
+        raise Exception('time series require a cell-wise (DG) function space')
+    return keys
+
+
+#%%
+class TimeSeriesWriter:
+    """
+    Writer of the time series of the given variables (list of names). The
+    options are:
+        every - only every Nth call of write() is stored (default 1)
+        change_tol - frames with max. change below it are skipped (default 0)
+        complevel - zlib compression level (default 4)
+        chunk_size - number of dofs per chunk (default 2**18)
+        append - continue an existing file (e.g. restart), default False
+    """
+    def __init__(self, file_name, variables, **kwarg):
+        self.file_name = file_name
+        self.variables = list(variables)
+        self.every = kwarg.get('every', 1)
+        self.change_tol = kwarg.get('change_tol', 0)
+        self.complevel = kwarg.get('complevel', 4)
+        self.chunk_size = kwarg.get('chunk_size', 2**18)
+        self.append = kwarg.get('append', False)
+
+        self.comm = MPI.comm_world
+        self.rank = self.comm.Get_rank()
+        self.keys = None
+        self.n_calls = 0
+        self.last = {}
+        self.h5 = None
+        if self.rank == 0 and self.append and os.path.isfile(file_name):
+            self.h5 = tables.open_file(file_name, mode='a')
+            for name in self.variables:
+                if len(self.h5.root.time) > 0:
+                    self.last[name] = self.h5.get_node('/', name)[-1]
+
+    def _create(self, n_dofs):
+        # arrays are created at the first write when the number of dofs is known
+        self.h5 = tables.open_file(self.file_name, mode='w')
+        filters = tables.Filters(complevel=self.complevel, complib='zlib', shuffle=True)
+        self.h5.create_earray(self.h5.root, 'time', atom=tables.Float64Atom(), shape=(0,))
+        for name in self.variables:
+            self.h5.create_earray(self.h5.root, name, atom=tables.Float32Atom(), shape=(0, n_dofs),
+                                  chunkshape=(1, min(n_dofs, self.chunk_size)), filters=filters)
+
+    def write(self, t, functions, **kwarg):
+        """
+        Store the functions (same order as the variables) at time t. Must be
+        called on every process. With force=True the frame is written
+        regardless of every and change_tol (e.g. last step).
+        """
+        force = kwarg.get('force', False)
+        self.n_calls += 1
+        if not force and self.n_calls % self.every != 0:
+            return False
+
+        # global vectors on root in key order (collective)
+        if self.keys is None:
+            self.keys = dof_keys(functions[0].function_space())
+        all_keys = self.comm.gather(self.keys, root=0)
+        all_values = [self.comm.gather(f.vector().get_local(), root=0) for f in functions]
+        if self.rank != 0:
+            return True
+        all_keys = np.concatenate(all_keys)
+        values = []
+        for v in all_values:
+            ordered = np.empty(len(all_keys), dtype=np.float32)
+            ordered[all_keys] = np.concatenate(v)
+            values.append(ordered)
+
+        if not force and len(self.last) == len(self.variables):
+            change = max(abs(v-self.last[name]).max() for name, v in zip(self.variables, values))
+            if change <= self.change_tol:
+                return False
+
+        if self.h5 is None:
+            self._create(len(values[0]))
+        for name, v in zip(self.variables, values):
+            self.h5.get_node('/', name).append(v[np.newaxis, :])
+            self.last[name] = v
+        self.h5.root.time.append(np.array([t], dtype=float))
+        self.h5.flush()
+        return True
+
+    def close(self):
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+
+#%%
+def time_series_times(file_name):
+    # times stored in the time series file
+    with tables.open_file(file_name, mode='r') as h5:
+        return h5.root.time[:]
+
+
+#%%
+def read_time_series(file_name, variable, t, **kwarg):
+    """
+    Values of variable at the last stored time not later than t (key order,
+    see dof_keys). If function is given, its (local) vector is set as well.
+    The file is read on root only and broadcast when function is given.
+    """
+    function = kwarg.get('function', None)
+    comm = MPI.comm_world
+
+    values = None
+    if comm.Get_rank() == 0:
+        with tables.open_file(file_name, mode='r') as h5:
+            times = h5.root.time[:]
+            idx = np.searchsorted(times, t, side='right')-1
+            if idx < 0:
+                raise Exception('no stored time before ' + str(t) + ' in ' + file_name)
+            values = np.float64(h5.get_node('/', variable)[idx])
+
+    if function is not None:
+        values = comm.bcast(values, root=0)
+        function.vector().set_local(values[dof_keys(function.function_space())])
+        function.vector().apply('insert')
+    return values
@@ -12,17 +12,22 @@ import time
 import yaml
 import numpy as np
 import os
+import sys
 import copy
 from nibabel.testing import data_path
 import nibabel as nib
 import matplotlib.pyplot as plt
 import pandas as pd
-from scipy.integrate import odeint
 import multiprocessing
 
 # added module
 import IO_fcts
 import finite_element_fcts as fe_mod
+import propagation_fcts
+
+# define MPI variables
+comm = MPI.comm_world
+rank = comm.Get_rank()
 
 start0 = time.time()
 
@@ -51,19 +56,18 @@ res_fldr = configs['output']['res_fldr']
 kf,kt,kc,kd = configs['parameter']['kf'],configs['parameter']['kt'],configs['parameter']['kc'],configs['parameter']['kd']
 Td,Tp = configs['parameter']['Td'],configs['parameter']['Tp']
 
-# define the ODE for cell death, h[0] - dead, h[1] - toxic, h[2] - vulnerable index
-def cell_death(x,t):
-	D,T,V = x
-	A = 1-D
-
-	if T>Td:
-		dDdt = kf*A*T
-	else:
-		dDdt = 0
-	dTdt = kt*V*(1-T)-kc*(1-V)*A*T
+# time stepping engine: 'frontier' (only voxels whose state can still change) or 'dense'
+try:
+    engine = configs['simulation']['engine']
+except KeyError:
+    engine = 'frontier'
+try:
+    frontier_tol = configs['simulation']['frontier_tol']
+except KeyError:
+    frontier_tol = 1e-6
 
-	dxdt = [dDdt, dTdt, 0]
-	return dxdt
+# the ODE for cell death (dead, toxic, vulnerable index) and the vulnerability propagation
+# are solved for all voxels at once in propagation_fcts
 
 # %% READ PERFUSION
 if rank == 0: 
@@ -87,15 +91,17 @@ img_t = nib.load(treatmentfile)
 img_t = img_t.get_fdata()
 
 # compute the relative perfusion
-rel_perf = img_o/img_h
+with np.errstate(divide='ignore', invalid='ignore'):
+    rel_perf = img_o/img_h
 rel_perf[np.isnan(rel_perf)] = 0
 
 # mask the brain region and initialise the model
-brain_region = np.int32(img_h > 0)
+brain_region = img_h > 0
 nx,ny,nz = rel_perf.shape
 
 # compute the relative perfusion after treatment
-rel_perf_t = img_t/img_h
+with np.errstate(divide='ignore', invalid='ignore'):
+    rel_perf_t = img_t/img_h
 rel_perf_t[np.isnan(rel_perf_t)] = 0
 
 # %% RUN CELL DEATH MODEL
@@ -107,87 +113,28 @@ start1 = time.time()
 # BEFORE TREATMENT
 
 dt = 30 # min
-t = np.linspace(0,dt*60,int(dt*12+1))
 num_iter_arrival = int(arrival_time*60/dt)
 
 infarct = np.zeros([nx,ny,nz])
 toxin = np.zeros([nx,ny,nz])
-vulnerable = np.zeros([nx,ny,nz])
 
 # initialise vulnerable index
-for i in range(nx):
-	for j in range(ny):
-		for k in range(nz):
-			if brain_region[i,j,k]!=0:
-				if rel_perf[i,j,k]<1:
-					vulnerable[i,j,k] = 1-rel_perf[i,j,k]
-
-for n in range(num_iter_arrival):
-
-	# define an array to update vulnerable index
-	vulnerable_new = np.zeros([nx,ny,nz])
-
-	# run cell death model first
-	for i in range(nx):
-		for j in range(ny):
-			for k in range(nz):
-				if brain_region[i,j,k] != 0:
-					# just run cell death model for the progress region
-					# if vulnerable[i,j,k] > 0 and (infarct[i,j,k] <= 0.8 or toxin[i,j,k] <= Tp):
-					# 	hi = [infarct[i,j,k],toxin[i,j,k],vulnerable[i,j,k]]
-					# 	hs = odeint(cell_death, hi, t)
-					# 	infarct[i,j,k] = hs[-1,0]
-					# 	toxin[i,j,k] = hs[-1,1]
-					# or run for every pixel
-					hi = [infarct[i,j,k],toxin[i,j,k],vulnerable[i,j,k]]
-					hs = odeint(cell_death, hi, t)
-					infarct[i,j,k] = hs[-1,0]
-					toxin[i,j,k] = hs[-1,1]
-
-    # run the vulnerable index propagation
-	for i in range(nx):
-		for j in range(ny):
-			for k in range(nz):
-				if brain_region[i,j,k] != 0 and toxin[i,j,k]>Tp:
-					vulnerable_new[i+1,j,k] = max(vulnerable[i,j,k]*kd,vulnerable[i+1,j,k],vulnerable_new[i+1,j,k])
-					vulnerable_new[i-1,j,k] = max(vulnerable[i,j,k]*kd,vulnerable[i-1,j,k],vulnerable_new[i-1,j,k])	
-					vulnerable_new[i,j+1,k] = max(vulnerable[i,j,k]*kd,vulnerable[i,j+1,k],vulnerable_new[i,j+1,k])
-					vulnerable_new[i,j-1,k] = max(vulnerable[i,j,k]*kd,vulnerable[i,j-1,k],vulnerable_new[i,j-1,k])
-					vulnerable_new[i,j,k+1] = max(vulnerable[i,j,k]*kd,vulnerable[i,j,k+1],vulnerable_new[i,j,k+1])
-					vulnerable_new[i,j,k-1] = max(vulnerable[i,j,k]*kd,vulnerable[i,j,k-1],vulnerable_new[i,j,k-1])
-
-	# update the vulnerable index
-	for i in range(nx):
-		for j in range(ny):
-			for k in range(nz):
-				if brain_region[i,j,k] != 0 and vulnerable_new[i,j,k] != 0:
-					vulnerable[i,j,k] = vulnerable_new[i,j,k]	
+vulnerable = np.where(brain_region & (rel_perf < 1), 1-rel_perf, 0)
+
+# run cell death model first, then the vulnerable index propagation in each step
+num_iter_done = propagation_fcts.cell_death_steps(infarct, toxin, vulnerable, brain_region, num_iter_arrival, dt*60,
+                                                  kf, kt, kc, kd, Td, Tp, engine=engine, tol=frontier_tol)
+if rank == 0 and num_iter_done < num_iter_arrival:
+    print('Tissue state converged after ' + str(num_iter_done) + ' of ' + str(num_iter_arrival) + ' steps')
 
 # AFTER TREATMENT - assume successful treatment (vulnerability based on restored perfusion)
 
 # update vulnerable index
-
-vulnerable = np.zeros([nx,ny,nz])
-
-for i in range(nx):
-	for j in range(ny):
-		for k in range(nz):
-			if brain_region[i,j,k]!=0:
-				if rel_perf_t[i,j,k]<1:
-					vulnerable[i,j,k] = 1-rel_perf_t[i,j,k]
+vulnerable = np.where(brain_region & (rel_perf_t < 1), 1-rel_perf_t, 0)
 
 # run the cell death model again
-
-t = np.linspace(0,recovery_time*3600,int(recovery_time*60+1))
-
-for i in range(nx):
-	for j in range(ny):
-		for k in range(nz):
-			if brain_region[i,j,k] != 0:
-				hi = [infarct[i,j,k],toxin[i,j,k],vulnerable[i,j,k]]
-				hs = odeint(cell_death, hi, t)
-				infarct[i,j,k] = hs[-1,0]
-				toxin[i,j,k] = hs[-1,1]
+propagation_fcts.cell_death_steps(infarct, toxin, vulnerable, brain_region, 1, recovery_time*3600,
+                                  kf, kt, kc, kd, Td, Tp, engine=engine, propagate=False)
 
 # calculate the core volume
 core = np.sum(infarct>0.8)*pow(affine_matrix[0,0],3)/1000